@@ -16,16 +16,25 @@
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import concurrent.futures
 import hashlib
 import logging
+import os
 
 import secp256k1
 
+from . import archive
 from . import bl4p_backend
 from . import bl4p_rpc
+from . import journal
+from . import ratelimit
 from . import offerbook_backend
 from . import offerbook_rpc
 from . import rpcserver
+from . import signatures
+from . import snapshot
+from . import sqlite_backend
+from .api import bl4p_pb2
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s: %(message)s',
@@ -42,8 +51,91 @@ def parseArgs():
 		help='Address to bind service to')
 	parser.add_argument('--port', default=8000, type=int,
 		help='Port to bind service to')
-
-	return parser.parse_args()
+	parser.add_argument('--timing-wheel', action='store_true',
+		help='Process time-outs with a timing wheel (one-second granularity)')
+	parser.add_argument('--columnar', action='store_true',
+		help='Store transactions in typed arrays (requires NumPy)')
+	parser.add_argument('--columnar-offers', action='store_true',
+		help='Evaluate offer searches on typed arrays (requires NumPy)')
+	parser.add_argument('--archive', default=None, type=str,
+		help='File to archive finished transactions to (default: keep them in memory)')
+	parser.add_argument('--archive-retention', default=3600.0, type=float,
+		help='Time finished transactions stay in memory before being archived, in seconds')
+	parser.add_argument('--journal', default=None, type=str,
+		help='Write-ahead journal file for transaction state (default: no persistence)')
+	parser.add_argument('--snapshot', default=None, type=str,
+		help='Snapshot file of the transaction state; requires --journal')
+	parser.add_argument('--snapshot-interval', default=3600.0, type=float,
+		help='Time between snapshots, in seconds')
+
+	parser.add_argument('--verify-workers', default=0, type=int,
+		help='Verify signatures in a pool of this many threads (default: 0, on the event loop)')
+	parser.add_argument('--verify-processes', action='store_true',
+		help='Use processes instead of threads for --verify-workers')
+	parser.add_argument('--verify-batch-window', default=0.0, type=float,
+		help='Verify signatures of concurrent requests in batches, gathered during this many milliseconds; this saves pool calls, not verification time (default: 0, no batches)')
+
+	parser.add_argument('--max-in-flight', default=16, type=int,
+		help='Maximum number of concurrently handled requests per connection (default: 16; 1 handles requests strictly in order)')
+
+	parser.add_argument('--max-queue-size', default=1000, type=int,
+		help='Maximum number of requests waiting to be handled; further requests are rejected (default: 1000)')
+	parser.add_argument('--request-timeout', default=[], action='append', type=str,
+		metavar='[TYPE:]SECONDS',
+		help='Reject requests of type TYPE (default: all types) with a time-out error if they could not be handled within SECONDS after receiving them. SECONDS can be "none" to exempt TYPE from the default time-out. May be given multiple times.')
+	parser.add_argument('--max-message-size', default=[], action='append', type=str,
+		metavar='[TYPE:]BYTES',
+		help='Reject requests of type TYPE (default: all types) that are larger than BYTES, without parsing them (default: 65536). May be given multiple times.')
+	parser.add_argument('--rate-limit', default=[], action='append', type=str,
+		metavar='TYPE:RATE:BURST',
+		help='Limit messages of type TYPE (e.g. BL4P_FindOffers) to RATE per second with bursts of BURST, per user. May be given multiple times.')
+
+	parser.add_argument('--sqlite', default=None, type=str,
+		help='Store transaction state in this SQLite database instead of in memory')
+
+	args = parser.parse_args()
+	if args.snapshot is not None and args.journal is None:
+		parser.error('--snapshot requires --journal')
+	if args.max_in_flight < 1:
+		parser.error('--max-in-flight must be at least 1')
+	if args.max_queue_size < 1:
+		parser.error('--max-queue-size must be at least 1')
+
+	def parsePerType(values, convert, name):
+		'''
+		Converts [TYPE:]VALUE arguments to a dict of message type (None if
+		absent) -> converted value.
+		'''
+		ret = {}
+		for value in values:
+			try:
+				if ':' in value:
+					messageType, v = value.split(':')
+					messageType = getattr(bl4p_pb2, messageType)
+				else:
+					messageType, v = None, value
+				ret[messageType] = convert(v)
+			except (ValueError, AttributeError):
+				parser.error('Invalid %s: %s' % (name, value))
+		return ret
+
+	args.request_timeout = parsePerType(args.request_timeout,
+		lambda v: None if v == 'none' else float(v), 'request time-out')
+	args.max_message_size = parsePerType(args.max_message_size, int, 'maximum message size')
+
+	args.rate_limiter = None
+	if args.rate_limit:
+		args.rate_limiter = ratelimit.RateLimiter()
+		for rateLimit in args.rate_limit:
+			try:
+				messageType, rate, burst = rateLimit.split(':')
+				args.rate_limiter.setLimit(getattr(bl4p_pb2, messageType), float(rate), int(burst))
+			except (ValueError, AttributeError, KeyError):
+				parser.error('Invalid rate limit: ' + rateLimit)
+	if args.sqlite is not None and \
+		(args.journal or args.snapshot or args.archive or args.timing_wheel or args.columnar):
+		parser.error('--sqlite can not be combined with --journal, --snapshot, --archive, --timing-wheel or --columnar')
+	return args
 
 
 server = None #Make it a global variable
@@ -65,19 +157,50 @@ def main(timeoutFunctions=[]):
 	print('Starting BL4P server')
 	args = parseArgs()
 
-	server = rpcserver.RPCServer(args.host, args.port)
+	server = rpcserver.RPCServer(args.host, args.port, maxInFlight=args.max_in_flight, maxQueueSize=args.max_queue_size)
 	for f in timeoutFunctions:
 		server.registerTimeoutFunction(f)
-
-	bl4p = bl4p_backend.BL4P()
+	server.setRateLimiter(args.rate_limiter)
+	for messageType, timeout in args.request_timeout.items():
+		server.setRequestTimeout(messageType, timeout)
+	for messageType, maxSize in args.max_message_size.items():
+		server.setMaxMessageSize(messageType, maxSize)
+
+	if args.sqlite is not None:
+		bl4p = sqlite_backend.SQLiteBL4P(args.sqlite)
+	else:
+		bl4p = bl4p_backend.BL4P(timingWheel=args.timing_wheel, columnar=args.columnar)
+	if args.verify_workers > 0:
+		if args.verify_processes:
+			pool = concurrent.futures.ProcessPoolExecutor(args.verify_workers)
+		else:
+			pool = concurrent.futures.ThreadPoolExecutor(args.verify_workers)
+		bl4p.setVerificationPool(pool)
+	if args.verify_batch_window > 0:
+		bl4p.setBatchVerifier(signatures.BatchVerifier(
+			bl4p.verificationPool, args.verify_batch_window / 1000.0, loop=server.loop))
+	if args.archive is not None:
+		bl4p.setArchive(archive.TransactionArchive(args.archive, loop=server.loop), args.archive_retention)
 
 	#Some dummy users:
 	key3 = secp256k1.PrivateKey(privkey=sha256(b'3'))
 	key6 = secp256k1.PrivateKey(privkey=sha256(b'6'))
-	bl4p.users[3] = bl4p_backend.User(id=3, balance=2000000000, pubKey=key3.pubkey) #20 000 eur
-	bl4p.users[6] = bl4p_backend.User(id=6, balance=5000000000, pubKey=key6.pubkey) #50 000 eur
+	bl4p.addUser(bl4p_backend.User(id=3, balance=2000000000, pubKey=key3.pubkey.serialize())) #20 000 eur
+	bl4p.addUser(bl4p_backend.User(id=6, balance=5000000000, pubKey=key6.pubkey.serialize())) #50 000 eur
+
+	#After creating the users, since the journal is replayed on top of them:
+	if args.journal is not None:
+		generation = 0
+		if args.snapshot is not None and os.path.exists(args.snapshot):
+			generation = snapshot.load(bl4p, args.snapshot)
+
+		bl4p.setJournal(journal.Journal(args.journal, loop=server.loop), generation)
+		server.registerResponseBarrier(bl4p.journal.waitDurable)
+
+		if args.snapshot is not None:
+			snapshot.Snapshotter(bl4p, args.snapshot, args.snapshot_interval).start(server)
 
-	offerBook = offerbook_backend.OfferBook()
+	offerBook = offerbook_backend.OfferBook(columnar=args.columnar_offers)
 
 	bl4p_rpc.registerRPC(server, bl4p)
 	offerbook_rpc.registerRPC(server, offerBook)
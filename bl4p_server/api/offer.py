@@ -118,15 +118,40 @@ class Offer:
 
 
 	def matches(self, other):
-		try:
-			self.verifyMatches(other)
-		except MismatchError:
+		'''
+		Performs the same checks as verifyMatches, but returns a bool
+		instead of raising an exception with a description of the mismatch.
+		This is the fast path for searching through many offers.
+		'''
+		selfBid, selfAsk = self.bid, self.ask
+		otherBid, otherAsk = other.bid, other.ask
+
+		#Must be matching currency and exchange:
+		if selfBid.currency != otherAsk.currency or selfBid.exchange != otherAsk.exchange:
 			return False
+		if selfAsk.currency != otherBid.currency or selfAsk.exchange != otherBid.exchange:
+			return False
+
+		#All condition ranges must overlap
+		otherConditions = other.conditions
+		for key, r1 in self.conditions.items():
+			r2 = otherConditions.get(key)
+			if r2 is not None and (r1[0] > r2[1] or r2[0] > r1[1]):
+				return False
 
-		return True
+		#Must have compatible limit rates (see verifyMatches)
+		return \
+			selfBid.max_amount * otherBid.max_amount * \
+			selfAsk.max_amount_divisor * otherAsk.max_amount_divisor \
+			>= \
+			selfAsk.max_amount * otherAsk.max_amount * \
+			selfBid.max_amount_divisor * otherBid.max_amount_divisor
 
 
 	def verifyMatches(self, other):
+		'''
+		:raises MismatchError: if the offers don't match; the message describes why
+		'''
 		#Must be matching currency and exchange:
 		if self.bid.currency != other.ask.currency:
 			raise MismatchError('Currency mismatch between bid %s and ask %s' % (self.bid.currency, other.ask.currency))
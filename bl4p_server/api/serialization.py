@@ -67,3 +67,37 @@ def deserialize(message: bytes) -> Any:
 	obj.ParseFromString(serialized)
 	return obj
 
+
+
+def getTypeID(message: bytes) -> int:
+	'''
+	Reads the message type ID without parsing the message.
+	'''
+	return struct.unpack('<I', message[:4])[0]
+
+
+def getRequestID(message: bytes) -> int:
+	'''
+	Reads the request ID without parsing the message.
+	All message types have the request ID as field 1, and encoders write
+	fields in field number order. A request ID of 0 is not serialized.
+
+	Request IDs are uint64; if the varint is incomplete, longer than
+	10 bytes or out of range, this returns 0.
+	'''
+	if message[4:5] != b'\x08': #field 1, varint
+		return 0
+
+	ret = 0 #type: int
+	shift = 0 #type: int
+	for b in message[5:15]:
+		ret |= (b & 0x7f) << shift
+		if b < 0x80:
+			break
+		shift += 7
+	else:
+		return 0 #No last byte within 10 bytes
+
+	if ret >= 2**64:
+		return 0
+	return ret
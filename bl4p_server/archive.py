@@ -0,0 +1,321 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import struct
+
+from .utils import LRUCache
+
+
+
+class TransactionArchive:
+	'''
+	Append-only on-disk archive of finished transactions.
+
+	The data file consists of fixed-size records.
+	The index file is an on-disk hash table (open addressing with linear
+	probing) from payment hash to record number. It is rebuilt from the
+	data file when it is missing or outdated. When it gets half full, a
+	larger index is built next to it, indexGrowthStep records per add,
+	so that no single add reads the whole data file; lookups use the old
+	index until the new one is complete. Recently archived or requested
+	entries are kept in an in-memory LRU cache.
+
+	With an event loop, startFlush syncs the files in a worker thread,
+	like the group commit of the journal; no records can be added until
+	that is finished.
+
+	The payment preimage is not archived.
+	'''
+
+	#payment hash, sender user ID (-1 for None), receiver user ID,
+	#amount incoming, amount outgoing, sender time-out, receiver time-out,
+	#status
+	record = struct.Struct('<32sqqqqddB')
+
+	#Index header: number of indexed records
+	indexHeader = struct.Struct('<Q')
+
+	#Index slot: payment hash prefix, record number + 1 (0 = empty slot)
+	indexSlot = struct.Struct('<QQ')
+
+	statuses = ('sender_timeout', 'receiver_timeout', 'completed', 'canceled')
+
+	#Number of records copied to a growing index per add.
+	#Growth starts when the index is half full, and must be finished
+	#before it is full, so this must be at least 2.
+	indexGrowthStep = 16
+
+
+	def __init__(self, filename, cacheSize=10000, minIndexSize=1024, loop=None):
+		'''
+		:param filename: name of the data file; the index file gets an additional .index suffix
+		:param cacheSize: maximum number of entries in the in-memory cache
+		:param minIndexSize: minimum number of index slots
+		:param loop: the asyncio event loop; without loop, startFlush flushes synchronously
+		'''
+		self.filename = filename
+		self.loop = loop
+		self.flushing = False
+		self.indexFilename = filename + '.index'
+		self.minIndexSize = minIndexSize
+		self.cache = LRUCache(cacheSize) #payment hash -> fields
+
+		self.dataFD = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+
+		#Remove any incomplete record at the end:
+		size = os.fstat(self.dataFD).st_size
+		self.numRecords = size // self.record.size
+		if size != self.numRecords * self.record.size:
+			os.ftruncate(self.dataFD, self.numRecords * self.record.size)
+
+		self.index = None
+		self.indexCapacity = 0
+
+		#Index that is being built to replace index; see growIndex:
+		self.newIndex = None
+		self.newIndexCapacity = 0
+		self.numMigrated = 0 #number of records in newIndex
+
+		try:
+			self.openIndex()
+			numIndexed = self.indexHeader.unpack_from(self.index, 0)[0]
+		except ValueError:
+			numIndexed = None
+		if numIndexed != self.numRecords:
+			self.rebuildIndex()
+
+
+	def close(self):
+		if self.newIndex is not None:
+			self.growIndex(self.numRecords)
+		self.flush()
+		self.index.close()
+		os.close(self.indexFD)
+		os.close(self.dataFD)
+
+
+	def flush(self):
+		self.index.flush()
+		os.fsync(self.dataFD)
+
+
+	def startFlush(self, callback):
+		'''
+		Flush in a worker thread, or synchronously without event loop.
+		add may not be called until callback has been called.
+
+		:param callback: function(exception), called on the event loop
+		                 with None on success, or the exception of a
+		                 failed flush
+		'''
+		if self.loop is None:
+			try:
+				self.flush()
+			except Exception as e:
+				callback(e)
+			else:
+				callback(None)
+			return
+
+		self.flushing = True
+		future = self.loop.run_in_executor(None, self.flush)
+		future.add_done_callback(lambda f: self.finishFlush(f, callback))
+
+
+	def finishFlush(self, future, callback):
+		self.flushing = False
+		callback(future.exception())
+
+
+	def add(self, paymentHash, tx):
+		'''
+		Archive a finished transaction.
+
+		:param paymentHash: the payment hash
+		:param tx: the transaction (Transaction-like object)
+		'''
+		assert not self.flushing
+
+		fields = \
+		{
+		'sender_userid'  : tx.sender_userid,
+		'receiver_userid': tx.receiver_userid,
+		'amountIncoming' : tx.amountIncoming,
+		'amountOutgoing' : tx.amountOutgoing,
+		'senderTimeout'  : tx.senderTimeout,
+		'receiverTimeout': tx.receiverTimeout,
+		'status'         : str(tx.status),
+		}
+		data = self.record.pack(
+			paymentHash,
+			-1 if tx.sender_userid is None else tx.sender_userid,
+			tx.receiver_userid,
+			tx.amountIncoming, tx.amountOutgoing,
+			tx.senderTimeout, tx.receiverTimeout,
+			self.statuses.index(fields['status'])
+			)
+		os.pwrite(self.dataFD, data, self.numRecords * self.record.size)
+		self.numRecords += 1
+
+		self.addToIndex(self.index, self.indexCapacity, paymentHash, self.numRecords - 1)
+		self.indexHeader.pack_into(self.index, 0, self.numRecords)
+
+		if self.newIndex is None and 2 * self.numRecords > self.indexCapacity:
+			self.startIndexGrowth()
+		if self.newIndex is not None:
+			self.growIndex(self.indexGrowthStep)
+
+		self.cache.put(paymentHash, fields)
+
+
+	def get(self, paymentHash):
+		'''
+		Look up an archived transaction.
+
+		:param paymentHash: the payment hash
+
+		:returns: dict with the archived Transaction fields, or None
+		'''
+		fields = self.cache.get(paymentHash)
+		if fields is not None:
+			return fields
+
+		prefix = self.getHashPrefix(paymentHash)
+		slot = prefix % self.indexCapacity
+		while True:
+			offset = self.indexHeader.size + slot * self.indexSlot.size
+			slotPrefix, recordNumber = self.indexSlot.unpack_from(self.index, offset)
+			if recordNumber == 0:
+				return None
+			if slotPrefix == prefix:
+				fields = self.readRecord(recordNumber - 1, paymentHash)
+				if fields is not None:
+					self.cache.put(paymentHash, fields)
+					return fields
+			slot = (slot + 1) % self.indexCapacity
+
+
+	def readRecord(self, recordNumber, paymentHash=None):
+		data = os.pread(self.dataFD, self.record.size, recordNumber * self.record.size)
+		recordHash, sender_userid, receiver_userid, \
+		amountIncoming, amountOutgoing, senderTimeout, receiverTimeout, \
+		status = self.record.unpack(data)
+
+		if paymentHash is not None and recordHash != paymentHash:
+			return None
+
+		return \
+		{
+		'sender_userid'  : None if sender_userid < 0 else sender_userid,
+		'receiver_userid': receiver_userid,
+		'amountIncoming' : amountIncoming,
+		'amountOutgoing' : amountOutgoing,
+		'senderTimeout'  : senderTimeout,
+		'receiverTimeout': receiverTimeout,
+		'status'         : self.statuses[status],
+		}
+
+
+	@staticmethod
+	def getHashPrefix(paymentHash):
+		return int.from_bytes(paymentHash[:8], 'little')
+
+
+	def openIndex(self):
+		fd = os.open(self.indexFilename, os.O_RDWR | os.O_CREAT, 0o600)
+		size = os.fstat(fd).st_size
+		capacity = (size - self.indexHeader.size) // self.indexSlot.size
+		if capacity <= 0:
+			os.close(fd)
+			raise ValueError('Index file is too small')
+
+		self.indexFD = fd
+		self.index = mmap.mmap(fd, size)
+		self.indexCapacity = capacity
+
+
+	def addToIndex(self, index, capacity, paymentHash, recordNumber):
+		prefix = self.getHashPrefix(paymentHash)
+		slot = prefix % capacity
+		while True:
+			offset = self.indexHeader.size + slot * self.indexSlot.size
+			if self.indexSlot.unpack_from(index, offset)[1] == 0:
+				self.indexSlot.pack_into(index, offset, prefix, recordNumber + 1)
+				return
+			slot = (slot + 1) % capacity
+
+
+	def rebuildIndex(self):
+		'''
+		Build a new index from the complete data file.
+		'''
+		if self.newIndex is not None:
+			self.newIndex.close()
+			os.close(self.newIndexFD)
+			self.newIndex = None
+		self.startIndexGrowth()
+		self.growIndex(self.numRecords)
+
+
+	def startIndexGrowth(self):
+		'''
+		Start building a new index next to the current one.
+		'''
+		capacity = self.minIndexSize
+		while capacity < 4 * self.numRecords:
+			capacity *= 2
+
+		size = self.indexHeader.size + capacity * self.indexSlot.size
+		self.newIndexFD = os.open(self.indexFilename + '.tmp', os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+		os.ftruncate(self.newIndexFD, size)
+		self.newIndex = mmap.mmap(self.newIndexFD, size)
+		self.newIndexCapacity = capacity
+		self.numMigrated = 0
+
+
+	def growIndex(self, maxRecords):
+		'''
+		Copy records from the data file to the new index.
+		Once it has all records, it replaces the current index.
+
+		:param maxRecords: maximum number of records to copy
+		'''
+		chunkSize = 4096
+		end = min(self.numRecords, self.numMigrated + maxRecords)
+		for start in range(self.numMigrated, end, chunkSize):
+			count = min(chunkSize, end - start)
+			data = os.pread(self.dataFD, count * self.record.size, start * self.record.size)
+			for i in range(count):
+				paymentHash = data[i * self.record.size:i * self.record.size + 32]
+				self.addToIndex(self.newIndex, self.newIndexCapacity, paymentHash, start + i)
+		self.numMigrated = end
+
+		if self.numMigrated < self.numRecords:
+			return
+
+		self.indexHeader.pack_into(self.newIndex, 0, self.numRecords)
+		self.newIndex.flush()
+		os.replace(self.indexFilename + '.tmp', self.indexFilename)
+
+		if self.index is not None:
+			self.index.close()
+			os.close(self.indexFD)
+		self.index, self.indexFD, self.indexCapacity = \
+			self.newIndex, self.newIndexFD, self.newIndexCapacity
+		self.newIndex = None
@@ -15,6 +15,9 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import collections
+import concurrent.futures
 import decimal
 import hashlib
 import logging
@@ -25,7 +28,11 @@ import secp256k1
 
 from .api import selfreport
 
-from .utils import Struct, Enum
+from . import journal
+from . import signatures
+from . import timeouts
+
+from .utils import Struct, Enum, LRUCache
 
 
 
@@ -36,7 +43,8 @@ sha256 = lambda preimage: hashlib.sha256(preimage).digest()
 class User(Struct):
 	id = None     #int: user ID
 	balance = 0   #int: balance
-	pubKey = None #secp256k1.PublicKey: public key for self-reporting
+	pubKey = None #bytes: compressed public key for self-reporting (33 bytes)
+	signatureType = signatures.SignatureType.ecdsa #signatures.SignatureType: type of the user's signatures
 
 
 
@@ -49,6 +57,7 @@ waiting_for_sender -> canceled
 waiting_for_receiver -> canceled
 '''
 TransactionStatus = Enum(['waiting_for_selfreport', 'waiting_for_sender', 'waiting_for_receiver', 'sender_timeout', 'receiver_timeout', 'completed', 'canceled'])
+finalStates = (TransactionStatus.sender_timeout, TransactionStatus.receiver_timeout, TransactionStatus.completed, TransactionStatus.canceled)
 
 class Transaction(Struct):
 	sender_userid = None   #int or None: sender user ID
@@ -61,12 +70,39 @@ class Transaction(Struct):
 	status = None          #TransactionStatus: status
 
 
+class TransactionDict(dict):
+	'''
+	Dict storage of payment hash -> Transaction.
+	Queries over all transactions have the same interface as in
+	columnar.TransactionTable.
+	'''
+
+	def getLockedFunds(self, sender_userid=None):
+		'''
+		:param sender_userid: only count transactions of this sender (default: all senders)
+
+		:returns: sum of the incoming amounts of transactions that are waiting for the receiver
+		'''
+		return sum(
+			tx.amountIncoming
+			for tx in self.values()
+			if tx.status == TransactionStatus.waiting_for_receiver and \
+				(sender_userid is None or tx.sender_userid == sender_userid)
+			)
+
+
 class BL4P:
 	'''
 	BL4P data storage and business logic back-end.
-	This is a dummy class with only volatile (internal memory) storage.
-	An actual implementation should use something like SQL with
-	atomic database transactions.
+	This is a dummy class with internal memory storage.
+	State changes can be made persistent with a write-ahead journal
+	(see setJournal). For storage in SQL with atomic database
+	transactions, see sqlite_backend.SQLiteBL4P.
+
+	Once the journal fails to write, the back-end is fail-stop: all
+	further state changes are refused with BackendUnavailable, since the
+	in-memory state may already be ahead of the journal. The state on
+	disk is recovered by restarting with the journal.
 	'''
 
 	class UserNotFound(Exception):
@@ -96,9 +132,23 @@ class BL4P:
 		pass
 
 
-	def __init__(self):
+	class BackendUnavailable(Exception):
+		pass
+
+
+	def __init__(self, timingWheel=False, columnar=False):
+		'''
+		:param timingWheel: use a timing wheel instead of a heap for time-outs.
+		                    Time-outs are then processed with one-second granularity.
+		:param columnar: store transactions in a columnar.TransactionTable
+		                 instead of a TransactionDict. This requires NumPy.
+		'''
 		self.users = {}
-		self.transactions = {}
+		if columnar:
+			from . import columnar as columnarStorage
+			self.transactions = columnarStorage.TransactionTable()
+		else:
+			self.transactions = TransactionDict()
 
 		#1 + 0.25% fee:
 		self.fee_rate = decimal.Decimal('0.0025')
@@ -107,6 +157,151 @@ class BL4P:
 		self.maxLockedTimeout = 366 * 24 * 3600 #one year
 		self.minTimeBetweenTimeouts = 1         #one second
 
+		#Time-outs of transactions that are waiting for sender or receiver.
+		#Entries are keyed by payment hash.
+		if timingWheel:
+			self.timeouts = timeouts.TimingWheel(time.time())
+		else:
+			self.timeouts = timeouts.TimeoutHeap(self.isTimeoutValid)
+
+		#Expired time-outs that still need to be processed, in order of expiry.
+		#payment hash -> status
+		self.timeoutBacklog = collections.OrderedDict()
+
+		#Maximum time spent in one processTimeouts call:
+		self.timeoutTimeBudget = 0.01 #seconds
+
+		#Number of expired time-outs moved to the back-log at once:
+		self.timeoutBatchSize = 100
+
+		#Delay before retrying a failed processTimeouts call.
+		#It doubles on every consecutive failure, up to the maximum:
+		self.minTimeoutRetryDelay = 0.1 #seconds
+		self.maxTimeoutRetryDelay = 10.0 #seconds
+		self.timeoutRetryDelay = self.minTimeoutRetryDelay
+
+		#Optional archive for finished transactions; see setArchive:
+		self.archive = None
+		self.archiveRetentionTime = None
+		self.archiveQueue = collections.deque() #(archive time, payment hash)
+		self.archiveRetryDelay = self.minTimeoutRetryDelay #after a failed flush
+
+		#Optional executor for signature verification; see setVerificationPool:
+		self.verificationPool = None
+		#Optional signatures.BatchVerifier; see setBatchVerifier:
+		self.batchVerifier = None
+
+		#secp256k1.PublicKey objects are only made for users that need them:
+		#compressed key -> secp256k1.PublicKey
+		self.publicKeyCache = LRUCache(100000)
+
+		#Successfully verified and parsed reports, so that retries of
+		#processSenderAck don't need to do that again.
+		#(user ID, SHA256 of report, signature) -> (contents, payment hash)
+		self.verificationCache = LRUCache(10000)
+
+		#Optional RPCServer-like object; see setScheduler:
+		self.scheduler = None
+		self.scheduledTimeout = None
+
+		#Optional write-ahead journal; see setJournal:
+		self.journal = None
+
+
+	def setArchive(self, archive, retentionTime):
+		'''
+		Move finished transactions out of memory after some time.
+
+		:param archive: TransactionArchive-like object
+		:param retentionTime: time finished transactions stay in memory, in seconds
+		'''
+		self.archive = archive
+		self.archiveRetentionTime = retentionTime
+
+
+	def setScheduler(self, scheduler):
+		'''
+		Let processTimeouts be called through a deadline scheduler.
+
+		:param scheduler: object with the scheduleDeadline and cancelDeadline methods of RPCServer
+		'''
+		self.scheduler = scheduler
+		self.processTimeouts()
+
+
+	def setVerificationPool(self, pool):
+		'''
+		Let verifySignatureAsync verify signatures in an executor,
+		instead of on the calling thread.
+
+		:param pool: a concurrent.futures.ThreadPoolExecutor or ProcessPoolExecutor, or None
+		'''
+		self.verificationPool = pool
+
+
+	def setBatchVerifier(self, verifier):
+		'''
+		Let verifySignatureAsync verify signatures in batches.
+		This replaces the verification pool; the verifier may have its own pool.
+
+		:param verifier: a signatures.BatchVerifier, or None
+		'''
+		self.batchVerifier = verifier
+
+
+	def setJournal(self, newJournal, startGeneration=0):
+		'''
+		Replay a write-ahead journal, and write all further state changes to it.
+		Users are not journaled: they must already exist,
+		with the balances they had when the journal was started
+		(or when the snapshot was taken; see loadState).
+
+		:param newJournal: Journal-like object
+		:param startGeneration: the first journal generation to replay
+		'''
+		self.journal = None
+		for payload in newJournal.readRecords(startGeneration):
+			self.applyChange(payload)
+			if payload[0] in (journal.SENDER_TIMEOUT, journal.RECEIVER_TIMEOUT):
+				#When this was recorded, the time-out was already taken out of the index:
+				self.timeouts.remove(journal.decode(payload)[1])
+		self.journal = newJournal
+
+
+	def loadState(self, users, transactions):
+		'''
+		Load users and transactions, e.g. from a snapshot.
+
+		:param users: iterable of User
+		:param transactions: dict of payment hash -> Transaction
+
+		:raises signatures.UnsupportedSignatureType: a user's signature type can not be verified
+		'''
+		for user in users:
+			signatures.checkSupported(user.signatureType)
+			self.users[user.id] = user
+
+		for paymentHash, tx in transactions.items():
+			self.transactions[paymentHash] = tx
+			if tx.status == TransactionStatus.waiting_for_sender:
+				self.addTimeout(tx.senderTimeout, paymentHash, tx.status)
+			elif tx.status == TransactionStatus.waiting_for_receiver:
+				self.addTimeout(tx.receiverTimeout, paymentHash, tx.status)
+			elif tx.status in finalStates:
+				self.finishTransaction(paymentHash)
+
+
+	def addUser(self, user):
+		'''
+		Add a user, unless a user with the same ID already exists.
+
+		:param user: the user data structure
+
+		:raises signatures.UnsupportedSignatureType: the user's signature type can not be verified
+		'''
+		signatures.checkSupported(user.signatureType)
+		self.users.setdefault(user.id, user)
+
 
 	def getUser(self, userid):
 		'''
@@ -147,6 +342,9 @@ class BL4P:
 				)
 			raise BL4P.TransactionNotFound()
 
+		#processTimeouts may lag behind; the time-out itself is leading:
+		self.expireIfDue(paymentHash, ret)
+
 		if acceptableStates is not None and ret.status not in acceptableStates:
 			logging.warning(
 				'getTransaction: payment is not in an acceptable state: state %s; acceptable %s' % \
@@ -233,40 +431,83 @@ class BL4P:
 			(receiver_userid, self.getUser(receiver_userid).balance)
 			)
 
-		tx = Transaction(
-			sender_userid = None,
-			receiver_userid = receiver_userid,
-			amountIncoming = amountIncoming,
-			amountOutgoing = amountOutgoing,
-			preimage = preimage,
-			senderTimeout = senderTimeout,
-			receiverTimeout = receiverTimeout,
-			status = TransactionStatus.waiting_for_selfreport
-			)
-		self.transactions[paymentHash] = tx
+		self.changeState(journal.encodeStart(paymentHash, preimage,
+			receiver_userid, amountIncoming, amountOutgoing,
+			senderTimeout, receiverTimeout
+			))
 		return amountIncoming, amountOutgoing, paymentHash
 
 
-	def processSelfReport(self, receiver_userid, report, signature):
+	def checkSignature(self, user, message, signature):
 		'''
-		Process self-reporting by the receiver.
+		:param user: the user
+		:param message: the signed message
+		:param signature: the user's signature over the message
 
-		:param receiver_userid: the user ID of the receiver
+		:raises SignatureFailure: the signature is not correct
+		'''
+		if not signatures.verify(self.getPublicKey(user), message, signature, user.signatureType):
+			raise BL4P.SignatureFailure()
+
+
+	def getPublicKey(self, user):
+		'''
+		:param user: the user
+
+		:returns: the user's public key as secp256k1.PublicKey, or None if it has no valid key
+		'''
+		if user.pubKey is None:
+			return None
+
+		ret = self.publicKeyCache.get(user.pubKey)
+		if ret is None:
+			try:
+				ret = secp256k1.PublicKey(user.pubKey, raw=True)
+			except Exception:
+				return None
+			self.publicKeyCache.put(user.pubKey, ret)
+		return ret
+
+
+	def getPublicKeyCacheStatistics(self):
+		'''
+		:returns: dict with the number of cache hits and misses, and the cache size
+		'''
+		return \
+		{
+		'hits'  : self.publicKeyCache.hits,
+		'misses': self.publicKeyCache.misses,
+		'size'  : len(self.publicKeyCache),
+		}
+
+
+	def getVerificationCacheKey(self, userid, report, signature):
+		return (userid, sha256(report), signature)
+
+
+	def verifyReport(self, user, report, signature, signatureVerified=False):
+		'''
+		Verify the signature over a report, and parse the report.
+		Successful results are cached, so repeated calls with the same
+		report and signature skip both.
+
+		:param user: the user
 		:param report: the serialized report
-		:param signature: the user's signature over the report report
+		:param signature: the user's signature over the report
+		:param signatureVerified: the signature is already verified (see verifySignatureAsync)
+
+		:returns: tuple (report contents, payment hash)
 
 		:raises SignatureFailure: the signature is not correct
-		:raises TransactionNotFound: No transaction was found for this user and hash
 		:raises MissingData: The report is missing required data
 		'''
+		key = self.getVerificationCacheKey(user.id, report, signature)
+		ret = self.verificationCache.get(key)
+		if ret is not None:
+			return ret
 
-		user = self.getUser(receiver_userid)
-		try:
-			sigObject = user.pubKey.ecdsa_deserialize(signature)
-			assert user.pubKey.ecdsa_verify(report, sigObject)
-		except:
-			#On *anything* that goes wrong, including assertion failure:
-			raise BL4P.SignatureFailure()
+		if not signatureVerified:
+			self.checkSignature(user, report, signature)
 
 		#TODO: propagate correct exception type if this fails
 		contents = selfreport.deserialize(report)
@@ -280,6 +521,69 @@ class BL4P:
 		except KeyError:
 			raise BL4P.MissingData()
 
+		ret = contents, paymentHash
+		self.verificationCache.put(key, ret)
+		return ret
+
+
+	@asyncio.coroutine
+	def verifySignatureAsync(self, userid, message, signature):
+		'''
+		Verify a user's signature, in the batch verifier or the
+		verification pool if there is one.
+		This does not touch any other state, so other calls can be
+		processed while waiting for the result.
+
+		:param userid: the user ID
+		:param message: the signed message
+		:param signature: the user's signature over the message
+
+		:raises UserNotFound: No user was found with this ID
+		:raises SignatureFailure: the signature is not correct
+		'''
+		user = self.getUser(userid)
+		if self.verificationCache.get(self.getVerificationCacheKey(userid, message, signature)) is not None:
+			#Verified before
+			return
+
+		if self.batchVerifier is None and self.verificationPool is None:
+			self.checkSignature(user, message, signature)
+			return
+
+		pool = self.verificationPool if self.batchVerifier is None else self.batchVerifier.pool
+		if isinstance(pool, concurrent.futures.ProcessPoolExecutor):
+			#PublicKey objects can not be passed to other processes:
+			pubKey = user.pubKey
+		else:
+			pubKey = self.getPublicKey(user)
+
+		if self.batchVerifier is not None:
+			correct = yield from self.batchVerifier.verify(
+				pubKey, message, signature, user.signatureType)
+		else:
+			correct = yield from asyncio.get_event_loop().run_in_executor(
+				pool, signatures.verify, pubKey, message, signature, user.signatureType)
+		if not correct:
+			raise BL4P.SignatureFailure()
+
+
+	def processSelfReport(self, receiver_userid, report, signature, signatureVerified=False):
+		'''
+		Process self-reporting by the receiver.
+
+		:param receiver_userid: the user ID of the receiver
+		:param report: the serialized report
+		:param signature: the user's signature over the report report
+		:param signatureVerified: the signature is already verified (see verifySignatureAsync)
+
+		:raises SignatureFailure: the signature is not correct
+		:raises TransactionNotFound: No transaction was found for this user and hash
+		:raises MissingData: The report is missing required data
+		'''
+
+		user = self.getUser(receiver_userid)
+		contents, paymentHash = self.verifyReport(user, report, signature, signatureVerified)
+
 		tx = self.getTransaction(paymentHash, [TransactionStatus.waiting_for_selfreport])
 
 		if tx.receiver_userid != receiver_userid:
@@ -290,7 +594,7 @@ class BL4P:
 
 		#TODO: store report and signature data
 
-		tx.status = TransactionStatus.waiting_for_sender
+		self.changeState(journal.encode(journal.SELFREPORT, paymentHash))
 
 
 	def cancelTransaction(self, receiver_userid, paymentHash):
@@ -311,17 +615,12 @@ class BL4P:
 			#The transaction exists globally, but not in this user's transactions.
 			raise BL4P.TransactionNotFound()
 
-		if tx.status == TransactionStatus.waiting_for_receiver:
-			#Funds are already sent - give back to sender
-			sender = self.getUser(tx.sender_userid)
-			sender.balance += tx.amountIncoming
-
 		logging.info('cancelTransaction')
 
-		tx.status = TransactionStatus.canceled
+		self.changeState(journal.encode(journal.CANCEL, paymentHash))
 
 
-	def processSenderAck(self, sender_userid, amount, paymentHash, maxLockedTimeout, report, signature):
+	def processSenderAck(self, sender_userid, amount, paymentHash, maxLockedTimeout, report, signature, signatureVerified=False):
 		'''
 		Process acknowledgement by the sender.
 
@@ -332,6 +631,7 @@ class BL4P:
 		
 		:param report: the serialized report
 		:param signature: the user's signature over the report report
+		:param signatureVerified: the signature is already verified (see verifySignatureAsync)
 
 		:returns: the payment preimage
 
@@ -343,25 +643,7 @@ class BL4P:
 		'''
 
 		sender = self.getUser(sender_userid)
-
-		try:
-			sigObject = sender.pubKey.ecdsa_deserialize(signature)
-			assert sender.pubKey.ecdsa_verify(report, sigObject)
-		except:
-			#On *anything* that goes wrong, including assertion failure:
-			raise BL4P.SignatureFailure()
-
-		#TODO: propagate correct exception type if this fails
-		contents = selfreport.deserialize(report)
-
-		#We require this data:
-		try:
-			paymentHash = bytes.fromhex(contents['paymentHash'])
-			offerID = int(contents['offerID'])
-			receiverCryptoAmount = decimal.Decimal(contents['receiverCryptoAmount'])
-			cryptoCurrency = contents['cryptoCurrency']
-		except KeyError:
-			raise BL4P.MissingData()
+		contents, paymentHash = self.verifyReport(sender, report, signature, signatureVerified)
 
 		#TODO: compare against receiver reported data
 
@@ -418,14 +700,12 @@ class BL4P:
 			(sender_userid, sender.balance)
 			)
 
-		sender.balance -= amount
+		self.changeState(journal.encodeSenderAck(paymentHash, sender_userid))
 
 		logging.info('  New balance of sending user %d: %d' % \
-			(sender_userid, sender.balance)
+			(sender_userid, self.getUser(sender_userid).balance)
 			)
 
-		tx.sender_userid = sender_userid
-		tx.status = TransactionStatus.waiting_for_receiver
 		return tx.preimage
 
 
@@ -459,14 +739,12 @@ class BL4P:
 			(tx.receiver_userid, receiver.balance)
 			)
 
-		receiver.balance += tx.amountOutgoing
+		self.changeState(journal.encode(journal.CLAIM, paymentHash))
 
 		logging.info('  New balance of receiving user %d: %d' % \
-			(tx.receiver_userid, receiver.balance)
+			(tx.receiver_userid, self.getUser(tx.receiver_userid).balance)
 			)
 
-		tx.status = TransactionStatus.completed
-
 
 	def getTransactionStatus(self, userid, paymentHash):
 		'''
@@ -484,45 +762,385 @@ class BL4P:
 		#Just check that the user exists
 		self.getUser(userid)
 
-		tx = self.getTransaction(paymentHash)
+		try:
+			tx = self.getTransaction(paymentHash)
+		except BL4P.TransactionNotFound:
+			tx = self.getArchivedTransaction(paymentHash)
+
 		if userid not in (tx.sender_userid, tx.receiver_userid):
 			raise BL4P.TransactionNotFound()
 
 		return str(tx.status)
 
 
+	def getLockedFunds(self, userid=None):
+		'''
+		Return the funds that are taken from senders, but not yet given
+		to receivers or given back.
+
+		:param userid: only count transactions of this sender (default: all senders)
+
+		:returns: the sum of the incoming amounts
+		'''
+		return self.transactions.getLockedFunds(userid)
+
+
+	def changeState(self, payload):
+		'''
+		Write a state change to the journal (if any), and apply it.
+
+		:param payload: the journal record payload
+
+		:raises BackendUnavailable: the journal has failed; nothing is changed
+		'''
+		self.checkAvailable()
+		if self.journal is not None:
+			self.journal.append(payload)
+		self.applyChange(payload)
+
+
+	def checkAvailable(self):
+		'''
+		:raises BackendUnavailable: the journal has failed, so state changes are refused
+		'''
+		if self.journal is not None and self.journal.failed is not None:
+			raise BL4P.BackendUnavailable()
+
+
+	def applyChange(self, payload):
+		'''
+		Apply a state change to the in-memory state.
+		This is used both for new state changes and for journal replay,
+		so it must not depend on anything outside the state.
+
+		:param payload: the journal record payload
+		'''
+		record = journal.decode(payload)
+		recordType, paymentHash = record[:2]
+
+		if recordType == journal.START:
+			preimage, receiver_userid, amountIncoming, amountOutgoing, \
+			senderTimeout, receiverTimeout = record[2:]
+			self.transactions[paymentHash] = Transaction(
+				sender_userid = None,
+				receiver_userid = receiver_userid,
+				amountIncoming = amountIncoming,
+				amountOutgoing = amountOutgoing,
+				preimage = preimage,
+				senderTimeout = senderTimeout,
+				receiverTimeout = receiverTimeout,
+				status = TransactionStatus.waiting_for_selfreport
+				)
+			return
+
+		if recordType == journal.ARCHIVE:
+			#Finished transactions may be absent from a snapshot:
+			self.transactions.pop(paymentHash, None)
+			return
+
+		tx = self.transactions[paymentHash]
+
+		if recordType == journal.SELFREPORT:
+			self.setStatus(paymentHash, tx, TransactionStatus.waiting_for_sender)
+
+		elif recordType == journal.SENDERACK:
+			tx.sender_userid = record[2]
+			self.getUser(tx.sender_userid).balance -= tx.amountIncoming
+			self.setStatus(paymentHash, tx, TransactionStatus.waiting_for_receiver)
+
+		elif recordType == journal.CLAIM:
+			self.getUser(tx.receiver_userid).balance += tx.amountOutgoing
+			self.setStatus(paymentHash, tx, TransactionStatus.completed)
+
+		elif recordType == journal.CANCEL:
+			if tx.status == TransactionStatus.waiting_for_receiver:
+				#Funds are already sent - give back to sender
+				self.getUser(tx.sender_userid).balance += tx.amountIncoming
+			self.setStatus(paymentHash, tx, TransactionStatus.canceled)
+
+		elif recordType == journal.SENDER_TIMEOUT:
+			self.processSenderTimeout(tx)
+			self.finishTransaction(paymentHash)
+
+		elif recordType == journal.RECEIVER_TIMEOUT:
+			self.processReceiverTimeout(tx)
+			self.finishTransaction(paymentHash)
+
+
+	def setStatus(self, paymentHash, tx, status):
+		'''
+		Change the status of a transaction, and update its time-out accordingly.
+
+		:param paymentHash: the payment hash
+		:param tx: the transaction
+		:param status: the new status
+		'''
+		oldStatus = tx.status
+		tx.status = status
+
+		if oldStatus in (TransactionStatus.waiting_for_sender, TransactionStatus.waiting_for_receiver):
+			self.timeouts.remove(paymentHash)
+
+		if status == TransactionStatus.waiting_for_sender:
+			self.addTimeout(tx.senderTimeout, paymentHash, status)
+		elif status == TransactionStatus.waiting_for_receiver:
+			self.addTimeout(tx.receiverTimeout, paymentHash, status)
+		elif status in finalStates:
+			self.finishTransaction(paymentHash)
+
+
+	def addTimeout(self, timeout, paymentHash, status):
+		self.timeouts.add(timeout, paymentHash, status)
+		self.requestWakeup(timeout)
+
+
+	def finishTransaction(self, paymentHash):
+		'''
+		Queue a transaction that has reached a final state for archiving.
+
+		:param paymentHash: the payment hash
+		'''
+		if self.archive is None:
+			return
+
+		archiveTime = time.time() + self.archiveRetentionTime
+		self.archiveQueue.append((archiveTime, paymentHash))
+		self.requestWakeup(archiveTime)
+
+
+	def getArchivedTransaction(self, paymentHash):
+		'''
+		Get an archived transaction.
+
+		:param paymentHash: the payment hash
+
+		:returns: the transaction data structure, without preimage
+
+		:raises TransactionNotFound: No transaction was found in the archive
+		'''
+		fields = None if self.archive is None else self.archive.get(paymentHash)
+		if fields is None:
+			raise BL4P.TransactionNotFound()
+		return Transaction(**fields)
+
+
+	def requestWakeup(self, t):
+		'''
+		Make sure processTimeouts gets called no later than t.
+
+		:param t: the time (seconds since UNIX epoch)
+		'''
+		#Only an earlier time changes the schedule.
+		#Removed time-outs may cause a premature wake-up, but never a late one.
+		if self.scheduledTimeout is None or t < self.scheduledTimeout:
+			self.updateSchedule(t)
+
+
+	def updateSchedule(self, timeout=None):
+		'''
+		Let the scheduler (if any) call processScheduledTimeouts at the given time.
+
+		:param timeout: the next time-out (seconds since UNIX epoch), or None
+		'''
+		self.scheduledTimeout = timeout
+		if self.scheduler is None:
+			return
+
+		if timeout is None:
+			self.scheduler.cancelDeadline(self)
+		else:
+			self.scheduler.scheduleDeadline(self, timeout, self.processScheduledTimeouts)
+
+
+	def processScheduledTimeouts(self):
+		'''
+		Call processTimeouts when the scheduled deadline has come.
+
+		If processTimeouts fails, the error is logged and the call is
+		retried after timeoutRetryDelay seconds.
+		'''
+		#The scheduler has already removed the deadline:
+		self.scheduledTimeout = None
+
+		try:
+			self.processTimeouts()
+		except Exception:
+			logging.exception('Processing time-outs failed; retrying in %f seconds' % \
+				self.timeoutRetryDelay)
+			self.updateSchedule(time.time() + self.timeoutRetryDelay)
+			self.timeoutRetryDelay = min(2 * self.timeoutRetryDelay, self.maxTimeoutRetryDelay)
+			return
+
+		self.timeoutRetryDelay = self.minTimeoutRetryDelay
+
+
+	def isTimeoutValid(self, paymentHash, status):
+		tx = self.transactions.get(paymentHash)
+		return tx is not None and tx.status == status
+
+
 	def processTimeouts(self):
 		'''
-		Process transaction time-out events.
+		Process transaction time-out events, and archive finished
+		transactions whose retention time has passed.
+
+		At most timeoutTimeBudget seconds are spent on this.
+		Expired time-outs are taken from the time-out index in batches
+		of timeoutBatchSize; any remaining ones stay in the back-log or
+		in the index, and processing continues on the next call.
 
 		:returns: the time-delta to the next time-out, or None
+
+		:raises BackendUnavailable: the journal has failed
 		'''
 
+		#Before anything is taken out of the back-log:
+		self.checkAvailable()
+
 		t = time.time()
+		endTime = t + self.timeoutTimeBudget
+
+		backlog = self.timeoutBacklog
+		finished = False
+		while True:
+			if not backlog:
+				for paymentHash, status in self.timeouts.popExpired(t, self.timeoutBatchSize):
+					backlog[paymentHash] = status
+				if not backlog:
+					finished = True
+					break
+
+			paymentHash, status = backlog.popitem(last=False)
+			self.processTimeout(paymentHash, self.transactions[paymentHash])
+
+			if time.time() > endTime:
+				break
+
+		if self.archiveQueue and finished:
+			self.archiveTransactions(t, endTime)
+
+		#During a flush, finishArchiving takes care of the archive queue:
+		archiveWaiting = self.archiveQueue and not self.archive.flushing
+
+		if not finished or (archiveWaiting and self.archiveQueue[0][0] <= t):
+			#Continue as soon as possible
+			self.updateSchedule(t)
+			return 0.0
+
+		nextTimeout = self.timeouts.getNextTimeout()
+		if archiveWaiting:
+			archiveTime = self.archiveQueue[0][0]
+			if nextTimeout is None or archiveTime < nextTimeout:
+				nextTimeout = archiveTime
+
+		self.updateSchedule(nextTimeout)
+		return None if nextTimeout is None else nextTimeout - t
 
-		nextTimeout = None
 
-		#TODO: cache a sorted time-out list, to make this scalable
-		for tx in self.transactions.values():
-			#We have two kinds of time-outs
-			if tx.status == TransactionStatus.waiting_for_sender:
-				timeout, handler = tx.senderTimeout, self.processSenderTimeout
-			elif tx.status == TransactionStatus.waiting_for_receiver:
-				timeout, handler = tx.receiverTimeout, self.processReceiverTimeout
-			else:
-				#python3-coverage doesn't detect coverage of
-				#this case, due to a Python optimization.
-				continue # pragma: no cover
+	def getTimeoutBacklogSize(self):
+		'''
+		:returns: the number of expired time-outs that are not yet processed
+		'''
+		return len(self.timeoutBacklog)
 
-			if timeout <= t:
-				#This time-out has happened
-				handler(tx)
 
-			elif nextTimeout is None or timeout < nextTimeout:
-				#This is the upcoming time-out
-				nextTimeout = timeout
+	def expireIfDue(self, paymentHash, tx):
+		'''
+		Process the time-out of tx if it has passed, regardless of whether
+		processTimeouts has already got to it.
 
-		return None if nextTimeout is None else nextTimeout - t
+		:param paymentHash: the payment hash
+		:param tx: the transaction
+		'''
+		if tx.status == TransactionStatus.waiting_for_sender:
+			timeout = tx.senderTimeout
+		elif tx.status == TransactionStatus.waiting_for_receiver:
+			timeout = tx.receiverTimeout
+		else:
+			return
+
+		if timeout > time.time():
+			return
+
+		#Before anything is taken out of the back-log:
+		self.checkAvailable()
+
+		inBacklog = self.timeoutBacklog.pop(paymentHash, None) is not None
+		self.processTimeout(paymentHash, tx)
+		if not inBacklog:
+			self.timeouts.remove(paymentHash)
+
+
+	def processTimeout(self, paymentHash, tx):
+		#We have two kinds of time-outs
+		if tx.status == TransactionStatus.waiting_for_sender:
+			recordType = journal.SENDER_TIMEOUT
+		else:
+			recordType = journal.RECEIVER_TIMEOUT
+
+		self.changeState(journal.encode(recordType, paymentHash))
+
+
+	def archiveTransactions(self, t, endTime):
+		'''
+		Move finished transactions from memory to the archive.
+		They are removed from memory once the archive is flushed;
+		see finishArchiving.
+
+		:param t: the current time (seconds since UNIX epoch)
+		:param endTime: stop when this time has passed (seconds since UNIX epoch)
+		'''
+		if self.archive.flushing:
+			#finishArchiving will continue
+			return
+
+		archived = []
+		queue = self.archiveQueue
+		try:
+			while queue and queue[0][0] <= t:
+				archiveTime, paymentHash = queue[0]
+				tx = self.transactions.get(paymentHash)
+				if tx is not None:
+					#Else it was already archived before a journal replay.
+					#If this fails, the entry stays queued for a retry:
+					self.archive.add(paymentHash, tx)
+					archived.append(paymentHash)
+				queue.popleft()
+
+				if time.time() > endTime:
+					break
+		finally:
+			#Also finish the ones that were added before a failure:
+			if archived:
+				self.archive.startFlush(
+					lambda error: self.finishArchiving(archived, error))
+
+
+	def finishArchiving(self, archived, error):
+		'''
+		Remove archived transactions from memory, now that the archive is
+		flushed. If the flush failed, archiving them is retried after
+		archiveRetryDelay seconds, which doubles on consecutive failures.
+
+		:param archived: list of payment hashes
+		:param error: the exception of a failed flush, or None
+		'''
+		if error is not None:
+			logging.error('Archive: flush failed: ' + str(error))
+			retryTime = time.time() + self.archiveRetryDelay
+			self.archiveRetryDelay = min(2 * self.archiveRetryDelay, self.maxTimeoutRetryDelay)
+			self.archiveQueue.extendleft((retryTime, paymentHash) for paymentHash in reversed(archived))
+			self.requestWakeup(retryTime)
+			return
+
+		self.archiveRetryDelay = self.minTimeoutRetryDelay
+
+		#Only remove them once they are safely in the archive:
+		for paymentHash in archived:
+			self.changeState(journal.encode(journal.ARCHIVE, paymentHash))
+
+		if self.archiveQueue:
+			self.requestWakeup(self.archiveQueue[0][0])
 
 
 	def processSenderTimeout(self, tx):
@@ -15,9 +15,13 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import binascii
+import hashlib
 
 from .api import bl4p_pb2
+from .api import selfreport
+from .rpcserver import Priority
 
 
 def error(reason):
@@ -45,6 +49,8 @@ def start(bl4p, userID, request):
 		return error(bl4p_pb2.Err_InvalidAmount)
 	except bl4p.InvalidTimeout:
 		return error(bl4p_pb2.Err_InvalidAmount)
+	except bl4p.BackendUnavailable:
+		return error(bl4p_pb2.Err_BackendUnavailable)
 
 	result = bl4p_pb2.BL4P_StartResult()
 	result.sender_amount.amount = senderAmount
@@ -53,15 +59,20 @@ def start(bl4p, userID, request):
 	return result
 
 
+@asyncio.coroutine
 def selfReport(bl4p, userID, request):
 	if userID is None:
 		return error(bl4p_pb2.Err_Unauthorized)
 
 	try:
+		#Verification happens outside the event loop; state is only
+		#touched after it has finished:
+		yield from bl4p.verifySignatureAsync(userID, request.report, request.signature)
 		bl4p.processSelfReport(
 			receiver_userid=userID,
 			report=request.report,
-			signature=request.signature)
+			signature=request.signature,
+			signatureVerified=True)
 	except bl4p.UserNotFound:
 		return error(bl4p_pb2.Err_InvalidAccount)
 	except bl4p.SignatureFailure:
@@ -70,6 +81,8 @@ def selfReport(bl4p, userID, request):
 		return error(bl4p_pb2.Err_NoSuchOrder)
 	except bl4p.MissingData:
 		return error(bl4p_pb2.Err_MalformedRequest)
+	except bl4p.BackendUnavailable:
+		return error(bl4p_pb2.Err_BackendUnavailable)
 
 	result = bl4p_pb2.BL4P_SelfReportResult()
 	return result
@@ -86,16 +99,20 @@ def cancelStart(bl4p, userID, request):
 			)
 	except bl4p.TransactionNotFound:
 		return error(bl4p_pb2.Err_NoSuchOrder)
+	except bl4p.BackendUnavailable:
+		return error(bl4p_pb2.Err_BackendUnavailable)
 
 	result = bl4p_pb2.BL4P_CancelStartResult()
 	return result
 
 
+@asyncio.coroutine
 def send(bl4p, userID, request):
 	if userID is None:
 		return error(bl4p_pb2.Err_Unauthorized)
 
 	try:
+		yield from bl4p.verifySignatureAsync(userID, request.report, request.signature)
 		paymentPreimage = \
 			bl4p.processSenderAck(
 				sender_userid=userID,
@@ -105,6 +122,7 @@ def send(bl4p, userID, request):
 
 				report=request.report,
 				signature=request.signature,
+				signatureVerified=True,
 				)
 
 	except bl4p.UserNotFound:
@@ -117,6 +135,8 @@ def send(bl4p, userID, request):
 		return error(bl4p_pb2.Err_BalanceInsufficient)
 	except bl4p.MissingData:
 		return error(bl4p_pb2.Err_MalformedRequest)
+	except bl4p.BackendUnavailable:
+		return error(bl4p_pb2.Err_BackendUnavailable)
 
 	result = bl4p_pb2.BL4P_SendResult()
 	result.payment_preimage.data = paymentPreimage
@@ -130,6 +150,8 @@ def receive(bl4p, userID, request):
 			)
 	except bl4p.TransactionNotFound:
 		return error(bl4p_pb2.Err_NoSuchOrder)
+	except bl4p.BackendUnavailable:
+		return error(bl4p_pb2.Err_BackendUnavailable)
 
 	result = bl4p_pb2.BL4P_ReceiveResult()
 	return result
@@ -147,6 +169,8 @@ def getStatus(bl4p, userID, request):
 		return error(bl4p_pb2.Err_InvalidAccount)
 	except bl4p.TransactionNotFound:
 		return error(bl4p_pb2.Err_NoSuchOrder)
+	except bl4p.BackendUnavailable:
+		return error(bl4p_pb2.Err_BackendUnavailable)
 
 	result = bl4p_pb2.BL4P_GetStatusResult()
 	result.status = \
@@ -162,6 +186,21 @@ def getStatus(bl4p, userID, request):
 	return result
 
 
+#Ordering keys: requests on the same payment hash are handled in order.
+
+def paymentHashKey(request):
+	return request.payment_hash.data
+
+
+def preimageKey(request):
+	return hashlib.sha256(request.payment_preimage.data).digest()
+
+
+def selfReportKey(request):
+	contents = selfreport.deserialize(request.report)
+	return bytes.fromhex(contents['paymentHash'])
+
+
 def makeClosure(function, firstArg):
 	def closure(*args, **kwargs):
 		return function(firstArg, *args, **kwargs)
@@ -171,17 +210,19 @@ def makeClosure(function, firstArg):
 def registerRPC(server, bl4p):
 	functionData = \
 	{
-	bl4p_pb2.BL4P_Start      : start,
-	bl4p_pb2.BL4P_CancelStart: cancelStart,
-	bl4p_pb2.BL4P_Send       : send,
-	bl4p_pb2.BL4P_Receive    : receive,
-	bl4p_pb2.BL4P_GetStatus  : getStatus,
-	bl4p_pb2.BL4P_SelfReport : selfReport,
+	bl4p_pb2.BL4P_Start      : (start      , None          , Priority.normal),
+	bl4p_pb2.BL4P_CancelStart: (cancelStart, paymentHashKey, Priority.high  ),
+	bl4p_pb2.BL4P_Send       : (send       , paymentHashKey, Priority.high  ),
+	bl4p_pb2.BL4P_Receive    : (receive    , preimageKey   , Priority.high  ),
+	bl4p_pb2.BL4P_GetStatus  : (getStatus  , paymentHashKey, Priority.normal),
+	bl4p_pb2.BL4P_SelfReport : (selfReport , selfReportKey , Priority.normal),
 	}
 
-	for requestType, function in functionData.items():
+	#Send, Receive and CancelStart are time-critical:
+	#funds are locked against HTLC expiry.
+	for requestType, (function, orderingKey, priority) in functionData.items():
 		server.registerRPCFunction(requestType,
-			makeClosure(function, bl4p))
+			makeClosure(function, bl4p), orderingKey, priority)
 
-	server.registerTimeoutFunction(bl4p.processTimeouts)
+	bl4p.setScheduler(server)
 
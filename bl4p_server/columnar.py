@@ -0,0 +1,452 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Columnar storage of transactions and offers. This requires NumPy.
+'''
+
+import numpy
+
+from .api.offer import CONDITION_NO_MIN, CONDITION_NO_MAX
+from .bl4p_backend import Transaction
+
+
+
+statuses = ('waiting_for_selfreport', 'waiting_for_sender', 'waiting_for_receiver',
+	'sender_timeout', 'receiver_timeout', 'completed', 'canceled')
+statusCodes = {s: i for i, s in enumerate(statuses)}
+
+WAITING_FOR_SENDER = statusCodes['waiting_for_sender']
+WAITING_FOR_RECEIVER = statusCodes['waiting_for_receiver']
+FREE = 255 #status of unused rows
+
+fieldNames = ('sender_userid', 'receiver_userid', 'amountIncoming', 'amountOutgoing',
+	'preimage', 'senderTimeout', 'receiverTimeout', 'status')
+
+
+
+def makeField(name, fromArray, toArray):
+	def get(self):
+		assert self.table.generation[self.row] == self.generation, 'stale TransactionRow'
+		return fromArray(getattr(self.table, name)[self.row])
+
+	def set(self, value):
+		assert self.table.generation[self.row] == self.generation, 'stale TransactionRow'
+		getattr(self.table, name)[self.row] = toArray(value)
+
+	return property(get, set)
+
+
+
+class TransactionRow:
+	'''
+	Transaction-like view of a row in a TransactionTable.
+	It stays valid until the transaction is removed from the table;
+	using it afterwards fails an assertion, even if the row has been
+	re-used for another transaction.
+	'''
+	__slots__ = ('table', 'row', 'generation')
+
+	def __init__(self, table, row):
+		self.table = table
+		self.row = row
+		self.generation = table.generation[row]
+
+	sender_userid = makeField('sender_userid',
+		lambda x: None if x < 0 else int(x),
+		lambda x: -1 if x is None else x)
+	receiver_userid = makeField('receiver_userid', int, int)
+	amountIncoming = makeField('amountIncoming', int, int)
+	amountOutgoing = makeField('amountOutgoing', int, int)
+	preimage = makeField('preimage',
+		lambda x: x.tobytes(),
+		lambda x: numpy.frombuffer(x, dtype=numpy.uint8))
+	senderTimeout = makeField('senderTimeout', float, float)
+	receiverTimeout = makeField('receiverTimeout', float, float)
+	status = makeField('status', statuses.__getitem__, statusCodes.__getitem__)
+
+
+	def copy(self):
+		'''
+		:returns: a Transaction with the same contents
+		'''
+		return Transaction(
+			sender_userid = self.sender_userid,
+			receiver_userid = self.receiver_userid,
+			amountIncoming = self.amountIncoming,
+			amountOutgoing = self.amountOutgoing,
+			preimage = self.preimage,
+			senderTimeout = self.senderTimeout,
+			receiverTimeout = self.receiverTimeout,
+			status = self.status,
+			)
+
+
+	def __eq__(self, obj):
+		return all(
+			getattr(self, k) == getattr(obj, k, None)
+			for k in fieldNames
+			)
+
+
+	def __repr__(self):
+		return 'TransactionRow(%d, %s)' % (self.row, repr(self.copy()))
+
+
+
+class TransactionTable:
+	'''
+	Dict-like storage of payment hash -> transaction.
+
+	Every transaction field is stored in a typed array, with one row per
+	transaction; a dict maps payment hashes to rows. Items are returned as
+	TransactionRow views. Rows of removed transactions are re-used.
+
+	Time-out sweeps and locked funds queries are vectorized. BL4P still
+	keeps a time-ordered index of time-outs, so that it doesn't need to
+	sweep the table for every time-out event.
+	'''
+
+	def __init__(self, capacity=1024):
+		'''
+		:param capacity: initial number of rows; it grows when necessary
+		'''
+		self.index = {}     #payment hash -> row
+		self.freeRows = []
+		self.numRows = 0    #number of rows that have been used
+		self.capacity = 0
+
+		self.paymentHash     = numpy.zeros((0, 32), dtype=numpy.uint8)
+		self.preimage        = numpy.zeros((0, 32), dtype=numpy.uint8)
+		self.sender_userid   = numpy.zeros(0, dtype=numpy.int64)
+		self.receiver_userid = numpy.zeros(0, dtype=numpy.int64)
+		self.amountIncoming  = numpy.zeros(0, dtype=numpy.int64)
+		self.amountOutgoing  = numpy.zeros(0, dtype=numpy.int64)
+		self.senderTimeout   = numpy.zeros(0, dtype=numpy.float64)
+		self.receiverTimeout = numpy.zeros(0, dtype=numpy.float64)
+		self.status          = numpy.zeros(0, dtype=numpy.uint8)
+		self.generation      = numpy.zeros(0, dtype=numpy.uint32) #incremented when a row is freed
+		self.resize(capacity)
+
+
+	columns = ('paymentHash', 'preimage', 'sender_userid', 'receiver_userid',
+		'amountIncoming', 'amountOutgoing', 'senderTimeout', 'receiverTimeout', 'status',
+		'generation')
+
+
+	def resize(self, capacity):
+		for name in self.columns:
+			old = getattr(self, name)
+			new = numpy.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+			new[:self.numRows] = old[:self.numRows]
+			setattr(self, name, new)
+		self.status[self.numRows:] = FREE
+		self.capacity = capacity
+
+
+	def __len__(self):
+		return len(self.index)
+
+
+	def __eq__(self, obj):
+		'''
+		Equal to any mapping with the same payment hashes and transaction contents.
+		'''
+		try:
+			return len(obj) == len(self) and \
+				all(self[k] == obj[k] for k in obj.keys())
+		except (AttributeError, TypeError, KeyError):
+			return False
+
+
+	def __contains__(self, paymentHash):
+		return paymentHash in self.index
+
+
+	def __iter__(self):
+		return iter(self.index)
+
+
+	def keys(self):
+		return self.index.keys()
+
+
+	def values(self):
+		return [TransactionRow(self, row) for row in self.index.values()]
+
+
+	def items(self):
+		return [(paymentHash, TransactionRow(self, row)) for paymentHash, row in self.index.items()]
+
+
+	def __getitem__(self, paymentHash):
+		return TransactionRow(self, self.index[paymentHash])
+
+
+	def get(self, paymentHash, default=None):
+		row = self.index.get(paymentHash)
+		return default if row is None else TransactionRow(self, row)
+
+
+	def __setitem__(self, paymentHash, tx):
+		row = self.index.get(paymentHash)
+		if row is None:
+			if self.freeRows:
+				row = self.freeRows.pop()
+			else:
+				if self.numRows == self.capacity:
+					self.resize(2 * self.capacity)
+				row = self.numRows
+				self.numRows += 1
+			self.index[paymentHash] = row
+			self.paymentHash[row] = numpy.frombuffer(paymentHash, dtype=numpy.uint8)
+
+		view = TransactionRow(self, row)
+		view.sender_userid = tx.sender_userid
+		view.receiver_userid = tx.receiver_userid
+		view.amountIncoming = tx.amountIncoming
+		view.amountOutgoing = tx.amountOutgoing
+		view.preimage = tx.preimage
+		view.senderTimeout = tx.senderTimeout
+		view.receiverTimeout = tx.receiverTimeout
+		view.status = tx.status
+
+
+	def pop(self, paymentHash, *default):
+		'''
+		Remove a transaction.
+
+		:returns: a Transaction copy of the removed transaction
+		'''
+		try:
+			row = self.index.pop(paymentHash)
+		except KeyError:
+			if default:
+				return default[0]
+			raise
+
+		ret = TransactionRow(self, row).copy()
+		self.status[row] = FREE
+		self.generation[row] += 1 #invalidates existing views
+		self.freeRows.append(row)
+		return ret
+
+
+	def getTimeouts(self):
+		'''
+		:returns: array with the current time-out of every row (inf if there is none)
+		'''
+		n = self.numRows
+		status = self.status[:n]
+		ret = numpy.full(n, numpy.inf)
+		ret[status == WAITING_FOR_SENDER] = self.senderTimeout[:n][status == WAITING_FOR_SENDER]
+		ret[status == WAITING_FOR_RECEIVER] = self.receiverTimeout[:n][status == WAITING_FOR_RECEIVER]
+		return ret
+
+
+	def getExpired(self, t):
+		'''
+		:param t: the current time (seconds since UNIX epoch)
+
+		:returns: [(payment hash, status), ...] of expired transactions, in order of time-out
+		'''
+		timeouts = self.getTimeouts()
+		rows = numpy.flatnonzero(timeouts <= t)
+		rows = rows[numpy.argsort(timeouts[rows], kind='stable')]
+		return \
+		[
+		(self.paymentHash[row].tobytes(), statuses[self.status[row]])
+		for row in rows
+		]
+
+
+	def getNextTimeout(self):
+		'''
+		:returns: the earliest time-out, or None
+		'''
+		if self.numRows == 0:
+			return None
+		ret = self.getTimeouts().min()
+		return None if ret == numpy.inf else float(ret)
+
+
+	def getLockedFunds(self, sender_userid=None):
+		'''
+		:param sender_userid: only count transactions of this sender (default: all senders)
+
+		:returns: sum of the incoming amounts of transactions that are waiting for the receiver
+		'''
+		n = self.numRows
+		mask = self.status[:n] == WAITING_FOR_RECEIVER
+		if sender_userid is not None:
+			mask &= self.sender_userid[:n] == sender_userid
+		return int(self.amountIncoming[:n][mask].sum())
+
+
+
+#Relative error margin of products of two float64 roundings of integers.
+#The actual error is at most about 1e-15; anything within this margin
+#of a decision boundary is checked with exact integer arithmetic.
+RATE_MARGIN = 1e-12
+
+
+
+class OfferColumns:
+	'''
+	Columnar mirror of the offers in an offerbook_backend.PairBucket, with
+	the same row order as the bucket's entries.
+
+	Per row, it stores the limit rate numerator and denominator as floats,
+	and for every condition key in conditionKeys the range minimum and
+	maximum as int64 (the full range for offers without the condition,
+	which matches the same queries). Rows with condition values outside
+	int64, or with conditions that have no columns, are flagged as inexact.
+
+	All offers in a bucket have the same currencies and exchanges, so
+	findMatches only evaluates the conditions and limit rates.
+	'''
+
+	def __init__(self, conditionKeys, capacity=64):
+		'''
+		:param conditionKeys: the condition keys that may get columns
+		:param capacity: initial number of rows; it grows when necessary
+		'''
+		self.conditionKeys = conditionKeys
+		self.size = 0
+		self.capacity = capacity
+		self.numerator   = numpy.zeros(capacity, dtype=numpy.float64)
+		self.denominator = numpy.zeros(capacity, dtype=numpy.float64)
+		self.inexact     = numpy.zeros(capacity, dtype=bool)
+		self.conditionMin = {} #condition key -> int64 array
+		self.conditionMax = {} #condition key -> int64 array
+
+
+	def __len__(self):
+		return self.size
+
+
+	def getColumns(self):
+		return \
+			[self.numerator, self.denominator, self.inexact] + \
+			list(self.conditionMin.values()) + list(self.conditionMax.values())
+
+
+	def resize(self, capacity):
+		def resizeColumn(old, fill):
+			new = numpy.full(capacity, fill, dtype=old.dtype)
+			new[:self.size] = old[:self.size]
+			return new
+
+		self.numerator = resizeColumn(self.numerator, 0.0)
+		self.denominator = resizeColumn(self.denominator, 0.0)
+		self.inexact = resizeColumn(self.inexact, False)
+		for key in self.conditionMin.keys():
+			self.conditionMin[key] = resizeColumn(self.conditionMin[key], CONDITION_NO_MIN)
+			self.conditionMax[key] = resizeColumn(self.conditionMax[key], CONDITION_NO_MAX)
+		self.capacity = capacity
+
+
+	def insert(self, position, offer, numerator, denominator):
+		'''
+		Insert a row, shifting the rows at and after position.
+
+		:param position: row number of the new row
+		:param offer: the offer
+		:param numerator: exact limit rate numerator of the offer
+		:param denominator: exact limit rate denominator of the offer
+		'''
+		if self.size == self.capacity:
+			self.resize(2 * self.capacity)
+
+		inexact = False
+		for key in offer.conditions.keys():
+			if key not in self.conditionKeys:
+				inexact = True #Left to query.matches
+			elif key not in self.conditionMin:
+				#Existing offers don't have this condition:
+				self.conditionMin[key] = numpy.full(self.capacity, CONDITION_NO_MIN, dtype=numpy.int64)
+				self.conditionMax[key] = numpy.full(self.capacity, CONDITION_NO_MAX, dtype=numpy.int64)
+
+		n = self.size
+		for column in self.getColumns():
+			column[position+1:n+1] = column[position:n]
+		self.size += 1
+
+		self.numerator[position] = float(numerator)
+		self.denominator[position] = float(denominator)
+		for key in self.conditionMin.keys():
+			minimum, maximum = offer.getConditionMin(key), offer.getConditionMax(key)
+			if minimum < CONDITION_NO_MIN or maximum > CONDITION_NO_MAX:
+				inexact = True
+				minimum, maximum = CONDITION_NO_MIN, CONDITION_NO_MAX
+			self.conditionMin[key][position] = minimum
+			self.conditionMax[key][position] = maximum
+		self.inexact[position] = inexact
+
+
+	def delete(self, position):
+		'''
+		Delete a row, shifting the rows after position.
+		'''
+		n = self.size
+		for column in self.getColumns():
+			column[position:n-1] = column[position+1:n]
+		self.size -= 1
+
+
+	def findMatches(self, query, queryNumerator, queryDenominator):
+		'''
+		:param query: the query offer
+		:param queryNumerator: exact limit rate numerator of the query
+		:param queryDenominator: exact limit rate denominator of the query
+
+		:returns: tuple (rows, sure): array of the row numbers, in order,
+		          of offers that may match query, and a boolean array that
+		          tells, for each of these, whether it certainly matches.
+		          The others must be checked with query.matches.
+		'''
+		n = self.size
+		possible = numpy.ones(n, dtype=bool)
+		inexact = self.inexact[:n].copy()
+
+		for key, (low, high) in query.conditions.items():
+			if key not in self.conditionMin:
+				#None of the offers has this condition, or it has no columns
+				#(then offers that have it are inexact):
+				continue
+			if low < CONDITION_NO_MIN or high > CONDITION_NO_MAX or \
+				low > CONDITION_NO_MAX or high < CONDITION_NO_MIN:
+				#Not comparable in int64; condition ranges are left to query.matches:
+				inexact[:] = True
+				continue
+			possible &= self.conditionMin[key][:n] <= high
+			possible &= self.conditionMax[key][:n] >= low
+
+		#Matching limit rates: query numerator * numerator >= query denominator * denominator.
+		#Rows far enough from equality are certain; others are confirmed exactly.
+		#Without overflow (amounts are uint64), a product of two rounded
+		#integers is off by at most a few units in the last place, so
+		#the margin never rejects actual matches.
+		lhs = float(queryNumerator) * self.numerator[:n]
+		rhs = float(queryDenominator) * self.denominator[:n]
+		possible[inexact] = True
+		possible &= lhs >= rhs * (1.0 - RATE_MARGIN)
+		sure = lhs >= rhs * (1.0 + RATE_MARGIN)
+		sure &= ~inexact
+
+		rows = numpy.flatnonzero(possible)
+		return rows, sure[rows]
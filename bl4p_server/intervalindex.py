@@ -0,0 +1,222 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+'''
+Index of closed intervals, for finding the intervals that overlap a
+given interval.
+'''
+
+import bisect
+import random
+
+
+
+class Node:
+	__slots__ = ('key', 'high', 'ID', 'priority', 'left', 'right', 'maxHigh')
+
+	def __init__(self, key, high, ID):
+		self.key = key #(low, sequence number)
+		self.high = high
+		self.ID = ID
+		self.priority = random.random()
+		self.left = None
+		self.right = None
+		self.maxHigh = high #highest high in this sub-tree
+
+
+def update(node):
+	maxHigh = node.high
+	if node.left is not None and node.left.maxHigh > maxHigh:
+		maxHigh = node.left.maxHigh
+	if node.right is not None and node.right.maxHigh > maxHigh:
+		maxHigh = node.right.maxHigh
+	node.maxHigh = maxHigh
+
+
+def replaceChild(parent, old, new):
+	if parent.left is old:
+		parent.left = new
+	else:
+		parent.right = new
+
+
+
+class IntervalIndex:
+	'''
+	Set of closed intervals [low, high], each identified by an ID.
+
+	This is a treap (randomized binary search tree) ordered by low end,
+	in which every node also keeps the highest high end in its sub-tree.
+	A search skips sub-trees that end before the search interval, and
+	stops at the first node that starts after it; the intervals in there
+	are not visited.
+
+	Sorted lists of all low and all high ends give the number of
+	overlapping intervals without a search.
+
+	Adding and removing take O(log n) expected time, plus the
+	insertion into or deletion from the sorted lists.
+	All intervals must have low <= high.
+	'''
+
+	def __init__(self):
+		self.root = None
+		self.keys = {} #ID -> (key, high)
+		self.nextSequence = 0
+		self.lows = []  #sorted
+		self.highs = [] #sorted
+
+
+	def __len__(self):
+		return len(self.keys)
+
+
+	def add(self, ID, low, high):
+		'''
+		:param ID: hashable object that identifies the interval; must be new
+		:param low: low end of the interval
+		:param high: high end of the interval
+		'''
+		key = low, self.nextSequence
+		self.nextSequence += 1
+		self.keys[ID] = key, high
+		bisect.insort(self.lows, low)
+		bisect.insort(self.highs, high)
+		new = Node(key, high, ID)
+
+		#Insert as a leaf:
+		path = []
+		node = self.root
+		while node is not None:
+			path.append(node)
+			if node.maxHigh < high:
+				node.maxHigh = high
+			node = node.left if key < node.key else node.right
+
+		if not path:
+			self.root = new
+			return
+		if key < path[-1].key:
+			path[-1].left = new
+		else:
+			path[-1].right = new
+
+		#Rotate up to restore the heap order of priorities:
+		while path and path[-1].priority < new.priority:
+			parent = path.pop()
+			if parent.left is new:
+				parent.left = new.right
+				new.right = parent
+			else:
+				parent.right = new.left
+				new.left = parent
+			update(parent)
+			update(new)
+
+			if path:
+				replaceChild(path[-1], parent, new)
+			else:
+				self.root = new
+
+
+	def remove(self, ID):
+		'''
+		:param ID: the ID of the interval
+		:raises KeyError: there is no interval with this ID
+		'''
+		key, high = self.keys.pop(ID)
+		del self.lows[bisect.bisect_left(self.lows, key[0])]
+		del self.highs[bisect.bisect_left(self.highs, high)]
+
+		path = []
+		node = self.root
+		while node.key != key:
+			path.append(node)
+			node = node.left if key < node.key else node.right
+		depth = len(path)
+
+		#Rotate down until it has at most one child:
+		while node.left is not None and node.right is not None:
+			if node.left.priority > node.right.priority:
+				child = node.left
+				node.left = child.right
+				child.right = node
+			else:
+				child = node.right
+				node.right = child.left
+				child.left = node
+
+			if path:
+				replaceChild(path[-1], node, child)
+			else:
+				self.root = child
+			path.append(child)
+
+		child = node.left if node.left is not None else node.right
+		if path:
+			replaceChild(path[-1], node, child)
+		else:
+			self.root = child
+
+		#Nodes below depth were rotated; above it, nothing changes once
+		#a node's maximum is unchanged:
+		for i in range(len(path) - 1, -1, -1):
+			node = path[i]
+			oldMaxHigh = node.maxHigh
+			update(node)
+			if i < depth and node.maxHigh == oldMaxHigh:
+				break
+
+
+	def countOverlapping(self, low, high):
+		'''
+		:param low: low end of the search interval
+		:param high: high end of the search interval; must be >= low
+
+		:returns: the number of intervals that overlap [low, high]
+		'''
+		#Intervals that start at or before high, except those that end
+		#before low (which also start before high):
+		return bisect.bisect_right(self.lows, high) - bisect.bisect_left(self.highs, low)
+
+
+	def findOverlapping(self, low, high):
+		'''
+		:param low: low end of the search interval
+		:param high: high end of the search interval
+
+		:returns: list of IDs of the intervals that overlap [low, high],
+		          in order of low end
+		'''
+		ret = []
+		stack = []
+		node = self.root
+		while True:
+			while node is not None and node.maxHigh >= low:
+				stack.append(node)
+				node = node.left
+			if not stack:
+				break
+
+			node = stack.pop()
+			if node.key[0] > high:
+				break #This and all further nodes start after high
+			if node.high >= low:
+				ret.append(node.ID)
+			node = node.right
+
+		return ret
+
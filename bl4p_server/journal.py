@@ -0,0 +1,325 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import os
+import struct
+import zlib
+
+
+
+#Record types:
+START            = 0
+SELFREPORT       = 1
+SENDERACK        = 2
+CLAIM            = 3
+CANCEL           = 4
+SENDER_TIMEOUT   = 5
+RECEIVER_TIMEOUT = 6
+ARCHIVE          = 7
+
+#Record header: payload length, CRC32 of payload
+header = struct.Struct('<II')
+
+#Payloads:
+#type, payment hash
+hashRecord = struct.Struct('<B32s')
+#type, payment hash, preimage, receiver user ID,
+#amount incoming, amount outgoing, sender time-out, receiver time-out
+startRecord = struct.Struct('<B32s32sqqqdd')
+#type, payment hash, sender user ID
+senderAckRecord = struct.Struct('<B32sq')
+
+
+
+def encodeStart(paymentHash, preimage, receiver_userid,
+	amountIncoming, amountOutgoing, senderTimeout, receiverTimeout):
+
+	return startRecord.pack(START,
+		paymentHash, preimage, receiver_userid,
+		amountIncoming, amountOutgoing,
+		senderTimeout, receiverTimeout
+		)
+
+
+def encodeSenderAck(paymentHash, sender_userid):
+	return senderAckRecord.pack(SENDERACK, paymentHash, sender_userid)
+
+
+def encode(recordType, paymentHash):
+	return hashRecord.pack(recordType, paymentHash)
+
+
+def decode(payload):
+	'''
+	:returns: tuple (record type, payment hash, ...), with the additional
+	          fields of the record type.
+	'''
+	recordType = payload[0]
+	if recordType == START:
+		return startRecord.unpack(payload)
+	if recordType == SENDERACK:
+		return senderAckRecord.unpack(payload)
+	return hashRecord.unpack(payload)
+
+
+
+class Journal:
+	'''
+	Append-only write-ahead journal with group commit.
+
+	Appended records are buffered. Once per event loop iteration, all
+	buffered records are written and synced in a single write+fdatasync,
+	in a worker thread. Records appended during a sync are part of the
+	next group.
+
+	A failed write is final: afterwards, append and waitDurable raise
+	WriteFailure.
+
+	The journal consists of generations, stored in the files
+	<filename>.<generation>. Records are appended to the latest
+	generation; rotate starts a new one. Old generations can be removed
+	once they are covered by a snapshot.
+	'''
+
+	class WriteFailure(Exception):
+		pass
+
+
+	def __init__(self, filename, loop=None):
+		'''
+		:param filename: the journal file name
+		:param loop: the asyncio event loop; without loop, records are only written on sync()
+		'''
+		self.filename = filename
+		self.loop = loop
+
+		generations = self.getGenerations()
+		self.generation = generations[-1] if generations else 0
+		self.fd = self.openGeneration(self.generation)
+
+		self.pending = []        #payloads that are not yet written
+		self.retired = []        #(fd, data) of rotated generations that still need to be written
+		self.numAppended = 0     #records appended since opening
+		self.numDurable = 0      #records durable since opening
+		self.waiters = []        #(record count, future)
+		self.flushing = False
+		self.failed = None       #exception of a failed write, if any
+
+
+	def close(self):
+		self.sync()
+		os.close(self.fd)
+
+
+	def getGenerationFilename(self, generation):
+		return '%s.%d' % (self.filename, generation)
+
+
+	def getGenerations(self):
+		'''
+		:returns: sorted list of the generations that exist on disk
+		'''
+		directory, prefix = os.path.split(self.filename)
+		prefix += '.'
+		ret = []
+		for name in os.listdir(directory or '.'):
+			suffix = name[len(prefix):]
+			if name.startswith(prefix) and suffix.isdigit():
+				ret.append(int(suffix))
+		return sorted(ret)
+
+
+	def openGeneration(self, generation):
+		return os.open(self.getGenerationFilename(generation),
+			os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+
+
+	def rotate(self):
+		'''
+		Start a new generation.
+		Records appended before this call stay in the old generation.
+
+		:returns: the new generation
+		'''
+		data = b''.join(self.pending)
+		self.pending = []
+		self.retired.append((self.fd, data))
+
+		self.generation += 1
+		self.fd = self.openGeneration(self.generation)
+
+		if self.loop is not None and not self.flushing:
+			self.flushing = True
+			self.loop.call_soon(self.startFlush)
+
+		return self.generation
+
+
+	def removeGenerationsBefore(self, generation):
+		'''
+		Remove old generations from disk.
+		The caller must make sure they are durable and no longer needed.
+
+		:param generation: the first generation to keep
+		'''
+		for g in self.getGenerations():
+			if g < generation:
+				os.remove(self.getGenerationFilename(g))
+
+
+	def readRecords(self, startGeneration=0):
+		'''
+		Iterate over the payloads of all records in the journal,
+		starting at the given generation.
+		An incomplete or corrupted tail (e.g. after a crash) is removed.
+
+		:param startGeneration: the first generation to read
+		'''
+		for generation in self.getGenerations():
+			if generation >= startGeneration:
+				yield from self.readGeneration(generation)
+
+
+	def readGeneration(self, generation):
+		filename = self.getGenerationFilename(generation)
+		offset = 0
+		with open(filename, 'r+b') as f:
+			while True:
+				data = f.read(header.size)
+				if len(data) < header.size:
+					break
+				length, crc = header.unpack(data)
+				payload = f.read(length)
+				if len(payload) < length or zlib.crc32(payload) != crc:
+					break
+				offset += header.size + length
+				yield payload
+
+			if offset != os.fstat(f.fileno()).st_size:
+				logging.warning('Journal: removing damaged tail of %s at offset %d' % \
+					(filename, offset))
+				os.ftruncate(f.fileno(), offset)
+
+
+	def append(self, payload):
+		'''
+		Append a record.
+		It is written with the next group commit.
+
+		:raises WriteFailure: an earlier write has failed; the journal no longer accepts records
+		'''
+		if self.failed is not None:
+			raise Journal.WriteFailure()
+
+		self.pending.append(header.pack(len(payload), zlib.crc32(payload)) + payload)
+		self.numAppended += 1
+
+		if self.loop is not None and not self.flushing:
+			#At the end of this loop iteration:
+			self.flushing = True
+			self.loop.call_soon(self.startFlush)
+
+
+	def sync(self):
+		'''
+		Synchronously write and sync all appended records.
+		'''
+		retired = self.retired
+		data = b''.join(self.pending)
+		self.retired = []
+		self.pending = []
+		self.writeGroup(retired, self.fd, data)
+		self.numDurable = self.numAppended
+
+
+	def writeGroup(self, retired, fd, data):
+		#Older generations first, so a later generation never has
+		#records that are durable while earlier ones are not:
+		for oldFD, oldData in retired:
+			self.writeAndSync(oldFD, oldData)
+			os.close(oldFD)
+		self.writeAndSync(fd, data)
+
+
+	def writeAndSync(self, fd, data):
+		if not data:
+			return
+		while data:
+			written = os.write(fd, data)
+			data = data[written:]
+		os.fdatasync(fd)
+
+
+	def startFlush(self):
+		retired = self.retired
+		data = b''.join(self.pending)
+		self.retired = []
+		self.pending = []
+		target = self.numAppended
+
+		future = self.loop.run_in_executor(None, self.writeGroup, retired, self.fd, data)
+		future.add_done_callback(lambda f: self.finishFlush(target, f))
+
+
+	def finishFlush(self, target, future):
+		try:
+			future.result()
+		except Exception as e:
+			logging.error('Journal: write failed: ' + str(e))
+			self.failed = e
+		else:
+			self.numDurable = target
+
+		#Wake up whoever is waiting for this group:
+		remaining = []
+		for count, waiter in self.waiters:
+			if waiter.done():
+				continue
+			if self.failed is not None:
+				waiter.set_exception(Journal.WriteFailure())
+			elif count <= self.numDurable:
+				waiter.set_result(True)
+			else:
+				remaining.append((count, waiter))
+		self.waiters = remaining
+
+		if (self.pending or self.retired) and self.failed is None:
+			#Next group
+			self.startFlush()
+		else:
+			self.flushing = False
+
+
+	@asyncio.coroutine
+	def waitDurable(self):
+		'''
+		Wait until all records appended so far are durable.
+
+		:raises WriteFailure: the journal could not be written
+		'''
+		if self.failed is not None:
+			raise Journal.WriteFailure()
+
+		target = self.numAppended
+		if self.numDurable >= target:
+			return
+
+		waiter = self.loop.create_future()
+		self.waiters.append((target, waiter))
+		yield from waiter
@@ -15,7 +15,213 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import copy
+from fractions import Fraction
+
+from .api.offer import CONDITION_NO_MIN, CONDITION_NO_MAX, Condition
+from .intervalindex import IntervalIndex
+
+
+
+#Condition keys that searches are indexed on.
+#Clients can send any key; other keys are only checked by Offer.matches,
+#so they can't make every offer in a pair pay for an extra index.
+indexedConditions = (Condition.CLTV_EXPIRY_DELTA, Condition.SENDER_TIMEOUT, Condition.LOCKED_TIMEOUT)
+
+
+
+def getPairKey(offer):
+	'''
+	:returns: (bid currency, bid exchange, ask currency, ask exchange) of the offer
+	'''
+	return (offer.bid.currency, offer.bid.exchange, offer.ask.currency, offer.ask.exchange)
+
+
+def getCounterPairKey(offer):
+	'''
+	:returns: the pair key of offers that can match with the offer
+	'''
+	return (offer.ask.currency, offer.ask.exchange, offer.bid.currency, offer.bid.exchange)
+
+
+
+def getLimitRate(offer):
+	'''
+	:returns: tuple (numerator, denominator) of the offer's limit rate,
+	          in bid amount per ask amount
+	'''
+	return \
+	(
+	offer.bid.max_amount * offer.ask.max_amount_divisor,
+	offer.ask.max_amount * offer.bid.max_amount_divisor,
+	)
+
+
+
+class PairBucket:
+	'''
+	The offers in one currency pair, sorted by limit rate: highest bid
+	amount per ask amount first, and equal rates in order of addition.
+
+	A query and an offer have compatible limit rates if
+	    query numerator * offer numerator >= query denominator * offer denominator
+	(see Offer.verifyMatches). For a given query, the offers that pass
+	this test form a prefix of the sorted offers, including when numerators
+	or denominators are zero, so a search can stop at the first offer that
+	fails it.
+
+	For every condition key in indexedConditions, an interval index holds
+	the condition ranges of all offers; offers without the condition have
+	the full range, as Offer.getConditionMin/Max. A search with conditions first collects
+	the offers whose ranges overlap for the most selective condition, so
+	offers with non-overlapping ranges are skipped without visiting them.
+
+	Optionally, a columnar.OfferColumns mirror of the entries is used
+	to evaluate searches that no condition is selective enough for.
+	'''
+
+	def __init__(self, columnar=False):
+		'''
+		:param columnar: keep a columnar.OfferColumns mirror of the offers
+		'''
+		self.keys = []    #sort keys, in order
+		self.entries = [] #(offer, numerator, denominator), in the same order
+		self.index = {}   #ID -> (sort key, entry)
+		self.nextSequence = 0
+		self.conditionIndices = {} #condition key -> IntervalIndex
+
+		if columnar:
+			from . import columnar as columnarStorage
+			self.columns = columnarStorage.OfferColumns(indexedConditions)
+		else:
+			self.columns = None
+
+
+	def __len__(self):
+		return len(self.keys)
+
+
+	def add(self, ID, offer):
+		'''
+		:param ID: hashable object that identifies the offer
+		:param offer: the offer
+		'''
+		numerator, denominator = getLimitRate(offer)
+
+		#A zero denominator is an infinitely high rate.
+		#Comparing Fractions is slow, so they are preceded by a float:
+		#rounding is monotonic, so only equal floats need the exact rate.
+		sequence = self.nextSequence
+		self.nextSequence += 1
+		if denominator == 0:
+			key = (0, 0.0, 0, sequence)
+		else:
+			key = (1, -(numerator / denominator), -Fraction(numerator, denominator), sequence)
+
+		entry = offer, numerator, denominator
+		position = bisect.bisect_left(self.keys, key)
+		self.keys.insert(position, key)
+		self.entries.insert(position, entry)
+		self.index[ID] = key, entry
+		if self.columns is not None:
+			self.columns.insert(position, offer, numerator, denominator)
+
+		for conditionKey in offer.conditions.keys():
+			if conditionKey in indexedConditions and conditionKey not in self.conditionIndices:
+				#Existing offers don't have this condition:
+				conditionIndex = IntervalIndex()
+				for otherID in self.index.keys():
+					if otherID != ID:
+						conditionIndex.add(otherID, CONDITION_NO_MIN, CONDITION_NO_MAX)
+				self.conditionIndices[conditionKey] = conditionIndex
+
+		for conditionKey, conditionIndex in self.conditionIndices.items():
+			conditionIndex.add(ID, offer.getConditionMin(conditionKey), offer.getConditionMax(conditionKey))
+
+
+	def remove(self, ID):
+		'''
+		:param ID: hashable object that identifies the offer
+		:raises KeyError: there is no offer with this ID
+		'''
+		key, entry = self.index.pop(ID)
+		position = bisect.bisect_left(self.keys, key)
+		del self.keys[position]
+		del self.entries[position]
+		if self.columns is not None:
+			self.columns.delete(position)
+
+		for conditionIndex in self.conditionIndices.values():
+			conditionIndex.remove(ID)
+
+
+	def findOffers(self, query):
+		'''
+		:returns: the offers that match query, best limit rate first
+		'''
+		queryNumerator, queryDenominator = getLimitRate(query)
+
+		candidates = self.findCandidates(query)
+		if candidates is None:
+			if self.columns is not None:
+				return self.findOffersColumnar(query, queryNumerator, queryDenominator)
+			entries = self.entries
+		else:
+			entries = [entry for key, entry in sorted(self.index[ID] for ID in candidates)]
+
+		ret = []
+		for offer, numerator, denominator in entries:
+			if queryNumerator * numerator < queryDenominator * denominator:
+				break #Further offers have even lower rates
+			if query.matches(offer):
+				ret.append(offer)
+		return ret
+
+
+	def findOffersColumnar(self, query, queryNumerator, queryDenominator):
+		'''
+		findOffers, evaluated on the columnar mirror.
+		This gives the same results as Offer.matches.
+		'''
+		entries = self.entries
+		rows, sure = self.columns.findMatches(query, queryNumerator, queryDenominator)
+		return \
+		[
+		entries[row][0]
+		for row, isSure in zip(rows.tolist(), sure.tolist())
+		if isSure or query.matches(entries[row][0])
+		]
+
+
+	def findCandidates(self, query):
+		'''
+		:returns: IDs of the offers whose condition ranges overlap with those
+		          of query for its most selective condition, or None if no
+		          condition is selective enough to be worth it
+		'''
+		bestIndex = None
+		bestCount = len(self) // 4 #Beyond this, scanning all offers is cheaper
+
+		for conditionKey, (low, high) in query.conditions.items():
+			try:
+				conditionIndex = self.conditionIndices[conditionKey]
+			except KeyError:
+				continue #Not indexed, or none of the offers has this condition
+
+			#Offers without the condition match any range that overlaps
+			#with the full range, which they have in the index.
+			#Empty ranges are left to Offer.matches.
+			if low > CONDITION_NO_MAX or high < CONDITION_NO_MIN or low > high:
+				continue
+
+			count = conditionIndex.countOverlapping(low, high)
+			if count < bestCount:
+				bestIndex, bestRange, bestCount = conditionIndex, (low, high), count
+
+		if bestIndex is None:
+			return None
+		return bestIndex.findOverlapping(*bestRange)
 
 
 
@@ -26,10 +232,14 @@ class UserData:
 
 
 	def addOffer(self, offer):
+		'''
+		:returns: tuple (offer ID, stored copy of the offer)
+		'''
 		ret = self.nextOfferID
-		self.offers[ret] = copy.deepcopy(offer)
+		stored = copy.deepcopy(offer)
+		self.offers[ret] = stored
 		self.nextOfferID += 1
-		return ret
+		return ret, stored
 
 
 	def listOffers(self):
@@ -37,11 +247,10 @@ class UserData:
 
 
 	def removeOffer(self, offerID):
-		del self.offers[offerID]
-
-
-	def findOffers(self, query):
-		return filter(query.matches, self.offers.values())
+		'''
+		:returns: the removed offer
+		'''
+		return self.offers.pop(offerID)
 
 
 
@@ -60,8 +269,15 @@ class OfferBook:
 		pass
 
 
-	def __init__(self):
+	def __init__(self, columnar=False):
+		'''
+		:param columnar: evaluate searches on columnar offer storage (requires NumPy)
+		'''
 		self.data = {}
+		self.columnar = columnar
+
+		#Pair key -> PairBucket, with offers identified by (user ID, offer ID):
+		self.pairIndex = {}
 
 
 	def addOffer(self, userID, offer):
@@ -72,7 +288,15 @@ class OfferBook:
 			if maximum < minimum:
 				raise OfferBook.InvalidOffer()
 
-		return self.getUserData(userID).addOffer(offer)
+		offerID, stored = self.getUserData(userID).addOffer(offer)
+		pairKey = getPairKey(stored)
+		try:
+			bucket = self.pairIndex[pairKey]
+		except KeyError:
+			bucket = PairBucket(columnar=self.columnar)
+			self.pairIndex[pairKey] = bucket
+		bucket.add((userID, offerID), stored)
+		return offerID
 
 
 	def listOffers(self, userID):
@@ -81,18 +305,24 @@ class OfferBook:
 
 	def removeOffer(self, userID, offerID):
 		try:
-			return self.getUserData(userID).removeOffer(offerID)
+			offer = self.getUserData(userID).removeOffer(offerID)
 		except KeyError:
 			raise OfferBook.OfferNotFound()
 
+		pairKey = getPairKey(offer)
+		bucket = self.pairIndex[pairKey]
+		bucket.remove((userID, offerID))
+		if not bucket:
+			del self.pairIndex[pairKey]
+
 
 	def findOffers(self, query):
-		return \
-		[
-		offer
-		for userData in self.data.values()
-		for offer in userData.findOffers(query)
-		]
+		#Only offers in the counter-pair can match:
+		try:
+			bucket = self.pairIndex[getCounterPairKey(query)]
+		except KeyError:
+			return []
+		return bucket.findOffers(query)
 
 
 	def getUserData(self, userID):
@@ -17,6 +17,7 @@
 
 from .api import bl4p_pb2
 from .api.offer import Offer
+from .rpcserver import Priority
 
 
 
@@ -96,13 +97,14 @@ def makeClosure(function, firstArg):
 def registerRPC(server, offerBook):
 	functionData = \
 	{
-	bl4p_pb2.BL4P_AddOffer    : addOffer,
-	bl4p_pb2.BL4P_ListOffers  : listOffers,
-	bl4p_pb2.BL4P_RemoveOffer : removeOffer,
-	bl4p_pb2.BL4P_FindOffers  : findOffers,
+	bl4p_pb2.BL4P_AddOffer    : (addOffer   , Priority.normal),
+	bl4p_pb2.BL4P_ListOffers  : (listOffers , Priority.low   ),
+	bl4p_pb2.BL4P_RemoveOffer : (removeOffer, Priority.normal),
+	bl4p_pb2.BL4P_FindOffers  : (findOffers , Priority.low   ),
 	}
 
-	for requestType, function in functionData.items():
+	#Offer book queries can wait for payment-path requests:
+	for requestType, (function, priority) in functionData.items():
 		server.registerRPCFunction(requestType,
-			makeClosure(function, offerBook))
+			makeClosure(function, offerBook), priority=priority)
 
@@ -0,0 +1,118 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+'''
+Token bucket rate limiting.
+'''
+
+import collections
+import time
+
+from .api.serialization import type2id
+
+
+
+class RateLimiter:
+	'''
+	Token bucket rate limits per client and message type.
+
+	Every (client, message type) pair has its own bucket, which holds up to
+	burst tokens and is refilled with rate tokens per second. Each message
+	takes one token; a message that finds its bucket empty is rejected.
+	Message types without a limit are always allowed.
+
+	Buckets that have refilled completely are equivalent to new ones, so
+	they are removed; only clients that were recently active take memory.
+	'''
+
+	def __init__(self):
+		self.limits = {} #message type ID -> (rate, burst)
+
+		#(client, message type ID) -> (tokens, time of last update),
+		#least recently updated first:
+		self.buckets = collections.OrderedDict()
+
+		self.numRejected = 0
+
+
+	def setLimit(self, messageType, rate, burst):
+		'''
+		:param messageType: the message type
+		:param rate: number of allowed messages per second, in the long run
+		:param burst: number of messages that may be sent at once
+
+		:raises KeyError: messageType is not a message type
+		:raises ValueError: rate or burst is not positive
+		'''
+		if rate <= 0 or burst < 1:
+			raise ValueError('Rate limit must be positive')
+		self.limits[type2id[messageType]] = float(rate), float(burst)
+
+
+	def allow(self, client, typeID, t=None):
+		'''
+		Takes a token for a message, if one is available.
+
+		:param client: hashable object that identifies the client
+		:param typeID: the message type ID (as in the serialized message)
+		:param t: the current time (default: now)
+
+		:returns: whether the message is allowed
+		'''
+		try:
+			rate, burst = self.limits[typeID]
+		except KeyError:
+			return True
+
+		if t is None:
+			t = time.monotonic()
+		self.removeIdle(t)
+
+		key = client, typeID
+		try:
+			tokens, lastUpdate = self.buckets[key]
+			tokens = min(burst, tokens + (t - lastUpdate) * rate)
+		except KeyError:
+			tokens = burst
+
+		allowed = tokens >= 1.0
+		if allowed:
+			tokens -= 1.0
+		else:
+			self.numRejected += 1
+
+		self.buckets[key] = tokens, t
+		self.buckets.move_to_end(key)
+		return allowed
+
+
+	def removeIdle(self, t):
+		'''
+		Removes buckets that have refilled completely.
+		Only the least recently updated buckets are checked.
+
+		:param t: the current time
+		'''
+		buckets = self.buckets
+		while buckets:
+			(client, typeID), (tokens, lastUpdate) = next(iter(buckets.items()))
+			limit = self.limits.get(typeID)
+			if limit is not None:
+				rate, burst = limit
+				if tokens + (t - lastUpdate) * rate < burst:
+					break
+			buckets.popitem(last=False)
+
@@ -16,41 +16,276 @@
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
+import heapq
 import logging
+import time
 import traceback
 
 import websockets
+from google.protobuf.message import DecodeError
 
-from .api.serialization import serialize, deserialize
+from .api.serialization import serialize, deserialize, getTypeID, getRequestID, id2type
 from .api import bl4p_pb2
+from .utils import Enum
+
+
+
+Priority = Enum(['high', 'normal', 'low'])
+priorityOrder = (Priority.high, Priority.normal, Priority.low)
+
+notSet = object() #Distinguishes missing dictionary entries from None values
+
+
+
+def copyResult(source, destination):
+	'''
+	Copies the result or exception of a finished future to another future.
+	'''
+	if destination.done():
+		return
+	if source.cancelled():
+		destination.cancel()
+	elif source.exception() is not None:
+		destination.set_exception(source.exception())
+	else:
+		destination.set_result(source.result())
+
+
+
+class LatencyStatistics:
+	'''
+	Count, mean and maximum of a series of latencies.
+	'''
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.maximum = 0.0
+
+
+	def add(self, latency):
+		self.count += 1
+		self.total += latency
+		self.maximum = max(self.maximum, latency)
+
+
+	def get(self):
+		'''
+		:returns: dictionary with the count, mean and maximum (in seconds)
+		'''
+		return \
+		{
+		'count': self.count,
+		'mean': self.total / self.count if self.count else 0.0,
+		'max': self.maximum,
+		}
 
 
 
 class RPCServer:
-	def __init__(self, host, port):
+	def __init__(self, host, port, maxInFlight=16, maxQueueSize=1000):
+		'''
+		:param maxInFlight: maximum number of requests per connection that
+		                    are handled concurrently (default: 16).
+		                    With 1, requests are handled strictly in order.
+		:param maxQueueSize: maximum number of requests, over all connections,
+		                     that wait to be dispatched (default: 1000).
+		                     Requests beyond that are answered with
+		                     Err_RequestQueueFull.
+		'''
 		self.host = host
 		self.port = port
+		self.maxInFlight = maxInFlight
+		self.maxQueueSize = maxQueueSize
 		self.RPCFunctions = {}
+		self.orderingKeyFunctions = {}
+		self.priorities = {} #message type -> priority class
 		self.timeoutFunctions = []
+		self.responseBarriers = []
+		self.rateLimiter = None
+		self.requestTimeouts = {} #message type (None: default) -> time-out in seconds
+		self.maxMessageSizes = {None: 65536} #message type (None: default) -> size in bytes
 
 		self.loop = asyncio.SelectorEventLoop()
 
 		self.activeTimer = None
 
-
-	def registerRPCFunction(self, messageType, function):
+		#Deadline scheduler:
+		self.deadlines = {}      #key -> (deadline, sequence number, function)
+		self.deadlineQueue = []  #heap of (deadline, sequence number, key)
+		self.nextDeadlineSequence = 0
+		self.deadlineTimer = None
+		self.deadlineTimerTime = None
+
+		#Request queue:
+		#Per priority class: deque of (function, userID, request, received time, deadline, future)
+		self.requestQueues = {p: collections.deque() for p in priorityOrder}
+		self.queueScheduled = False
+		self.numQueued = 0   #accepted requests that have not been dispatched yet
+		self.maxQueued = 0   #highest value of numQueued
+		self.numShed = 0     #requests answered with Err_RequestQueueFull
+		self.numTimedOut = 0 #requests answered with Err_RequestTimeout
+
+		#Per priority class: time from receiving requests to dispatching them
+		#and to having the response ready:
+		self.queueTimes = {p: LatencyStatistics() for p in priorityOrder}
+		self.responseTimes = {p: LatencyStatistics() for p in priorityOrder}
+
+
+	def registerRPCFunction(self, messageType, function, orderingKey=None, priority=Priority.normal):
 		'''
 		Registers an RPC function.
 
+		Requests on a connection are pipelined: responses are sent as
+		they complete, possibly out of order. Requests on the same
+		connection with the same ordering key are handled and answered
+		in the order in which they were received.
+
 		:param messageType: the input message type.
 		:param function: the function. May raise Exception.
+		                 If it returns a coroutine, its result is awaited;
+		                 other messages are handled in the meantime.
+		:param orderingKey: function that takes the request and returns a
+		                    hashable ordering key, or None if the request
+		                    has no ordering requirements.
+		                    May raise Exception; this is treated as None.
+		                    Default: no ordering requirements.
+		:param priority: priority class (see Priority). Queued requests of
+		                 a higher priority class are always dispatched first.
 		'''
 		self.RPCFunctions[messageType] = function
+		self.priorities[messageType] = priority
+		if orderingKey is None:
+			self.orderingKeyFunctions.pop(messageType, None)
+		else:
+			self.orderingKeyFunctions[messageType] = orderingKey
+
+
+	def registerResponseBarrier(self, function):
+		'''
+		Registers a response barrier.
+
+		Before a response is sent, every registered response barrier is
+		awaited. This can be used to hold back responses until the state
+		changes they report on are durable.
+
+		:param function: coroutine function without arguments. May raise Exception.
+		'''
+		self.responseBarriers.append(function)
+
+
+	def setRateLimiter(self, rateLimiter):
+		'''
+		Sets the rate limiter (see the ratelimit module).
+		Messages are checked before they are parsed; authenticated users
+		are limited per user ID, anonymous clients per connection.
+		Rejected messages are answered with Err_RateLimitExceeded.
+
+		:param rateLimiter: the rate limiter, or None for no rate limits.
+		'''
+		self.rateLimiter = rateLimiter
+
+
+	def setRequestTimeout(self, messageType, timeout):
+		'''
+		Sets the maximum time between receiving a request and dispatching it.
+		Requests that are still waiting after that time are answered with
+		Err_RequestTimeout, without calling their RPC function: by then,
+		the client has most likely given up on them.
+
+		:param messageType: the message type, or None to set the default
+		                    for message types without their own time-out.
+		:param timeout: the time-out in seconds, or None for no time-out
+		                (for a message type, also if there is a default).
+		'''
+		self.requestTimeouts[messageType] = timeout
+
+
+	def resetRequestTimeout(self, messageType):
+		'''
+		Makes a message type use the default request time-out again.
+
+		:param messageType: the message type
+		'''
+		self.requestTimeouts.pop(messageType, None)
+
+
+	def getRequestDeadline(self, request, receivedTime):
+		'''
+		:param receivedTime: time when the request was received (time.monotonic())
+
+		:returns: the dispatch deadline of the request (time.monotonic()), or None
+		'''
+		timeout = self.requestTimeouts.get(request.__class__, notSet)
+		if timeout is notSet:
+			timeout = self.requestTimeouts.get(None)
+		return None if timeout is None else receivedTime + timeout
+
+
+	def setMaxMessageSize(self, messageType, maxSize):
+		'''
+		Sets the maximum size of requests.
+		Larger requests are answered with Err_MalformedRequest, without
+		parsing them. The default maximum for all types is 64 kiB.
+		Frames larger than all maxima are already rejected by the
+		WebSocket transport, which closes the connection; see
+		getMaxFrameSize. That limit is fixed when run is called.
+
+		:param messageType: the message type, or None to set the default
+		                    for message types without their own maximum.
+		:param maxSize: maximum size in bytes (excluding the type ID),
+		                or None for no maximum.
+		'''
+		if maxSize is None and messageType is not None:
+			self.maxMessageSizes.pop(messageType, None)
+		else:
+			self.maxMessageSizes[messageType] = maxSize
+
+
+	def getMaxFrameSize(self):
+		'''
+		:returns: the size of the largest request allowed by any maximum,
+		          including the type ID, or None if some type has no maximum.
+		'''
+		maxSizes = self.maxMessageSizes.values()
+		if None in maxSizes:
+			return None
+		return max(maxSizes) + 4
+
+
+	def routeMessage(self, message):
+		'''
+		Finds the RPC function of a serialized request, without parsing it.
+
+		:param message: the serialized request.
+
+		:returns: tuple (message type, function), or None if the request
+		          must be rejected as malformed.
+		'''
+		if not isinstance(message, bytes) or len(message) < 4:
+			logging.warning('Received a request without type ID')
+			return None
+
+		messageType = id2type.get(getTypeID(message))
+		function = self.RPCFunctions.get(messageType)
+		if function is None:
+			logging.warning('Received unsupported request type')
+			return None
+
+		maxSize = self.maxMessageSizes.get(messageType, self.maxMessageSizes.get(None))
+		if maxSize is not None and len(message) - 4 > maxSize:
+			logging.warning('Received a request that exceeds the maximum size')
+			return None
+
+		return messageType, function
 
 
 	def registerTimeoutFunction(self, function):
 		'''
 		Registers a timeout function.
+		This is a compatibility interface; new code should use
+		scheduleDeadline instead.
 
 		Each time after a request is handled OR a time-out happens,
 		every registered timeout function is called.
@@ -66,6 +301,126 @@ class RPCServer:
 		self.timeoutFunctions.append(function)
 
 
+	def scheduleDeadline(self, key, deadline, function):
+		'''
+		Schedules a deadline.
+		Any existing deadline with the same key is replaced.
+
+		When the deadline has passed, the deadline is removed and
+		function is called without arguments.
+		The event loop timer is only re-armed when this changes the
+		earliest deadline.
+
+		:param key: hashable object that identifies the deadline.
+		:param deadline: the deadline (seconds since UNIX epoch).
+		:param function: the function. May raise Exception.
+		'''
+		try:
+			oldDeadline, sequence, oldFunction = self.deadlines[key]
+			if (oldDeadline, oldFunction) == (deadline, function):
+				return
+		except KeyError:
+			pass
+
+		sequence = self.nextDeadlineSequence
+		self.nextDeadlineSequence += 1
+		self.deadlines[key] = deadline, sequence, function
+		heapq.heappush(self.deadlineQueue, (deadline, sequence, key))
+		self.armDeadlineTimer()
+
+
+	def rescheduleDeadline(self, key, deadline):
+		'''
+		Moves an existing deadline to a different time.
+
+		:param key: hashable object that identifies the deadline.
+		:param deadline: the new deadline (seconds since UNIX epoch).
+
+		:raises KeyError: No deadline was scheduled with this key
+		'''
+		oldDeadline, sequence, function = self.deadlines[key]
+		self.scheduleDeadline(key, deadline, function)
+
+
+	def cancelDeadline(self, key):
+		'''
+		Cancels a deadline.
+		Canceling a non-existing deadline is not an error.
+
+		:param key: hashable object that identifies the deadline.
+		'''
+		try:
+			del self.deadlines[key]
+		except KeyError:
+			return
+
+		#The queue entry is removed lazily
+		self.armDeadlineTimer()
+
+
+	def getNextDeadline(self):
+		'''
+		:returns: the earliest scheduled deadline, or None
+		'''
+		queue = self.deadlineQueue
+		while queue:
+			deadline, sequence, key = queue[0]
+			try:
+				if self.deadlines[key][1] == sequence:
+					return deadline
+			except KeyError:
+				pass
+
+			#Stale entry: replaced or canceled
+			heapq.heappop(queue)
+
+		return None
+
+
+	def armDeadlineTimer(self):
+		nextDeadline = self.getNextDeadline()
+		if nextDeadline == self.deadlineTimerTime:
+			return
+
+		if self.deadlineTimer is not None:
+			self.deadlineTimer.cancel()
+			self.deadlineTimer = None
+
+		self.deadlineTimerTime = nextDeadline
+		if nextDeadline is not None:
+			self.deadlineTimer = self.loop.call_later(
+				max(0.0, nextDeadline - time.time()),
+				self.processDeadlines
+				)
+
+
+	def processDeadlines(self):
+		self.deadlineTimer = None
+		self.deadlineTimerTime = None
+
+		#First collect, then call: functions that re-schedule
+		#themselves immediately are called on the next loop iteration.
+		t = time.time()
+		functions = []
+		while True:
+			nextDeadline = self.getNextDeadline()
+			if nextDeadline is None or nextDeadline > t:
+				break
+
+			deadline, sequence, key = heapq.heappop(self.deadlineQueue)
+			deadline, sequence, function = self.deadlines.pop(key)
+			functions.append(function)
+
+		for function in functions:
+			try:
+				function()
+			except Exception as e:
+				logging.error('Something unexpected went wrong: ' + str(e))
+				logging.error(traceback.format_exc())
+
+		self.armDeadlineTimer()
+
+
 	@asyncio.coroutine
 	def handleMessages(self, websocket, path):
 		try:
@@ -79,36 +434,269 @@ class RPCServer:
 			#TODO: send error message
 			userID = None
 
+		#Rate limiter client key:
+		client = ('user', userID) if userID is not None else ('connection', id(websocket))
+
+		inFlight = asyncio.Semaphore(self.maxInFlight)
+		tasks = set()
+		lastTasks = {} #ordering key -> task of the last request with that key
+
+		def makeDoneCallback(key):
+			def done(task):
+				inFlight.release()
+				tasks.discard(task)
+				if key is not None and lastTasks.get(key) is task:
+					del lastTasks[key]
+			return done
+
 		try:
 			while True:
 				message = yield from websocket.recv()
-				request = deserialize(message)
+				receivedTime = time.monotonic()
+
+				#Reject what we can before parsing:
+				route = self.routeMessage(message)
+				if route is None:
+					requestID = getRequestID(message) if isinstance(message, bytes) else 0
+					yield from self.sendError(websocket, requestID,
+						bl4p_pb2.Err_MalformedRequest)
+					continue
+				messageType, function = route
+
+				if self.rateLimiter is not None and \
+					not self.rateLimiter.allow(client, getTypeID(message)):
+					yield from self.sendError(websocket, getRequestID(message),
+						bl4p_pb2.Err_RateLimitExceeded)
+					continue
+
+				#Stop reading from the connection while it has too many
+				#requests in flight:
+				yield from inFlight.acquire()
+
+				#Shed load instead of letting latency grow without bound:
+				if self.numQueued >= self.maxQueueSize:
+					inFlight.release()
+					self.numShed += 1
+					yield from self.sendError(websocket, getRequestID(message),
+						bl4p_pb2.Err_RequestQueueFull)
+					continue
 
 				try:
-					function = self.RPCFunctions[request.__class__]
-				except KeyError:
-					logging.warning('Received unsupported request type')
-					result = bl4p_pb2.Error()
-					result.reason = bl4p_pb2.Err_MalformedRequest
-				else:
-					try:
-						result = function(userID, request)
-					except Exception as e:
-						logging.error('Something unexpected went wrong: ' + str(e))
-						logging.error(traceback.format_exc())
-						result = bl4p_pb2.Error()
-						result.reason = bl4p_pb2.Err_Unknown
-
-					#After a function call, time-outs may have changed:
-					self.manageTimeouts()
-
-				result.request = request.request
-				yield from websocket.send(serialize(result))
+					request = deserialize(message)
+				except DecodeError:
+					inFlight.release()
+					logging.warning('Received a request that could not be parsed')
+					yield from self.sendError(websocket, getRequestID(message),
+						bl4p_pb2.Err_MalformedRequest)
+					continue
+
+				self.numQueued += 1
+				self.maxQueued = max(self.maxQueued, self.numQueued)
+
+				key = self.getOrderingKey(request)
+				previous = None if key is None else lastTasks.get(key)
+
+				task = asyncio.ensure_future(
+					self.handleRequest(websocket, userID, function, request, receivedTime, previous))
+				tasks.add(task)
+				if key is not None:
+					lastTasks[key] = task
+				task.add_done_callback(makeDoneCallback(key))
 		except websockets.ConnectionClosed:
 			#Accept a connection close at any time.
 			#Our response is just to silently break the loop.
 			pass
 
+		#Let requests that are still in flight finish their state changes:
+		if tasks:
+			yield from asyncio.wait(tasks)
+
+
+	def getOrderingKey(self, request):
+		'''
+		:returns: the ordering key of the request, or None
+		'''
+		try:
+			orderingKey = self.orderingKeyFunctions[request.__class__]
+		except KeyError:
+			return None
+
+		try:
+			return orderingKey(request)
+		except Exception:
+			#The RPC function will report the problem
+			return None
+
+
+	@asyncio.coroutine
+	def sendError(self, websocket, requestID, reason):
+		result = bl4p_pb2.Error()
+		result.reason = reason
+		result.request = requestID
+		try:
+			yield from websocket.send(serialize(result))
+		except websockets.ConnectionClosed:
+			pass
+
+
+	@asyncio.coroutine
+	def handleRequest(self, websocket, userID, function, request, receivedTime, previous=None):
+		'''
+		Handles a single request and sends the response.
+		The request must already be counted in numQueued.
+
+		:param function: the RPC function of the request.
+		:param receivedTime: time when the request was received (time.monotonic()).
+		:param previous: task that must finish before this request is handled,
+		                 or None.
+		'''
+		if previous is not None:
+			#Only wait; a failure of the previous request is not ours.
+			yield from asyncio.wait([previous])
+
+		try:
+			result = yield from self.dispatch(function, userID, request, receivedTime)
+		except Exception as e:
+			logging.error('Something unexpected went wrong: ' + str(e))
+			logging.error(traceback.format_exc())
+			result = bl4p_pb2.Error()
+			result.reason = bl4p_pb2.Err_Unknown
+
+		#After a function call, time-outs may have changed.
+		#This only concerns the compatibility interface;
+		#scheduled deadlines take care of themselves.
+		if self.timeoutFunctions:
+			self.manageTimeouts()
+
+		try:
+			for barrier in self.responseBarriers:
+				yield from barrier()
+		except Exception as e:
+			logging.error('Response barrier failed: ' + str(e))
+			result = bl4p_pb2.Error()
+			result.reason = bl4p_pb2.Err_BackendUnavailable
+
+		result.request = request.request
+		self.responseTimes[self.getPriority(request)].add(time.monotonic() - receivedTime)
+		try:
+			yield from websocket.send(serialize(result))
+		except websockets.ConnectionClosed:
+			pass
+
+
+	def getPriority(self, request):
+		return self.priorities.get(request.__class__, Priority.normal)
+
+
+	@asyncio.coroutine
+	def dispatch(self, function, userID, request, receivedTime=None):
+		'''
+		Puts a function call in the request queue of the request's priority
+		class, and waits for its result.
+		If the function returns a coroutine, its result is awaited.
+		If the request time-out (see setRequestTimeout) passes before the call
+		is dispatched, the function is not called and the result is an
+		Err_RequestTimeout error.
+
+		:param receivedTime: time when the request was received
+		                     (time.monotonic(); default: now).
+		'''
+		if receivedTime is None:
+			receivedTime = time.monotonic()
+		deadline = self.getRequestDeadline(request, receivedTime)
+
+		future = self.loop.create_future()
+		self.requestQueues[self.getPriority(request)].append(
+			(function, userID, request, receivedTime, deadline, future))
+		self.scheduleQueue()
+		return (yield from future)
+
+
+	def scheduleQueue(self):
+		if self.numWaiting() > 0 and not self.queueScheduled:
+			self.queueScheduled = True
+			self.loop.call_soon(self.runQueue)
+
+
+	def runQueue(self):
+		'''
+		Dispatches the first request of the highest non-empty priority class.
+
+		Only one request is dispatched per event loop iteration, so incoming
+		messages keep being read (and shed when the queue is full) while
+		the queue is long.
+		'''
+		self.queueScheduled = False
+		for priority in priorityOrder:
+			queue = self.requestQueues[priority]
+			if queue:
+				break
+
+		function, userID, request, receivedTime, deadline, future = queue.popleft()
+		self.numQueued -= 1
+
+		t = time.monotonic()
+		self.queueTimes[priority].add(t - receivedTime)
+
+		if deadline is not None and t > deadline:
+			self.numTimedOut += 1
+			result = bl4p_pb2.Error()
+			result.reason = bl4p_pb2.Err_RequestTimeout
+			future.set_result(result)
+			self.scheduleQueue()
+			return
+
+		try:
+			result = function(userID, request)
+		except Exception as e:
+			future.set_exception(e)
+		else:
+			if asyncio.iscoroutine(result):
+				task = asyncio.ensure_future(result, loop=self.loop)
+				task.add_done_callback(lambda t: copyResult(t, future))
+			else:
+				future.set_result(result)
+
+		self.scheduleQueue()
+
+
+	def numWaiting(self):
+		'''
+		:returns: the number of calls in the request queues
+		'''
+		return sum(len(q) for q in self.requestQueues.values())
+
+
+	def getQueueStatistics(self):
+		'''
+		:returns: dictionary with the current queue depth, the highest
+		          depth so far, the configured maximum depth, the number
+		          of requests that were shed because the queue was full
+		          and the number of requests that timed out in the queue
+		'''
+		return \
+		{
+		'depth': self.numQueued,
+		'maxDepth': self.maxQueued,
+		'limit': self.maxQueueSize,
+		'shed': self.numShed,
+		'timedOut': self.numTimedOut,
+		}
+
+
+	def getLatencyStatistics(self):
+		'''
+		:returns: per priority class, dictionaries with statistics of the
+		          time from receiving requests to dispatching them ('queue')
+		          and to having the response ready for sending ('response');
+		          see LatencyStatistics
+		'''
+		return \
+		{
+		p: {'queue': self.queueTimes[p].get(), 'response': self.responseTimes[p].get()}
+		for p in priorityOrder
+		}
+
 
 
 	def run(self):
@@ -119,6 +707,7 @@ class RPCServer:
 			self.handleMessages,
 			self.host, self.port,
 			loop = self.loop,
+			max_size = self.getMaxFrameSize(),
 			)
 		self.server = self.loop.run_until_complete(startServer)
 		self.stopFuture = self.loop.create_future()
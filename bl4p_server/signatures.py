@@ -0,0 +1,207 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Signature verification.
+
+verify does not use any back-end state, so it can run in a thread pool
+(libsecp256k1 is called without holding the GIL) or in a process pool.
+
+Users sign either with ECDSA (DER-serialized signatures over the SHA256
+of the message) or with BIP340 Schnorr signatures (64 bytes, over the
+tagged hash of the message with tag schnorrTag). The signature type of
+a user is configured on the back-end (User.signatureType).
+'''
+
+import asyncio
+
+import secp256k1
+
+from .utils import Enum
+
+
+
+SignatureType = Enum(['ecdsa', 'schnorr'])
+
+schnorrTag = b'BL4P/report'
+
+
+
+class UnsupportedSignatureType(Exception):
+	pass
+
+
+def checkSupported(signatureType):
+	'''
+	:param signatureType: the SignatureType
+
+	:raises UnsupportedSignatureType: the installed secp256k1 can not verify this type of signatures
+	'''
+	if signatureType == SignatureType.schnorr:
+		#BIP340 Schnorr signatures require secp256k1 0.14.0 or later,
+		#built with the schnorrsig and extrakeys modules:
+		supported = \
+			getattr(secp256k1, 'HAS_SCHNORR', False) and \
+			getattr(secp256k1, 'HAS_EXTRAKEYS', False) and \
+			hasattr(secp256k1.PublicKey, 'schnorr_verify')
+		if not supported:
+			raise UnsupportedSignatureType(
+				'The installed secp256k1 does not support BIP340 Schnorr signatures')
+	elif signatureType != SignatureType.ecdsa:
+		raise UnsupportedSignatureType('Unknown signature type %s' % signatureType)
+
+
+
+def verify(pubKey, message, signature, signatureType=SignatureType.ecdsa):
+	'''
+	Verify a signature.
+
+	:param pubKey: the public key: a secp256k1.PublicKey, or its serialized form
+	               (which can be passed to a process pool)
+	:param message: the signed message
+	:param signature: the signature
+	:param signatureType: the SignatureType
+
+	:returns: whether the signature is correct
+	'''
+	if pubKey is None:
+		return False #The user has no valid public key
+
+	#On malformed input, secp256k1 raises plain Exceptions (or fails an assertion):
+	try:
+		if isinstance(pubKey, bytes):
+			pubKey = secp256k1.PublicKey(pubKey, raw=True)
+		if signatureType != SignatureType.schnorr:
+			sigObject = pubKey.ecdsa_deserialize(signature)
+	except Exception:
+		return False
+
+	if signatureType == SignatureType.schnorr:
+		if len(signature) != 64:
+			return False
+		return bool(pubKey.schnorr_verify(message, signature, schnorrTag))
+
+	return bool(pubKey.ecdsa_verify(message, sigObject))
+
+
+def verifyBatch(batch):
+	'''
+	Verify a batch of signatures.
+
+	This is groundwork only: the secp256k1 bindings have no batch
+	verification, so every signature is verified separately, at the same
+	CPU cost as with verify. The only saving is that a whole batch is
+	passed to a pool in a single call. Once batch verification is
+	available, Schnorr signatures can be verified together here.
+
+	:param batch: list of (pubKey, message, signature, signatureType), as in verify
+
+	:returns: list of bool: whether each signature is correct
+	'''
+	return [verify(*item) for item in batch]
+
+
+
+class BatchVerifier:
+	'''
+	Gathers signatures that are to be verified by concurrent requests,
+	and verifies them in batches: a batch is verified when it is full, or
+	when the first signature in it has waited for a short window.
+
+	Since verifyBatch does not verify faster than one by one yet, this
+	only reduces the number of pool calls, at the cost of the window's
+	latency; see verifyBatch.
+	'''
+
+	def __init__(self, pool=None, window=0.001, maxBatchSize=64, loop=None):
+		'''
+		:param pool: executor in which batches are verified, or None (on the event loop thread)
+		:param window: maximum time a signature waits for its batch to be started, in seconds
+		:param maxBatchSize: maximum number of signatures in a batch
+		:param loop: the event loop (default: the current event loop)
+		'''
+		self.pool = pool
+		self.window = window
+		self.maxBatchSize = maxBatchSize
+		self.loop = asyncio.get_event_loop() if loop is None else loop
+
+		self.batch = [] #(pubKey, message, signature, signatureType)
+		self.futures = []
+		self.timer = None
+
+		self.numBatches = 0
+		self.numSignatures = 0
+
+
+	@asyncio.coroutine
+	def verify(self, pubKey, message, signature, signatureType=SignatureType.ecdsa):
+		'''
+		Verify a signature as part of a batch. The arguments are as in the module function verify.
+
+		:returns: whether the signature is correct
+		'''
+		future = self.loop.create_future()
+		self.batch.append((pubKey, message, signature, signatureType))
+		self.futures.append(future)
+
+		if len(self.batch) >= self.maxBatchSize:
+			self.flush()
+		elif self.timer is None:
+			self.timer = self.loop.call_later(self.window, self.flush)
+
+		return (yield from future)
+
+
+	def flush(self):
+		'''
+		Start verifying the current batch.
+		'''
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+
+		batch, futures = self.batch, self.futures
+		self.batch, self.futures = [], []
+		if not batch:
+			return
+
+		self.numBatches += 1
+		self.numSignatures += len(batch)
+
+		if self.pool is None:
+			self.setResults(futures, verifyBatch(batch))
+			return
+
+		def finished(resultFuture):
+			try:
+				results = resultFuture.result()
+			except Exception as e:
+				for future in futures:
+					if not future.done():
+						future.set_exception(e)
+				return
+			self.setResults(futures, results)
+
+		self.loop.run_in_executor(self.pool, verifyBatch, batch).add_done_callback(finished)
+
+
+	@staticmethod
+	def setResults(futures, results):
+		for future, result in zip(futures, results):
+			#The waiting request may have been canceled:
+			if not future.done():
+				future.set_result(result)
@@ -0,0 +1,318 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Point-in-time snapshots of the BL4P state.
+
+A snapshot file contains a header, all users, the transactions and a
+CRC32 of everything before it. It also records the journal generation
+that was started when the snapshot was taken: on start-up, the snapshot
+is loaded and only the journal from that generation on is replayed.
+'''
+
+import gc
+import logging
+import os
+import struct
+import time
+import zlib
+
+from .bl4p_backend import User, Transaction, finalStates
+from .signatures import SignatureType
+
+
+
+#magic, journal generation, number of users, number of transactions
+header = struct.Struct('<8sQQQ')
+magic = b'BL4PSNP2'
+
+#user ID, balance, compressed public key (all zeroes for None),
+#signature type
+userRecord = struct.Struct('<qq33sB')
+noPubKey = bytes(33)
+
+#Version 1 files have no signature type; they can still be read:
+magicV1 = b'BL4PSNP1'
+userRecordV1 = struct.Struct('<qq33s')
+
+#payment hash, preimage, sender user ID (-1 for None), receiver user ID,
+#amount incoming, amount outgoing, sender time-out, receiver time-out,
+#status
+transactionRecord = struct.Struct('<32s32sqqqqddB')
+
+#CRC32 of all preceding data
+trailer = struct.Struct('<I')
+
+statuses = ('waiting_for_selfreport', 'waiting_for_sender', 'waiting_for_receiver',
+	'sender_timeout', 'receiver_timeout', 'completed', 'canceled')
+
+signatureTypes = (SignatureType.ecdsa, SignatureType.schnorr)
+
+chunkSize = 4096 #records
+
+
+
+def packPubKey(pubKey):
+	if pubKey is None:
+		return noPubKey
+	if len(pubKey) != len(noPubKey):
+		raise ValueError('Public key is not a compressed public key')
+	return pubKey
+
+
+def write(filename, generation, users, transactions):
+	'''
+	Write and sync a snapshot file.
+
+	:param filename: the file name
+	:param generation: the journal generation that follows this snapshot
+	:param users: list of User-like objects
+	:param transactions: dict of payment hash -> Transaction-like object
+	'''
+	with open(filename, 'wb') as f:
+		crc = 0
+
+		def writeData(data):
+			nonlocal crc
+			crc = zlib.crc32(data, crc)
+			f.write(data)
+
+		writeData(header.pack(magic, generation, len(users), len(transactions)))
+
+		for start in range(0, len(users), chunkSize):
+			writeData(b''.join(
+				userRecord.pack(user.id, user.balance, packPubKey(user.pubKey),
+					signatureTypes.index(user.signatureType))
+				for user in users[start:start + chunkSize]
+				))
+
+		items = list(transactions.items())
+		for start in range(0, len(items), chunkSize):
+			writeData(b''.join(
+				transactionRecord.pack(
+					paymentHash, tx.preimage,
+					-1 if tx.sender_userid is None else tx.sender_userid,
+					tx.receiver_userid,
+					tx.amountIncoming, tx.amountOutgoing,
+					tx.senderTimeout, tx.receiverTimeout,
+					statuses.index(str(tx.status))
+					)
+				for paymentHash, tx in items[start:start + chunkSize]
+				))
+
+		f.write(trailer.pack(crc))
+		f.flush()
+		os.fsync(f.fileno())
+
+
+def read(filename):
+	'''
+	Read a snapshot file.
+
+	:param filename: the file name
+
+	:returns: tuple (journal generation, list of User, dict of payment hash -> Transaction)
+
+	:raises ValueError: the file is not a valid snapshot
+	'''
+	with open(filename, 'rb') as f:
+		crc = 0
+
+		def readData(size):
+			nonlocal crc
+			data = f.read(size)
+			if len(data) != size:
+				raise ValueError('Snapshot is truncated')
+			crc = zlib.crc32(data, crc)
+			return data
+
+		fileMagic, generation, numUsers, numTransactions = header.unpack(readData(header.size))
+		if fileMagic == magic:
+			record = userRecord
+		elif fileMagic == magicV1:
+			record = userRecordV1
+		else:
+			raise ValueError('Not a snapshot file')
+
+		users = []
+		for start in range(0, numUsers, chunkSize):
+			count = min(chunkSize, numUsers - start)
+			for userid, balance, pubKey, *signatureType in record.iter_unpack(readData(count * record.size)):
+				users.append(User(
+					id = userid,
+					balance = balance,
+					pubKey = None if pubKey == noPubKey else pubKey,
+					signatureType = signatureTypes[signatureType[0]] if signatureType else SignatureType.ecdsa
+					))
+
+		transactions = {}
+		for start in range(0, numTransactions, chunkSize):
+			count = min(chunkSize, numTransactions - start)
+			for paymentHash, preimage, sender_userid, receiver_userid, \
+				amountIncoming, amountOutgoing, senderTimeout, receiverTimeout, \
+				status in transactionRecord.iter_unpack(readData(count * transactionRecord.size)):
+
+				transactions[paymentHash] = Transaction(
+					sender_userid = None if sender_userid < 0 else sender_userid,
+					receiver_userid = receiver_userid,
+					amountIncoming = amountIncoming,
+					amountOutgoing = amountOutgoing,
+					preimage = preimage,
+					senderTimeout = senderTimeout,
+					receiverTimeout = receiverTimeout,
+					status = statuses[status]
+					)
+
+		expectedCRC = crc
+		if trailer.unpack(readData(trailer.size))[0] != expectedCRC:
+			raise ValueError('Snapshot checksum mismatch')
+
+	return generation, users, transactions
+
+
+def load(bl4p, filename):
+	'''
+	Load a snapshot into a BL4P back-end.
+
+	:param bl4p: the BL4P back-end
+	:param filename: the file name
+
+	:returns: the journal generation to start replaying at
+
+	:raises ValueError: the file is not a valid snapshot
+	'''
+	#Millions of new objects would trigger many useless garbage collections:
+	gc.disable()
+	try:
+		generation, users, transactions = read(filename)
+		bl4p.loadState(users, transactions)
+	finally:
+		gc.enable()
+	return generation
+
+
+
+class Snapshotter:
+	'''
+	Periodically writes snapshots of a BL4P back-end, and then removes
+	the journal generations that are covered by them.
+
+	The snapshot is written by a forked child process, which has a
+	copy-on-write view of the state at the moment of forking; the server
+	process continues handling requests in the meantime.
+	The snapshot only replaces the previous one when both the child has
+	finished and all journal records it covers are durable.
+	'''
+
+	def __init__(self, bl4p, filename, interval):
+		'''
+		:param bl4p: the BL4P back-end; it must have a journal
+		:param filename: the snapshot file name
+		:param interval: time between snapshots, in seconds
+		'''
+		self.bl4p = bl4p
+		self.filename = filename
+		self.tempFilename = filename + '.tmp'
+		self.interval = interval
+		self.pollInterval = 0.1 #seconds
+
+		self.scheduler = None
+		self.childPID = None
+		self.generation = None   #journal generation following the snapshot in progress
+		self.durableTarget = None #journal record count that must be durable
+
+
+	def start(self, scheduler):
+		'''
+		:param scheduler: object with the scheduleDeadline method of RPCServer
+		'''
+		self.scheduler = scheduler
+		self.scheduler.scheduleDeadline(self, time.time() + self.interval, self.takeSnapshot)
+
+
+	def takeSnapshot(self):
+		'''
+		Start writing a snapshot in a child process.
+		'''
+		bl4p = self.bl4p
+		self.generation = bl4p.journal.rotate()
+		self.durableTarget = bl4p.journal.numAppended
+
+		pid = os.fork()
+		if pid == 0:
+			#Child process:
+			status = 1
+			try:
+				write(self.tempFilename, self.generation,
+					list(bl4p.users.values()), self.getSnapshotTransactions())
+				status = 0
+			finally:
+				os._exit(status)
+
+		self.childPID = pid
+		self.scheduler.scheduleDeadline(self, time.time() + self.pollInterval, self.checkSnapshot)
+
+
+	def getSnapshotTransactions(self):
+		'''
+		:returns: the transactions to be included in the snapshot
+		'''
+		if self.bl4p.archive is not None:
+			#Finished transactions that are not yet archived must survive a restart:
+			return self.bl4p.transactions
+
+		return \
+		{
+		paymentHash: tx
+		for paymentHash, tx in self.bl4p.transactions.items()
+		if tx.status not in finalStates
+		}
+
+
+	def checkSnapshot(self):
+		'''
+		Finish the snapshot in progress, if possible.
+		'''
+		if self.childPID is not None:
+			pid, status = os.waitpid(self.childPID, os.WNOHANG)
+			if pid == 0:
+				#Still busy
+				self.scheduler.scheduleDeadline(self, time.time() + self.pollInterval, self.checkSnapshot)
+				return
+
+			self.childPID = None
+			if status != 0:
+				logging.error('Snapshot: writing failed (wait status %d)' % status)
+				self.scheduler.scheduleDeadline(self, time.time() + self.interval, self.takeSnapshot)
+				return
+
+		#The snapshot may only depend on durable journal records:
+		if self.bl4p.journal.numDurable < self.durableTarget:
+			self.scheduler.scheduleDeadline(self, time.time() + self.pollInterval, self.checkSnapshot)
+			return
+
+		os.replace(self.tempFilename, self.filename)
+		directoryFD = os.open(os.path.dirname(self.filename) or '.', os.O_RDONLY)
+		try:
+			os.fsync(directoryFD)
+		finally:
+			os.close(directoryFD)
+
+		self.bl4p.journal.removeGenerationsBefore(self.generation)
+		logging.info('Snapshot: written; journal generation is now %d' % self.generation)
+
+		self.scheduler.scheduleDeadline(self, time.time() + self.interval, self.takeSnapshot)
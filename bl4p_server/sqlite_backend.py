@@ -0,0 +1,400 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import logging
+import sqlite3
+import time
+
+from . import journal
+from . import signatures
+from .bl4p_backend import BL4P, User, Transaction, TransactionStatus
+
+
+
+schema = \
+[
+'''CREATE TABLE IF NOT EXISTS users (
+	id             INTEGER PRIMARY KEY,
+	balance        INTEGER NOT NULL,
+	pubkey         BLOB,
+	signature_type TEXT NOT NULL DEFAULT 'ecdsa'
+	)''',
+
+'''CREATE TABLE IF NOT EXISTS transactions (
+	payment_hash     BLOB PRIMARY KEY,
+	sender_userid    INTEGER,
+	receiver_userid  INTEGER NOT NULL,
+	amount_incoming  INTEGER NOT NULL,
+	amount_outgoing  INTEGER NOT NULL,
+	preimage         BLOB NOT NULL,
+	sender_timeout   REAL NOT NULL,
+	receiver_timeout REAL NOT NULL,
+	status           TEXT NOT NULL,
+	timeout          REAL
+	) WITHOUT ROWID''',
+
+#payment_hash is indexed as primary key.
+#timeout is the time-out of the current status, or NULL:
+'''CREATE INDEX IF NOT EXISTS transactions_status_timeout
+	ON transactions (status, timeout)''',
+]
+
+#All statements are constant strings, so sqlite3 can re-use the
+#prepared statements from its statement cache.
+
+#Columns that were added later, for upgrading existing databases:
+#(table, column, definition)
+addedColumns = \
+[
+('users', 'signature_type', "TEXT NOT NULL DEFAULT 'ecdsa'"),
+]
+
+selectUser = 'SELECT balance, pubkey, signature_type FROM users WHERE id = ?'
+
+insertUser = 'INSERT OR IGNORE INTO users (id, balance, pubkey, signature_type) VALUES (?, ?, ?, ?)'
+
+addBalance = 'UPDATE users SET balance = balance + ? WHERE id = ?'
+
+selectTransaction = '''SELECT
+	sender_userid, receiver_userid, amount_incoming, amount_outgoing,
+	preimage, sender_timeout, receiver_timeout, status
+	FROM transactions WHERE payment_hash = ?'''
+
+insertTransaction = '''INSERT INTO transactions (
+	payment_hash, sender_userid, receiver_userid, amount_incoming, amount_outgoing,
+	preimage, sender_timeout, receiver_timeout, status, timeout
+	) VALUES (?, NULL, ?, ?, ?, ?, ?, ?, ?, NULL)'''
+
+updateStatus = 'UPDATE transactions SET status = ?, timeout = ? WHERE payment_hash = ?'
+
+updateSender = 'UPDATE transactions SET sender_userid = ? WHERE payment_hash = ?'
+
+selectExpired = '''SELECT payment_hash FROM transactions
+	WHERE status = ? AND timeout <= ? ORDER BY timeout LIMIT ?'''
+
+selectNextTimeout = 'SELECT MIN(timeout) FROM transactions WHERE status = ?'
+
+selectLockedFunds = 'SELECT SUM(amount_incoming) FROM transactions WHERE status = ?'
+
+selectLockedFundsOfSender = '''SELECT SUM(amount_incoming) FROM transactions
+	WHERE status = ? AND sender_userid = ?'''
+
+waitingStatuses = (TransactionStatus.waiting_for_sender, TransactionStatus.waiting_for_receiver)
+
+
+
+class SQLiteBL4P(BL4P):
+	'''
+	BL4P back-end with storage in SQLite.
+
+	The business logic is that of BL4P; only the storage differs.
+	Every public method call is one atomic database transaction.
+	The database is in WAL mode; with synchronous=FULL, every committed
+	database transaction is durable.
+
+	Journals, snapshots, archives and timing wheels are not supported:
+	the database takes care of persistence and time-out indexing.
+	'''
+
+	def __init__(self, filename, synchronous='FULL'):
+		'''
+		:param filename: the database file name
+		:param synchronous: SQLite synchronous setting (e.g. 'FULL' or 'NORMAL')
+		'''
+		BL4P.__init__(self)
+
+		#Maximum number of time-outs processed in one processTimeouts call:
+		self.timeoutBatchSize = 1000
+
+		#Transactions are managed explicitly, see transaction():
+		self.db = sqlite3.connect(filename, isolation_level=None, cached_statements=256)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=' + synchronous)
+		for statement in schema:
+			self.db.execute(statement)
+		for table, column, definition in addedColumns:
+			columns = [row[1] for row in self.db.execute('PRAGMA table_info(%s)' % table)]
+			if column not in columns:
+				self.db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition))
+
+		self.inTransaction = False
+
+
+	def close(self):
+		self.db.close()
+
+
+	@contextlib.contextmanager
+	def transaction(self):
+		'''
+		Context manager for an atomic database transaction.
+		Nested use is part of the outer transaction.
+		'''
+		if self.inTransaction:
+			yield
+			return
+
+		self.db.execute('BEGIN IMMEDIATE')
+		self.inTransaction = True
+		try:
+			yield
+		except:
+			self.db.execute('ROLLBACK')
+			raise
+		else:
+			self.db.execute('COMMIT')
+		finally:
+			self.inTransaction = False
+
+
+	def setArchive(self, archive, retentionTime):
+		'''
+		:raises ValueError: always; finished transactions stay in the database
+		'''
+		raise ValueError('SQLiteBL4P stores finished transactions itself')
+
+
+	def setJournal(self, newJournal, startGeneration=0):
+		'''
+		:raises ValueError: always; the database is already durable
+		'''
+		raise ValueError('SQLiteBL4P stores state changes in its database, not in a journal')
+
+
+	def addUser(self, user):
+		signatures.checkSupported(user.signatureType)
+		with self.transaction():
+			self.db.execute(insertUser, (user.id, user.balance, user.pubKey, user.signatureType))
+
+
+	def getUser(self, userid):
+		row = self.db.execute(selectUser, (userid,)).fetchone()
+		if row is None:
+			raise BL4P.UserNotFound()
+
+		balance, pubKey, signatureType = row
+		return User(id=userid, balance=balance, pubKey=pubKey, signatureType=signatureType)
+
+
+	def readTransaction(self, paymentHash):
+		'''
+		:returns: the transaction data structure, or None
+		'''
+		row = self.db.execute(selectTransaction, (paymentHash,)).fetchone()
+		if row is None:
+			return None
+
+		sender_userid, receiver_userid, amountIncoming, amountOutgoing, \
+		preimage, senderTimeout, receiverTimeout, status = row
+		return Transaction(
+			sender_userid = sender_userid,
+			receiver_userid = receiver_userid,
+			amountIncoming = amountIncoming,
+			amountOutgoing = amountOutgoing,
+			preimage = preimage,
+			senderTimeout = senderTimeout,
+			receiverTimeout = receiverTimeout,
+			status = status
+			)
+
+
+	def getTransaction(self, paymentHash, acceptableStates=None):
+		ret = self.readTransaction(paymentHash)
+		if ret is None:
+			logging.warning(
+				'getTransaction: payment hash not found'
+				)
+			raise BL4P.TransactionNotFound()
+
+		#processTimeouts may lag behind; the time-out itself is leading:
+		self.expireIfDue(paymentHash, ret)
+
+		if acceptableStates is not None and ret.status not in acceptableStates:
+			logging.warning(
+				'getTransaction: payment is not in an acceptable state: state %s; acceptable %s' % \
+				(ret.status, str(acceptableStates))
+				)
+			raise BL4P.TransactionNotFound()
+
+		return ret
+
+
+	def startTransaction(self, *args, **kwargs):
+		with self.transaction():
+			return BL4P.startTransaction(self, *args, **kwargs)
+
+
+	def processSelfReport(self, *args, **kwargs):
+		with self.transaction():
+			return BL4P.processSelfReport(self, *args, **kwargs)
+
+
+	def cancelTransaction(self, *args, **kwargs):
+		with self.transaction():
+			return BL4P.cancelTransaction(self, *args, **kwargs)
+
+
+	def processSenderAck(self, *args, **kwargs):
+		with self.transaction():
+			return BL4P.processSenderAck(self, *args, **kwargs)
+
+
+	def processReceiverClaim(self, *args, **kwargs):
+		with self.transaction():
+			return BL4P.processReceiverClaim(self, *args, **kwargs)
+
+
+	def getTransactionStatus(self, *args, **kwargs):
+		with self.transaction():
+			return BL4P.getTransactionStatus(self, *args, **kwargs)
+
+
+	def getLockedFunds(self, userid=None):
+		if userid is None:
+			row = self.db.execute(selectLockedFunds,
+				(TransactionStatus.waiting_for_receiver,)).fetchone()
+		else:
+			row = self.db.execute(selectLockedFundsOfSender,
+				(TransactionStatus.waiting_for_receiver, userid)).fetchone()
+		return row[0] or 0 #SUM gives NULL if there are no rows
+
+
+	def applyChange(self, payload):
+		'''
+		Apply a state change to the database.
+		Must be called inside a database transaction.
+
+		:param payload: the journal record payload
+		'''
+		record = journal.decode(payload)
+		recordType, paymentHash = record[:2]
+
+		if recordType == journal.START:
+			preimage, receiver_userid, amountIncoming, amountOutgoing, \
+			senderTimeout, receiverTimeout = record[2:]
+			self.db.execute(insertTransaction, (
+				paymentHash, receiver_userid, amountIncoming, amountOutgoing,
+				preimage, senderTimeout, receiverTimeout,
+				TransactionStatus.waiting_for_selfreport
+				))
+			return
+
+		tx = self.readTransaction(paymentHash)
+
+		if recordType == journal.SELFREPORT:
+			self.setStatus(paymentHash, TransactionStatus.waiting_for_sender, tx.senderTimeout)
+
+		elif recordType == journal.SENDERACK:
+			sender_userid = record[2]
+			self.db.execute(addBalance, (-tx.amountIncoming, sender_userid))
+			self.db.execute(updateSender, (sender_userid, paymentHash))
+			self.setStatus(paymentHash, TransactionStatus.waiting_for_receiver, tx.receiverTimeout)
+
+		elif recordType == journal.CLAIM:
+			self.db.execute(addBalance, (tx.amountOutgoing, tx.receiver_userid))
+			self.setStatus(paymentHash, TransactionStatus.completed)
+
+		elif recordType == journal.CANCEL:
+			if tx.status == TransactionStatus.waiting_for_receiver:
+				#Funds are already sent - give back to sender
+				self.db.execute(addBalance, (tx.amountIncoming, tx.sender_userid))
+			self.setStatus(paymentHash, TransactionStatus.canceled)
+
+		elif recordType == journal.SENDER_TIMEOUT:
+			logging.info('Sender time-out happened')
+			assert tx.status == TransactionStatus.waiting_for_sender
+			self.setStatus(paymentHash, TransactionStatus.sender_timeout)
+
+		elif recordType == journal.RECEIVER_TIMEOUT:
+			logging.info('Receiver time-out happened')
+			assert tx.status == TransactionStatus.waiting_for_receiver
+			self.db.execute(addBalance, (tx.amountIncoming, tx.sender_userid))
+			self.setStatus(paymentHash, TransactionStatus.receiver_timeout)
+
+
+	def setStatus(self, paymentHash, status, timeout=None):
+		'''
+		Change the status of a transaction, and set its time-out accordingly.
+
+		:param paymentHash: the payment hash
+		:param status: the new status
+		:param timeout: the time-out of the new status, or None
+		'''
+		self.db.execute(updateStatus, (status, timeout, paymentHash))
+		if timeout is not None:
+			self.requestWakeup(timeout)
+
+
+	def expireIfDue(self, paymentHash, tx):
+		'''
+		Process the time-out of tx if it has passed, regardless of whether
+		processTimeouts has already got to it.
+		tx is updated accordingly.
+
+		:param paymentHash: the payment hash
+		:param tx: the transaction
+		'''
+		if tx.status == TransactionStatus.waiting_for_sender:
+			timeout = tx.senderTimeout
+		elif tx.status == TransactionStatus.waiting_for_receiver:
+			timeout = tx.receiverTimeout
+		else:
+			return
+
+		if timeout > time.time():
+			return
+
+		with self.transaction():
+			self.processTimeout(paymentHash, tx)
+		tx.status = self.readTransaction(paymentHash).status
+
+
+	def processTimeouts(self):
+		'''
+		Process transaction time-out events.
+
+		At most timeoutBatchSize time-outs of each kind are processed
+		per call; processing continues on the next call.
+
+		:returns: the time-delta to the next time-out, or None
+		'''
+
+		t = time.time()
+
+		with self.transaction():
+			backlog = False
+			for status in waitingStatuses:
+				expired = self.db.execute(selectExpired, (status, t, self.timeoutBatchSize)).fetchall()
+				backlog = backlog or len(expired) == self.timeoutBatchSize
+				for paymentHash, in expired:
+					self.processTimeout(paymentHash, self.readTransaction(paymentHash))
+
+			nextTimeout = None
+			for status in waitingStatuses:
+				timeout = self.db.execute(selectNextTimeout, (status,)).fetchone()[0]
+				if timeout is not None and (nextTimeout is None or timeout < nextTimeout):
+					nextTimeout = timeout
+
+		if backlog:
+			#Continue as soon as possible
+			self.updateSchedule(t)
+			return 0.0
+
+		self.updateSchedule(nextTimeout)
+		return None if nextTimeout is None else nextTimeout - t
+
@@ -0,0 +1,326 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Time-out indices.
+
+A time-out index keeps track of (time-out, key, status) entries, with at most
+one entry per key. All indices have the same interface:
+
+add(timeout, key, status): add an entry
+remove(key): remove the entry of key
+popExpired(t, limit=None): remove and return [(key, status), ...] of at most
+    limit expired entries; the rest stays in the index for the next call
+getNextTimeout(): the earliest moment something may expire, or None
+'''
+
+import collections
+import heapq
+
+
+
+class TimeoutHeap:
+	'''
+	Time-out index based on a binary heap.
+	Time-outs expire exactly at their time-out time.
+
+	Removal is lazy: removed entries stay in the heap until they reach
+	the top, or until they make up more than half of the heap.
+	'''
+
+	def __init__(self, isValid):
+		'''
+		:param isValid: function(key, status) that returns whether an entry has not been removed
+		'''
+		self.isValid = isValid
+		self.queue = []   #heap of (time-out, key, status)
+		self.numStale = 0
+
+
+	def add(self, timeout, key, status):
+		heapq.heappush(self.queue, (timeout, key, status))
+
+
+	def remove(self, key):
+		'''
+		Register that the entry of key has been removed.
+		isValid must already reflect the removal.
+		'''
+		self.numStale += 1
+
+		#Don't let stale entries dominate the queue:
+		if 2 * self.numStale > len(self.queue):
+			self.queue = \
+			[
+			entry
+			for entry in self.queue
+			if self.isValid(entry[1], entry[2])
+			]
+			heapq.heapify(self.queue)
+			self.numStale = 0
+
+
+	def popExpired(self, t, limit=None):
+		ret = []
+		queue = self.queue
+		while queue and queue[0][0] <= t and (limit is None or len(ret) < limit):
+			timeout, key, status = heapq.heappop(queue)
+			if self.isValid(key, status):
+				ret.append((key, status))
+			else:
+				self.numStale -= 1
+		return ret
+
+
+	def getNextTimeout(self):
+		queue = self.queue
+		while queue:
+			timeout, key, status = queue[0]
+			if self.isValid(key, status):
+				return timeout
+
+			heapq.heappop(queue)
+			self.numStale -= 1
+
+		return None
+
+
+
+class Bucket(dict):
+	'''
+	Timing wheel bucket: dict of key -> (time-out, status).
+	'''
+	__slots__ = ('level',)
+
+	def __init__(self, level):
+		dict.__init__(self)
+		self.level = level #None for the due and overflow buckets
+
+
+
+class TimingWheel:
+	'''
+	Time-out index based on a hierarchical timing wheel.
+
+	Level 0 has one-second buckets; each slot of a higher level spans a
+	full revolution of the level below it. Entries are moved down
+	("cascaded") when the wheel reaches their slot on a higher level.
+	Entries beyond the range of the top level wait in an overflow bucket.
+
+	Adding and removing entries is O(1), and a bucket expires as a whole,
+	in O(1): it is moved to a queue of expired buckets, from which
+	popExpired takes its entries.
+	As a consequence, time-outs expire at the end of their one-second
+	bucket, so up to one second after their time-out time.
+	'''
+
+	def __init__(self, startTime, levelBits=(8, 6, 6, 6)):
+		'''
+		:param startTime: the current time (seconds since UNIX epoch)
+		:param levelBits: for each level, the log2 of the number of slots
+		'''
+		self.shifts = [] #tick bit position of each level
+		self.masks = []  #slot index mask of each level
+		shift = 0
+		for bits in levelBits:
+			self.shifts.append(shift)
+			self.masks.append((1 << bits) - 1)
+			shift += bits
+		self.shifts.append(shift) #end of the top level
+
+		self.levels = \
+		[
+		[Bucket(level) for i in range(1 << bits)]
+		for level, bits in enumerate(levelBits)
+		]
+		self.levelCounts = [0] * len(levelBits)
+
+		self.due = Bucket(None)      #entries whose bucket has already expired
+		self.overflow = Bucket(None) #entries beyond the top level
+		self.expired = collections.deque() #expired level 0 buckets
+
+		self.location = {} #key -> bucket
+
+		#The first bucket that has not expired yet:
+		self.current = int(startTime)
+
+
+	def add(self, timeout, key, status):
+		slot = self.getSlot(int(timeout))
+		slot[key] = (timeout, status)
+		self.location[key] = slot
+		if slot.level is not None:
+			self.levelCounts[slot.level] += 1
+
+
+	def remove(self, key):
+		try:
+			slot = self.location.pop(key)
+		except KeyError:
+			return
+		del slot[key]
+		if slot.level is not None:
+			self.levelCounts[slot.level] -= 1
+
+
+	def getSlot(self, tick):
+		'''
+		:returns: the bucket for tick
+		'''
+		current = self.current
+		if tick < current:
+			return self.due
+
+		shifts = self.shifts
+		for level, slots in enumerate(self.levels):
+			#Same revolution of this level?
+			if tick >> shifts[level + 1] == current >> shifts[level + 1]:
+				return slots[(tick >> shifts[level]) & self.masks[level]]
+
+		return self.overflow
+
+
+	def popExpired(self, t, limit=None):
+		self.advance(int(t))
+
+		ret = []
+		self.takeEntries(self.due, ret, limit)
+		expired = self.expired
+		while expired and (limit is None or len(ret) < limit):
+			self.takeEntries(expired[0], ret, limit)
+			if not expired[0]:
+				expired.popleft()
+
+		return ret
+
+
+	def advance(self, end):
+		'''
+		Move the level 0 buckets before end to the expired queue.
+
+		:param end: the first tick that has not expired
+		'''
+		slots0 = self.levels[0]
+		mask0 = self.masks[0]
+		while self.current < end:
+			if self.levelCounts[0] == 0:
+				#Skip ahead to the next slot of the lowest non-empty level:
+				level = 1
+				while level < len(self.levels) and self.levelCounts[level] == 0:
+					level += 1
+				if level == len(self.levels) and not self.overflow:
+					self.current = end
+					break
+				step = 1 << self.shifts[level]
+				self.current = min(end, (self.current // step + 1) * step)
+			else:
+				index = self.current & mask0
+				slot = slots0[index]
+				if slot:
+					#Swap in an empty bucket; the expired one keeps its
+					#entries, so their locations stay valid:
+					self.levelCounts[0] -= len(slot)
+					slot.level = None
+					self.expired.append(slot)
+					slots0[index] = Bucket(0)
+				self.current += 1
+
+			if self.current & mask0 == 0:
+				self.cascade()
+
+
+	def takeEntries(self, slot, ret, limit):
+		'''
+		Move entries from slot to ret, until ret has limit entries.
+
+		:param slot: the bucket
+		:param ret: list of (key, status)
+		:param limit: the maximum length of ret, or None
+		'''
+		if limit is None or len(slot) <= limit - len(ret):
+			ret += [(key, status) for key, (timeout, status) in slot.items()]
+			self.takeSlot(slot)
+			return
+
+		location = self.location
+		while len(ret) < limit:
+			key, (timeout, status) = slot.popitem()
+			del location[key]
+			ret.append((key, status))
+
+
+	def takeSlot(self, slot):
+		for key in slot:
+			del self.location[key]
+		slot.clear()
+
+
+	def cascade(self):
+		'''
+		Move entries down from the higher-level slots that the wheel has
+		just reached.
+		'''
+		for level in range(1, len(self.levels)):
+			index = (self.current >> self.shifts[level]) & self.masks[level]
+			self.redistribute(self.levels[level][index])
+
+			#Higher levels only move on when this level wraps around:
+			if index != 0:
+				return
+
+		self.redistribute(self.overflow)
+
+
+	def redistribute(self, slot):
+		if not slot:
+			return
+		entries = list(slot.items())
+		self.takeSlot(slot)
+		if slot.level is not None:
+			self.levelCounts[slot.level] -= len(entries)
+		for key, (timeout, status) in entries:
+			self.add(timeout, key, status)
+
+
+	def getNextTimeout(self):
+		expired = [slot for slot in self.expired if slot]
+		if self.due:
+			expired.append(self.due)
+		if expired:
+			return min(
+				timeout
+				for slot in expired
+				for timeout, status in slot.values()
+				)
+
+		current = self.current
+		for level, slots in enumerate(self.levels):
+			if self.levelCounts[level] == 0:
+				continue
+			shift = self.shifts[level]
+			base = (current >> self.shifts[level + 1]) << self.shifts[level + 1]
+			for index in range((current >> shift) & self.masks[level], len(slots)):
+				if slots[index]:
+					#On level 0, this is where the bucket expires;
+					#on higher levels, nothing expires before this.
+					return base + (index << shift) + 1
+
+		if self.overflow:
+			top = self.shifts[-1]
+			return ((current >> top) + 1 << top) + 1
+
+		return None
@@ -15,39 +15,136 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
-from functools import reduce
+import collections
 
 
 
-class Struct:
-	def __init__(self, **kwargs):
-		self.__elementNames = [e for e in dir(self) if not e.startswith('__')]
-		for k in kwargs:
-			if k not in self.__elementNames:
-				raise KeyError('Key %s not in Struct' % k)
-			self.__dict__[k] = kwargs[k]
+class StructMeta(type):
+	'''
+	Metaclass of Struct.
 
+	When a Struct subclass is defined, its non-method class attributes
+	(including those of Struct base classes) become its fields, with the
+	class attribute values as defaults. The class gets __slots__ for these
+	fields, and __init__, __eq__ and __repr__ methods that are generated
+	once, for exactly these fields.
+	'''
+
+	def __new__(metacls, name, bases, namespace):
+		inherited = {}
+		for base in reversed(bases):
+			inherited.update(getattr(base, '_defaults', {}))
+
+		ownFields = \
+		[
+		k for k, v in namespace.items()
+		if not k.startswith('__') and not callable(v) and \
+			not isinstance(v, (property, staticmethod, classmethod))
+		]
+
+		defaults = dict(inherited)
+		for k in ownFields:
+			defaults[k] = namespace.pop(k)
+
+		namespace['_defaults'] = defaults
+		namespace['__slots__'] = tuple(k for k in ownFields if k not in inherited)
+
+		source = metacls.generateSource(list(defaults.keys()))
+		environment = {'_defaults': defaults}
+		exec(source, environment)
+		for method in ('__init__', '__eq__', '__repr__'):
+			if method not in namespace:
+				namespace[method] = environment[method]
+
+		return type.__new__(metacls, name, bases, namespace)
+
+
+	@staticmethod
+	def generateSource(fields):
+		'''
+		:param fields: list of field names
+
+		:returns: source code of __init__, __eq__ and __repr__
+		'''
+		lines = []
+
+		#Keyword-only; unknown keywords end up in kwargs:
+		lines.append('def __init__(self, %s**kwargs):' % \
+			''.join(['*, '] * bool(fields) + ['%s=_defaults[%r], ' % (k, k) for k in fields]))
+		lines.append('\tif kwargs:')
+		lines.append('\t\traise KeyError(\'Key %s not in Struct\' % next(iter(kwargs)))')
+		lines += ['\tself.%s = %s' % (k, k) for k in fields]
+
+		lines.append('def __eq__(self, obj):')
+		lines.append('\treturn obj.__class__ is self.__class__' + \
+			''.join(' and self.%s == obj.%s' % (k, k) for k in fields))
+
+		lines.append('def __repr__(self):')
+		lines.append('\treturn \'%%s(%s)\' %% (self.__class__.__name__%s)' % (
+			', '.join('%s=%%r' % k for k in fields),
+			''.join(', self.%s' % k for k in fields)
+			))
+
+		return '\n'.join(lines) + '\n'
+
+
+
+class Struct(metaclass=StructMeta):
+	'''
+	Base class for simple data structures. Class attributes of subclasses
+	define the fields and their default values; instances are constructed
+	with keyword arguments, and unknown keywords raise KeyError.
+	'''
 
 	def __str__(self):
 		return self.__repr__()
 
-	def __repr__(self):
-		return '%s(%s)' % (
-			self.__class__.__name__,
-			', '.join([
-				'%s=%s' % (k, repr(getattr(self, k)))
-				for k in self.__elementNames
-				])
-			)
-
-
-	def __eq__(self, obj):
-		return obj.__class__ == self.__class__ and \
-			reduce(lambda x,y: x and y,
-				[
-				getattr(self, k) == getattr(obj, k)
-				for k in self.__elementNames
-				])
+
+
+class LRUCache:
+	'''
+	Dict-like cache with a maximum size; when it is full, the least
+	recently used entry is removed.
+	'''
+
+	def __init__(self, maxSize):
+		'''
+		:param maxSize: the maximum number of entries
+		'''
+		self.maxSize = maxSize
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+
+	def __len__(self):
+		return len(self.entries)
+
+
+	def get(self, key, default=None):
+		'''
+		:returns: the value for key, or default if it is not in the cache
+		'''
+		try:
+			value = self.entries[key]
+		except KeyError:
+			self.misses += 1
+			return default
+		self.entries.move_to_end(key)
+		self.hits += 1
+		return value
+
+
+	def put(self, key, value):
+		self.entries[key] = value
+		self.entries.move_to_end(key)
+		if len(self.entries) > self.maxSize:
+			self.entries.popitem(last=False)
+
+
+	def clear(self):
+		self.entries.clear()
+
 
 
 class Enum(set):
@@ -9,7 +9,10 @@ setup(
 	install_requires=[
 		"websockets>=8.1",
 		"protobuf>=3.6.1",
-		"secp256k1>=0.13.2",
+		"secp256k1>=0.14.0",
 	],
-	extras_require={"testing": ["coverage>=4.5.2", "websocket-client>=0.53.0", "black"]},
+	extras_require={
+		"testing": ["coverage>=4.5.2", "websocket-client>=0.53.0", "black"],
+		"columnar": ["numpy"],
+	},
 )
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Throughput of complete payments (start, self-report, sender ack, claim)
+on the different back-ends, to show what durability costs.
+
+Usage: bench_backends.py [payments] (default: 2000)
+
+Signing by the simulated clients is included in all timings.
+'''
+
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import secp256k1
+
+sys.path.append('..')
+
+from bl4p_server import bl4p_backend
+from bl4p_server import journal
+from bl4p_server import sqlite_backend
+from bl4p_server.api import selfreport
+
+
+
+sha256 = lambda preimage: hashlib.sha256(preimage).digest()
+
+NUM_CLIENTS = 100 #concurrent clients in the group commit case
+
+receiverKey = secp256k1.PrivateKey(privkey=sha256(b'3'))
+senderKey = secp256k1.PrivateKey(privkey=sha256(b'6'))
+
+
+
+def sign(key, paymentHash):
+	report = selfreport.serialize(
+		{
+		'paymentHash': paymentHash.hex(),
+		'offerID': '42',
+		'receiverCryptoAmount': '6',
+		'cryptoCurrency': 'btc'
+		})
+	return report, key.ecdsa_serialize(key.ecdsa_sign(report))
+
+
+def addUsers(bl4p):
+	bl4p.addUser(bl4p_backend.User(id=3, balance=0, pubKey=receiverKey.pubkey.serialize()))
+	bl4p.addUser(bl4p_backend.User(id=6, balance=10**15, pubKey=senderKey.pubkey.serialize()))
+
+
+def payment(bl4p, sync=lambda: None):
+	'''
+	A complete payment; sync is called after every call,
+	before its result would be sent to the client.
+	'''
+	senderAmount, receiverAmount, paymentHash = \
+		bl4p.startTransaction(3, 1000, 60, 3600, True)
+	sync()
+	bl4p.processSelfReport(3, *sign(receiverKey, paymentHash))
+	sync()
+	preimage = bl4p.processSenderAck(6, senderAmount, paymentHash, 3600, *sign(senderKey, paymentHash))
+	sync()
+	bl4p.processReceiverClaim(preimage)
+	sync()
+
+
+def run(name, numPayments, function):
+	t0 = time.perf_counter()
+	function(numPayments)
+	dt = time.perf_counter() - t0
+	print('%-36s %8.0f payments/s' % (name + ':', numPayments / dt))
+
+
+def main():
+	numPayments = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	print('%d payments' % numPayments)
+
+	with tempfile.TemporaryDirectory(dir='.') as directory:
+		def inMemory(n):
+			bl4p = bl4p_backend.BL4P()
+			addUsers(bl4p)
+			for i in range(n):
+				payment(bl4p)
+		run('in memory', numPayments, inMemory)
+
+		def journalSyncEach(n):
+			bl4p = bl4p_backend.BL4P()
+			addUsers(bl4p)
+			bl4p.setJournal(journal.Journal(os.path.join(directory, 'journal1')))
+			for i in range(n):
+				payment(bl4p, bl4p.journal.sync)
+			bl4p.journal.close()
+		run('journal, fsync per call', numPayments, journalSyncEach)
+
+		def journalGroupCommit(n):
+			loop = asyncio.new_event_loop()
+			asyncio.set_event_loop(loop)
+			bl4p = bl4p_backend.BL4P()
+			addUsers(bl4p)
+			bl4p.setJournal(journal.Journal(os.path.join(directory, 'journal2'), loop=loop))
+
+			@asyncio.coroutine
+			def client(count):
+				for i in range(count):
+					senderAmount, receiverAmount, paymentHash = \
+						bl4p.startTransaction(3, 1000, 60, 3600, True)
+					yield from bl4p.journal.waitDurable()
+					bl4p.processSelfReport(3, *sign(receiverKey, paymentHash))
+					yield from bl4p.journal.waitDurable()
+					preimage = bl4p.processSenderAck(6, senderAmount, paymentHash, 3600, *sign(senderKey, paymentHash))
+					yield from bl4p.journal.waitDurable()
+					bl4p.processReceiverClaim(preimage)
+					yield from bl4p.journal.waitDurable()
+
+			loop.run_until_complete(asyncio.gather(
+				*[client(n // NUM_CLIENTS) for c in range(NUM_CLIENTS)]
+				))
+			bl4p.journal.close()
+			loop.close()
+		run('journal, group commit (%d clients)' % NUM_CLIENTS,
+			numPayments // NUM_CLIENTS * NUM_CLIENTS, journalGroupCommit)
+
+		for synchronous in ('NORMAL', 'FULL'):
+			def sqlite(n):
+				bl4p = sqlite_backend.SQLiteBL4P(
+					os.path.join(directory, 'bl4p-%s.sqlite' % synchronous), synchronous)
+				addUsers(bl4p)
+				for i in range(n):
+					payment(bl4p)
+				bl4p.close()
+			run('SQLite, synchronous=' + synchronous, numPayments, sqlite)
+
+
+
+if __name__ == '__main__':
+	main()
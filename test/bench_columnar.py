@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Memory use and query speed of dict versus columnar transaction storage.
+
+Usage: bench_columnar.py [transactions] (default: 1000000)
+'''
+
+import hashlib
+import sys
+import time
+import tracemalloc
+
+sys.path.append('..')
+
+from bl4p_server import bl4p_backend
+from bl4p_server import columnar
+
+
+
+sha256 = lambda preimage: hashlib.sha256(preimage).digest()
+
+START_TIME = time.time()
+
+statuses = ('waiting_for_sender', 'waiting_for_receiver', 'completed')
+
+
+
+def makeTransaction(i):
+	status = statuses[i % 3]
+	return bl4p_backend.Transaction(
+		sender_userid = None if status == 'waiting_for_sender' else i % 1000,
+		receiver_userid = (i * 7) % 1000,
+		amountIncoming = 1000 + i % 100,
+		amountOutgoing = 997 + i % 100,
+		preimage = i.to_bytes(32, 'little'),
+		senderTimeout = START_TIME + 3600 + i % 10000,
+		receiverTimeout = START_TIME + 7200 + i % 10000,
+		status = status,
+		)
+
+
+def fill(transactions, numTransactions):
+	for i in range(numTransactions):
+		transactions[sha256(i.to_bytes(32, 'little'))] = makeTransaction(i)
+	return transactions
+
+
+def timed(name, function, *args):
+	t0 = time.perf_counter()
+	ret = function(*args)
+	print('%-36s %8.3f s' % (name + ':', time.perf_counter() - t0))
+	return ret
+
+
+def measure(name, storage, numTransactions):
+	tracemalloc.start()
+	transactions = fill(storage, numTransactions)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	print('%-36s %8.0f bytes/transaction' % (name + ' memory:', size / numTransactions))
+
+	bl4p = bl4p_backend.BL4P(columnar=not isinstance(storage, dict))
+	bl4p.transactions = transactions
+	#A realistic sweep finds few expired transactions:
+	t = START_TIME + 3600 + 10
+	expired = timed(name + ' time-out sweep', lambda:
+		[
+		paymentHash
+		for paymentHash, tx in transactions.items()
+		if (tx.status == 'waiting_for_sender' and tx.senderTimeout <= t) or \
+			(tx.status == 'waiting_for_receiver' and tx.receiverTimeout <= t)
+		]) if isinstance(storage, dict) else \
+		timed(name + ' time-out sweep', transactions.getExpired, t)
+	locked = timed(name + ' locked funds', bl4p.getLockedFunds)
+	return len(expired), locked
+
+
+def main():
+	numTransactions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	print('%d transactions' % numTransactions)
+
+	dictResults = measure('dict', bl4p_backend.TransactionDict(), numTransactions)
+	columnarResults = measure('columnar', columnar.TransactionTable(), numTransactions)
+	assert dictResults == columnarResults
+
+
+
+if __name__ == '__main__':
+	main()
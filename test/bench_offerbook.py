@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Cost of OfferBook.findOffers, compared to a scan of all offers.
+
+The book contains offers in a number of currency pairs, with random
+limit rates and condition ranges. With wide locked time-out ranges, most
+offers match a query's range; with narrow ones, most don't.
+Each is measured without and with columnar offer storage (requires NumPy).
+
+Usage: bench_offerbook.py [offers] [pairs] (default: 100000 10)
+'''
+
+import random
+import sys
+import time
+
+sys.path.append('..')
+
+from bl4p_server import offerbook_backend
+from bl4p_server.api.offer import Offer, Asset
+
+
+
+def makeOffer(rng, pair, reverse=False, lockedWidth=100000):
+	bidCurrency, askCurrency = pair
+	if reverse:
+		bidCurrency, askCurrency = askCurrency, bidCurrency
+	bidExchange = 'ln' if bidCurrency == 'btc' else 'bl3p.eu'
+	askExchange = 'ln' if askCurrency == 'btc' else 'bl3p.eu'
+
+	lockedMin = rng.randint(0, 1000000)
+	return Offer(
+		bid=Asset(rng.randint(1, 10**8), 10**rng.randint(0, 8), bidCurrency, bidExchange),
+		ask=Asset(rng.randint(1, 10**8), 10**rng.randint(0, 8), askCurrency, askExchange),
+		address='',
+		ID=0,
+		cltv_expiry_delta=(rng.randint(0, 100), rng.randint(100, 200)),
+		locked_timeout=(lockedMin, lockedMin + rng.randint(0, lockedWidth)),
+		)
+
+
+def scan(offers, query):
+	'The original implementation, for reference'
+	return [o for o in offers if query.matches(o)]
+
+
+def measure(n, numPairs, lockedWidth, columnar):
+	numQueries = 20
+	print('%d offers in %d pairs, %d queries, locked time-out ranges up to %d wide%s' % \
+		(n, numPairs, numQueries, lockedWidth, ', columnar' if columnar else ''))
+
+	rng = random.Random(0)
+	pairs = [('btc', 'eur')] + [('btc', 'cur%d' % i) for i in range(numPairs - 1)]
+	offers = [makeOffer(rng, rng.choice(pairs), lockedWidth=lockedWidth) for i in range(n)]
+	queries = [makeOffer(rng, pairs[0], reverse=True, lockedWidth=lockedWidth) for i in range(numQueries)]
+
+	book = offerbook_backend.OfferBook(columnar=columnar)
+	t0 = time.perf_counter()
+	IDs = [(i % 100, book.addOffer(i % 100, offer)) for i, offer in enumerate(offers)]
+	dt = time.perf_counter() - t0
+	print('%-24s %10.3f us per offer' % ('OfferBook.addOffer:', 1e6 * dt / n))
+
+	t0 = time.perf_counter()
+	expected = [scan(offers, q) for q in queries]
+	dt = time.perf_counter() - t0
+	print('%-24s %10.3f ms per query' % ('scan:', 1e3 * dt / numQueries))
+
+	t0 = time.perf_counter()
+	results = [book.findOffers(q) for q in queries]
+	dt = time.perf_counter() - t0
+	print('%-24s %10.3f ms per query' % ('OfferBook.findOffers:', 1e3 * dt / numQueries))
+
+	sortKey = lambda o: o.toPB2().SerializeToString()
+	for e, r in zip(expected, results):
+		assert sorted(e, key=sortKey) == sorted(r, key=sortKey)
+	print('%-24s %10.1f' % ('matches per query:', sum(len(r) for r in results) / numQueries))
+
+	t0 = time.perf_counter()
+	for userID, offerID in IDs:
+		book.removeOffer(userID, offerID)
+	dt = time.perf_counter() - t0
+	print('%-24s %10.3f us per offer' % ('OfferBook.removeOffer:', 1e6 * dt / n))
+
+
+def main():
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	numPairs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+	for columnar in (False, True):
+		measure(n, numPairs, 1000000, columnar)
+		print()
+		measure(n, numPairs, 10000, columnar)
+		print()
+
+
+
+if __name__ == '__main__':
+	main()
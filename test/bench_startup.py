@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmark of BL4P start-up from a snapshot plus journal tail.
+
+Usage: bench_startup.py [users [open transactions [journal records]]]
+(default: 10000000 1000000 100000)
+'''
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import secp256k1
+
+sys.path.append('..')
+
+from bl4p_server import bl4p_backend
+from bl4p_server import journal
+from bl4p_server import snapshot
+
+
+
+sha256 = lambda preimage: hashlib.sha256(preimage).digest()
+
+START_TIME = time.time()
+
+
+
+class BenchUser:
+	__slots__ = ('id', 'balance', 'pubKey')
+
+	def __init__(self, id, balance, pubKey):
+		self.id, self.balance, self.pubKey = id, balance, pubKey
+
+
+class BenchTransaction:
+	__slots__ = ('sender_userid', 'receiver_userid', 'amountIncoming', 'amountOutgoing',
+		'preimage', 'senderTimeout', 'receiverTimeout', 'status')
+
+	def __init__(self, i, numUsers):
+		self.sender_userid = None if i % 2 else (i * 7) % numUsers
+		self.receiver_userid = i % numUsers
+		self.amountIncoming = 1000
+		self.amountOutgoing = 997
+		self.preimage = i.to_bytes(32, 'little')
+		self.senderTimeout = START_TIME + 3600 + i % 1000
+		self.receiverTimeout = START_TIME + 7200 + i % 1000
+		self.status = 'waiting_for_sender' if i % 2 else 'waiting_for_receiver'
+
+
+
+def timed(name, function, *args):
+	t0 = time.perf_counter()
+	ret = function(*args)
+	print('%-28s %8.3f s' % (name + ':', time.perf_counter() - t0))
+	return ret
+
+
+def main():
+	numUsers, numTransactions, numRecords = \
+		[int(x) for x in sys.argv[1:]] + [10000000, 1000000, 100000][len(sys.argv) - 1:]
+	print('%d users, %d open transactions, %d journal records after the snapshot' % \
+		(numUsers, numTransactions, numRecords))
+
+	#A few distinct keys are enough for timing purposes:
+	keys = [secp256k1.PrivateKey(privkey=sha256(bytes([i]))).pubkey.serialize() for i in range(16)]
+
+	with tempfile.TemporaryDirectory() as directory:
+		snapshotFile = os.path.join(directory, 'snapshot')
+		journalFile = os.path.join(directory, 'journal')
+
+		users = [BenchUser(i, 10**9, keys[i % 16]) for i in range(numUsers)]
+		transactions = \
+		{
+		sha256(i.to_bytes(32, 'little')): BenchTransaction(i, numUsers)
+		for i in range(numTransactions)
+		}
+		timed('write snapshot', snapshot.write, snapshotFile, 1, users, transactions)
+		print('%-28s %8.1f MB' % ('snapshot size:', os.path.getsize(snapshotFile) / 1e6))
+		del users, transactions
+
+		j = journal.Journal(journalFile)
+		j.rotate()
+		for i in range(numTransactions, numTransactions + numRecords // 2):
+			preimage = i.to_bytes(32, 'little')
+			paymentHash = sha256(preimage)
+			j.append(journal.encodeStart(paymentHash, preimage, i % numUsers,
+				1000, 997, START_TIME + 3600, START_TIME + 7200))
+			j.append(journal.encode(journal.SELFREPORT, paymentHash))
+		j.close()
+
+		t0 = time.perf_counter()
+		bl4p = bl4p_backend.BL4P()
+		generation = timed('load snapshot', snapshot.load, bl4p, snapshotFile)
+		timed('replay journal tail', bl4p.setJournal, journal.Journal(journalFile), generation)
+		print('%-28s %8.3f s' % ('total start-up:', time.perf_counter() - t0))
+
+		#Pause of the server process when a snapshot is started:
+		t0 = time.perf_counter()
+		pid = os.fork()
+		if pid == 0:
+			os._exit(0)
+		print('%-28s %8.3f s' % ('fork pause:', time.perf_counter() - t0))
+		os.waitpid(pid, 0)
+
+		bl4p.journal.close()
+
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Construction cost, comparison cost and per-instance memory of
+utils.Struct, compared to the original dir()-based implementation.
+
+Usage: bench_struct.py [instances] (default: 100000)
+'''
+
+from functools import reduce
+import sys
+import time
+import tracemalloc
+
+sys.path.append('..')
+
+from bl4p_server import utils
+
+
+
+class DirStruct:
+	'The original Struct implementation, for reference'
+
+	def __init__(self, **kwargs):
+		self.__elementNames = [e for e in dir(self) if not e.startswith('__')]
+		for k in kwargs:
+			if k not in self.__elementNames:
+				raise KeyError('Key %s not in Struct' % k)
+			self.__dict__[k] = kwargs[k]
+
+
+	def __eq__(self, obj):
+		return obj.__class__ == self.__class__ and \
+			reduce(lambda x,y: x and y,
+				[
+				getattr(self, k) == getattr(obj, k)
+				for k in self.__elementNames
+				])
+
+
+def makeTransactionClass(base):
+	class Transaction(base):
+		sender_userid = None
+		receiver_userid = None
+		amountIncoming = 0
+		amountOutgoing = 0
+		preimage = None
+		senderTimeout = None
+		receiverTimeout = None
+		status = None
+
+	return Transaction
+
+
+def construct(cls, n):
+	return \
+	[
+	cls(
+		receiver_userid = 3,
+		amountIncoming = 1000,
+		amountOutgoing = 997,
+		preimage = bytes(32),
+		senderTimeout = 1.0,
+		receiverTimeout = 2.0,
+		status = 'waiting_for_selfreport',
+		)
+	for i in range(n)
+	]
+
+
+def measure(name, cls, n):
+	t0 = time.perf_counter()
+	construct(cls, n)
+	dt = time.perf_counter() - t0
+	print('%-32s %8.2f us' % (name + ' construction:', 1e6 * dt / n))
+
+	tracemalloc.start()
+	instances = construct(cls, n)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	print('%-32s %8.0f bytes' % (name + ' memory per instance:', size / n))
+
+	t0 = time.perf_counter()
+	for x in instances:
+		x == instances[0]
+	dt = time.perf_counter() - t0
+	print('%-32s %8.2f us' % (name + ' comparison:', 1e6 * dt / n))
+
+
+def main():
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	print('%d instances' % n)
+
+	measure('original', makeTransactionClass(DirStruct), n)
+	measure('utils.Struct', makeTransactionClass(utils.Struct), n)
+
+
+
+if __name__ == '__main__':
+	main()
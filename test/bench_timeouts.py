@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmark of the time-out indices: heap versus timing wheel.
+
+Deadlines arrive in bursts that share nearly the same time-out, like
+sender time-outs of Lightning-facing traffic.
+Time is simulated; expiry is done in one-second steps.
+'''
+
+import gc
+import random
+import sys
+import time
+
+sys.path.append('..')
+
+from bl4p_server import timeouts
+
+
+
+NUM_DEADLINES = 1000000
+BURST_SIZE = 1000
+BURST_EXPIRED = 100000
+EXPIRY_BATCH_SIZE = 100
+CANCEL_FRACTION = 0.9 #most transactions complete before they time out
+START_TIME = 1600000000.0
+
+
+
+def makeDeadlines():
+	rng = random.Random(1)
+	ret = []
+	for burst in range(NUM_DEADLINES // BURST_SIZE):
+		base = START_TIME + rng.uniform(1, 3600)
+		for i in range(BURST_SIZE):
+			ret.append((base + rng.uniform(0, 0.5), len(ret).to_bytes(32, 'little')))
+	return ret
+
+
+def run(name, index, live, deadlines):
+	t0 = time.perf_counter()
+	for timeout, key in deadlines:
+		live[key] = 's'
+		index.add(timeout, key, 's')
+	t1 = time.perf_counter()
+
+	for timeout, key in deadlines[:int(CANCEL_FRACTION * len(deadlines))]:
+		del live[key]
+		index.remove(key)
+	t2 = time.perf_counter()
+
+	numExpired = 0
+	now = START_TIME
+	while index.getNextTimeout() is not None:
+		now += 1.0
+		numExpired += len(index.popExpired(now))
+	t3 = time.perf_counter()
+
+	print('%-6s add: %6.3f s   cancel: %6.3f s   expire (%d): %6.3f s   total: %6.3f s' % \
+		(name, t1 - t0, t2 - t1, numExpired, t3 - t2, t3 - t0))
+
+
+def burst(name, index, live):
+	'''
+	Time the first popExpired call after a burst of BURST_EXPIRED
+	time-outs has expired, with and without a limit.
+	'''
+	for limit in (None, EXPIRY_BATCH_SIZE):
+		for i in range(BURST_EXPIRED):
+			key = i.to_bytes(32, 'little')
+			live[key] = 's'
+			index.add(START_TIME + 0.5, key, 's')
+
+		gc.collect()
+		t0 = time.perf_counter()
+		expired = index.popExpired(START_TIME + 1.0, limit)
+		t1 = time.perf_counter()
+
+		print('%-6s first popExpired after %d expired, limit %s: %d entries in %.6f s' % \
+			(name, BURST_EXPIRED, limit, len(expired), t1 - t0))
+
+		#Also empty the index:
+		expired += index.popExpired(START_TIME + 1.0)
+		for key, status in expired:
+			del live[key]
+		del expired #don't let the next measurement include freeing it
+
+
+def main():
+	deadlines = makeDeadlines()
+	print('%d pending deadlines in bursts of %d; %d%% canceled' % \
+		(NUM_DEADLINES, BURST_SIZE, int(100 * CANCEL_FRACTION)))
+
+	live = {}
+	isValid = lambda key, status: live.get(key) == status
+	run('heap', timeouts.TimeoutHeap(isValid), live, deadlines)
+
+	live = {}
+	run('wheel', timeouts.TimingWheel(START_TIME), live, deadlines)
+
+	live = {}
+	burst('heap', timeouts.TimeoutHeap(isValid), live)
+	live = {}
+	burst('wheel', timeouts.TimingWheel(START_TIME), live)
+
+
+
+if __name__ == '__main__':
+	main()
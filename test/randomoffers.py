@@ -0,0 +1,57 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Random offer data, shared by the offer tests.
+
+The values include the edge cases of the limit rate: zero amounts and
+divisors, and amounts up to the uint64 maximum. With extremes, the
+uint64 maximum and the value just below it are explicit choices too.
+'''
+
+import sys
+
+sys.path.append('..')
+
+from bl4p_server.api.offer import Asset
+
+
+
+def randomAmount(rng, extremes=False):
+	choices = [0, 1, rng.randint(1, 1000), rng.randint(1, 2**64 - 1)]
+	if extremes:
+		choices += [2**64 - 1, 2**64 - 2]
+	return rng.choice(choices)
+
+
+def randomDivisor(rng, extremes=False):
+	choices = [0, 1, 10**rng.randint(1, 19)]
+	if extremes:
+		choices += [2**64 - 1, 2**64 - 2]
+	return rng.choice(choices)
+
+
+def randomAsset(rng, currency, exchange, extremes=False):
+	'''
+	:param rng: random.Random object
+	:param currency: the currency of the asset
+	:param exchange: the exchange of the asset
+	:param extremes: also choose amounts and divisors at the uint64 maximum
+
+	:returns: an Asset with a random amount and divisor
+	'''
+	return Asset(randomAmount(rng, extremes), randomDivisor(rng, extremes), currency, exchange)
@@ -0,0 +1,162 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('..')
+
+from bl4p_server import archive
+from bl4p_server.bl4p_backend import Transaction
+
+
+
+sha256 = lambda preimage: hashlib.sha256(preimage).digest()
+
+
+
+def makeTransaction(i):
+	return Transaction(
+		sender_userid = None if i % 3 == 0 else i,
+		receiver_userid = 1000 + i,
+		amountIncoming = 2**40 + i,
+		amountOutgoing = i,
+		preimage = b'secret',
+		senderTimeout = 1600000000.25 + i,
+		receiverTimeout = 1600000100.5 + i,
+		status = archive.TransactionArchive.statuses[i % 4],
+		)
+
+
+def expectedFields(i):
+	tx = makeTransaction(i)
+	return \
+	{
+	'sender_userid'  : tx.sender_userid,
+	'receiver_userid': tx.receiver_userid,
+	'amountIncoming' : tx.amountIncoming,
+	'amountOutgoing' : tx.amountOutgoing,
+	'senderTimeout'  : tx.senderTimeout,
+	'receiverTimeout': tx.receiverTimeout,
+	'status'         : tx.status,
+	}
+
+
+
+class TestTransactionArchive(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.filename = os.path.join(self.directory.name, 'archive')
+
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+
+	def test_addGet(self):
+		a = archive.TransactionArchive(self.filename, cacheSize=10, minIndexSize=4)
+
+		for i in range(100):
+			a.add(sha256(bytes([i])), makeTransaction(i))
+		self.assertEqual(len(a.cache), 10)
+		self.assertTrue(a.indexCapacity >= 200)
+
+		#Both cached and uncached:
+		for i in range(100):
+			self.assertEqual(a.get(sha256(bytes([i]))), expectedFields(i))
+		self.assertEqual(a.get(sha256(b'foo')), None)
+
+		#Reopening:
+		a.close()
+		a = archive.TransactionArchive(self.filename, cacheSize=10, minIndexSize=4)
+		self.assertEqual(a.numRecords, 100)
+		for i in range(100):
+			self.assertEqual(a.get(sha256(bytes([i]))), expectedFields(i))
+		a.close()
+
+		#The preimage is not archived:
+		with open(self.filename, 'rb') as f:
+			self.assertFalse(b'secret' in f.read())
+
+
+	def test_indexGrowth(self):
+		a = archive.TransactionArchive(self.filename, cacheSize=1, minIndexSize=4)
+		a.indexGrowthStep = 3
+
+		numGrowing = 0
+		for i in range(100):
+			a.add(sha256(bytes([i])), makeTransaction(i))
+			if a.newIndex is not None:
+				#Each add copies at most indexGrowthStep records:
+				numGrowing += 1
+				self.assertTrue(a.numMigrated <= 3 * numGrowing)
+			else:
+				numGrowing = 0
+			self.assertTrue(a.numRecords < a.indexCapacity) #Never full
+
+			#All records can be found, also while the index grows:
+			for j in range(i + 1):
+				self.assertEqual(a.get(sha256(bytes([j]))), expectedFields(j))
+
+		#Growth is finished when closing:
+		while a.newIndex is None:
+			a.add(sha256(bytes([a.numRecords])), makeTransaction(a.numRecords))
+		n = a.numRecords
+		a.close()
+		a = archive.TransactionArchive(self.filename, cacheSize=1, minIndexSize=4)
+		self.assertEqual(a.indexHeader.unpack_from(a.index, 0)[0], n)
+		self.assertTrue(a.indexCapacity >= 4 * n)
+		for i in range(n):
+			self.assertEqual(a.get(sha256(bytes([i]))), expectedFields(i))
+		a.close()
+
+
+	def test_recovery(self):
+		a = archive.TransactionArchive(self.filename)
+		for i in range(10):
+			a.add(sha256(bytes([i])), makeTransaction(i))
+		a.close()
+
+		#Incomplete record at the end:
+		with open(self.filename, 'ab') as f:
+			f.write(b'x' * 10)
+
+		#Index is missing:
+		os.remove(self.filename + '.index')
+
+		a = archive.TransactionArchive(self.filename)
+		self.assertEqual(a.numRecords, 10)
+		self.assertEqual(os.path.getsize(self.filename), 10 * a.record.size)
+		for i in range(10):
+			self.assertEqual(a.get(sha256(bytes([i]))), expectedFields(i))
+
+		#Index is outdated:
+		a.indexHeader.pack_into(a.index, 0, 5)
+		a.close()
+		a = archive.TransactionArchive(self.filename)
+		self.assertEqual(a.indexHeader.unpack_from(a.index, 0)[0], 10)
+		for i in range(10):
+			self.assertEqual(a.get(sha256(bytes([i]))), expectedFields(i))
+		a.close()
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
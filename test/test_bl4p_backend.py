@@ -15,17 +15,25 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import concurrent.futures
 import decimal
 import hashlib
+import os
 import sys
+import tempfile
 import time
 import unittest
+from unittest.mock import Mock, patch
 
 import secp256k1
 
 sys.path.append('..')
 
 from bl4p_server import bl4p_backend
+from bl4p_server import archive as bl4p_archive
+from bl4p_server import journal as bl4p_journal
+from bl4p_server import signatures
 from bl4p_server.api import selfreport
 
 
@@ -48,8 +56,8 @@ class TestBL4P(unittest.TestCase):
 		self.bl4p = bl4p_backend.BL4P()
 		self.bl4p.fee_base = 1
 		self.bl4p.fee_rate = 0
-		self.bl4p.users[self.senderID]   = bl4p_backend.User(id=self.senderID  , balance=0, pubKey=self.senderKey.pubkey  )
-		self.bl4p.users[self.receiverID] = bl4p_backend.User(id=self.receiverID, balance=0, pubKey=self.receiverKey.pubkey)
+		self.bl4p.users[self.senderID]   = bl4p_backend.User(id=self.senderID  , balance=0, pubKey=self.senderKey.pubkey.serialize()  )
+		self.bl4p.users[self.receiverID] = bl4p_backend.User(id=self.receiverID, balance=0, pubKey=self.receiverKey.pubkey.serialize())
 
 
 	def setBalance(self, userID, balance):
@@ -59,8 +67,11 @@ class TestBL4P(unittest.TestCase):
 		return self.bl4p.users[userID].balance
 
 
+	def getTransaction(self, paymentHash):
+		return self.bl4p.transactions[paymentHash]
+
 	def getTransactionStatus(self, paymentHash):
-		return self.bl4p.transactions[paymentHash].status
+		return self.getTransaction(paymentHash).status
 
 
 	def bl4p_startTransaction(self, amount=100, senderTimeout=5, lockedTimeout=5000, receiverPaysFee=True):
@@ -570,13 +581,13 @@ class TestBL4P(unittest.TestCase):
 
 		data = self.bl4p_startTransaction()
 		self.bl4p_processSelfReport(data)
-		data.paymentPreimage = self.bl4p.transactions[data.paymentHash].preimage
+		data.paymentPreimage = self.getTransaction(data.paymentHash).preimage
 		with self.assertRaises(self.bl4p.TransactionNotFound):
 			self.bl4p_processReceiverClaim(data)
 
 		data = self.bl4p_startTransaction(senderTimeout=0.01)
 		self.bl4p_processSelfReport(data)
-		data.paymentPreimage = self.bl4p.transactions[data.paymentHash].preimage
+		data.paymentPreimage = self.getTransaction(data.paymentHash).preimage
 		time.sleep(0.1)
 		self.bl4p.processTimeouts()
 		with self.assertRaises(self.bl4p.TransactionNotFound):
@@ -688,6 +699,620 @@ class TestBL4P(unittest.TestCase):
 		self.assertEqual(statusBefore, statusAfter)
 
 
+	def test_timeoutQueue(self):
+		self.setBalance(self.senderID, 500)
+		self.setBalance(self.receiverID, 200)
+		timeouts = self.bl4p.timeouts
+
+		#No queue entry before self-reporting:
+		data1 = self.bl4p_startTransaction()
+		self.assertEqual(timeouts.queue, [])
+
+		self.bl4p_processSelfReport(data1)
+		self.assertEqual(len(timeouts.queue), 1)
+		self.assertEqual(timeouts.numStale, 0)
+
+		#Sender ack replaces the sender time-out by the receiver time-out.
+		#Stale entries are removed once they dominate the queue:
+		self.bl4p_processSenderAck(data1)
+		tx = self.bl4p.transactions[data1.paymentHash]
+		self.assertEqual(timeouts.queue,
+			[(tx.receiverTimeout, data1.paymentHash, 'waiting_for_receiver')])
+		self.assertEqual(timeouts.numStale, 0)
+
+		self.bl4p_processReceiverClaim(data1)
+		self.assertEqual(timeouts.queue, [])
+		self.assertEqual(timeouts.numStale, 0)
+
+		#Stale entries on top of the queue don't affect the result:
+		data2 = self.bl4p_startTransaction(senderTimeout=1)
+		data3 = self.bl4p_startTransaction(senderTimeout=3)
+		self.bl4p_processSelfReport(data2)
+		self.bl4p_processSelfReport(data3)
+		self.bl4p_cancelTransaction(data2)
+		self.assertEqual(len(timeouts.queue), 2)
+		self.assertEqual(timeouts.numStale, 1)
+		ret = self.bl4p.processTimeouts()
+		self.assertAlmostEqual(ret, 3, places=1)
+		self.assertEqual(timeouts.numStale, 0)
+		self.assertEqual(self.getTransactionStatus(data3.paymentHash), 'waiting_for_sender')
+
+
+	def test_timingWheel(self):
+		self.bl4p = bl4p_backend.BL4P(timingWheel=True)
+		self.bl4p.fee_base = 1
+		self.bl4p.fee_rate = 0
+		self.bl4p.minTimeBetweenTimeouts = 0.01
+		self.bl4p.users[self.senderID]   = bl4p_backend.User(id=self.senderID  , balance=500, pubKey=self.senderKey.pubkey.serialize()  )
+		self.bl4p.users[self.receiverID] = bl4p_backend.User(id=self.receiverID, balance=200, pubKey=self.receiverKey.pubkey.serialize())
+
+		data1 = self.bl4p_startTransaction(senderTimeout=0.01, lockedTimeout=0.02)
+		self.bl4p_processSelfReport(data1)
+		data2 = self.bl4p_startTransaction(senderTimeout=0.01, lockedTimeout=0.02)
+		self.bl4p_processSelfReport(data2)
+		self.bl4p_processSenderAck(data2)
+		data3 = self.bl4p_startTransaction(senderTimeout=0.01, lockedTimeout=0.02)
+		self.bl4p_processSelfReport(data3)
+		self.bl4p_cancelTransaction(data3)
+		self.assertEqual(self.getBalance(self.senderID), 400)
+
+		#Time-outs expire at the end of their one-second bucket:
+		tx = self.bl4p.transactions[data2.paymentHash]
+		ret = self.bl4p.processTimeouts()
+		self.assertAlmostEqual(ret, int(tx.receiverTimeout) + 1 - time.time(), places=1)
+
+		time.sleep(ret + 0.01)
+		self.assertEqual(self.bl4p.processTimeouts(), None)
+		self.assertEqual(self.getTransactionStatus(data1.paymentHash), 'sender_timeout')
+		self.assertEqual(self.getTransactionStatus(data2.paymentHash), 'receiver_timeout')
+		self.assertEqual(self.getTransactionStatus(data3.paymentHash), 'canceled')
+		self.assertEqual(self.getBalance(self.senderID), 500)
+
+
+	def test_scheduler(self):
+		self.setBalance(self.senderID, 500)
+		self.setBalance(self.receiverID, 200)
+		self.bl4p.minTimeBetweenTimeouts = 0.01
+
+		scheduler = Mock()
+		self.bl4p.setScheduler(scheduler)
+		scheduler.cancelDeadline.assert_called_once_with(self.bl4p)
+		scheduler.reset_mock()
+
+		data1 = self.bl4p_startTransaction(senderTimeout=2)
+		self.bl4p_processSelfReport(data1)
+		tx1 = self.getTransaction(data1.paymentHash)
+		scheduler.scheduleDeadline.assert_called_once_with(
+			self.bl4p, tx1.senderTimeout, self.bl4p.processScheduledTimeouts)
+		scheduler.reset_mock()
+
+		#Later time-outs don't change the schedule:
+		data2 = self.bl4p_startTransaction(senderTimeout=3)
+		self.bl4p_processSelfReport(data2)
+		scheduler.scheduleDeadline.assert_not_called()
+
+		#Earlier time-outs do:
+		data3 = self.bl4p_startTransaction(senderTimeout=0.05, lockedTimeout=0.1)
+		self.bl4p_processSelfReport(data3)
+		tx3 = self.getTransaction(data3.paymentHash)
+		scheduler.scheduleDeadline.assert_called_once_with(
+			self.bl4p, tx3.senderTimeout, self.bl4p.processScheduledTimeouts)
+		scheduler.reset_mock()
+
+		time.sleep(0.1)
+		self.bl4p.processTimeouts()
+		self.assertEqual(self.getTransactionStatus(data3.paymentHash), 'sender_timeout')
+		scheduler.scheduleDeadline.assert_called_once_with(
+			self.bl4p, tx1.senderTimeout, self.bl4p.processScheduledTimeouts)
+		scheduler.reset_mock()
+
+		self.bl4p_cancelTransaction(data1)
+		self.bl4p_cancelTransaction(data2)
+		self.bl4p.processTimeouts()
+		scheduler.cancelDeadline.assert_called_once_with(self.bl4p)
+
+
+	def test_timeoutBacklog(self):
+		self.setBalance(self.senderID, 500)
+		self.setBalance(self.receiverID, 200)
+		self.bl4p.minTimeBetweenTimeouts = 0.01
+
+		senderTimeouts = []
+		for i in range(5):
+			data = self.bl4p_startTransaction(senderTimeout=0.01)
+			self.bl4p_processSelfReport(data)
+			senderTimeouts.append(data)
+
+		receiverTimeouts = []
+		for i in range(2):
+			data = self.bl4p_startTransaction(senderTimeout=0.01, lockedTimeout=0.02)
+			self.bl4p_processSelfReport(data)
+			self.bl4p_processSenderAck(data)
+			receiverTimeouts.append(data)
+		self.assertEqual(self.getBalance(self.senderID), 300)
+
+		time.sleep(0.05)
+
+		#Process one time-out per call:
+		self.bl4p.timeoutTimeBudget = 0.0
+		self.assertEqual(self.bl4p.processTimeouts(), 0.0)
+		self.assertEqual(self.bl4p.getTimeoutBacklogSize(), 6)
+		self.assertEqual(self.getTransactionStatus(senderTimeouts[0].paymentHash), 'sender_timeout')
+		self.assertEqual(self.getTransactionStatus(senderTimeouts[1].paymentHash), 'waiting_for_sender')
+
+		#A claim after the time-out fails, even if the time-out is not yet processed:
+		data = receiverTimeouts[1]
+		with self.assertRaises(self.bl4p.TransactionNotFound):
+			self.bl4p_processReceiverClaim(data)
+		self.assertEqual(self.getTransactionStatus(data.paymentHash), 'receiver_timeout')
+		self.assertEqual(self.bl4p.getTimeoutBacklogSize(), 5)
+		self.assertEqual(self.getBalance(self.senderID), 400)
+		self.assertEqual(self.getBalance(self.receiverID), 200)
+
+		#The same for status requests and sender acks:
+		self.assertEqual(
+			self.bl4p.getTransactionStatus(self.receiverID, senderTimeouts[1].paymentHash),
+			'sender_timeout')
+		with self.assertRaises(self.bl4p.TransactionNotFound):
+			self.bl4p_processSenderAck(senderTimeouts[2])
+		self.assertEqual(self.bl4p.getTimeoutBacklogSize(), 3)
+
+		self.bl4p.timeoutTimeBudget = 1.0
+		self.assertEqual(self.bl4p.processTimeouts(), None)
+		self.assertEqual(self.bl4p.getTimeoutBacklogSize(), 0)
+		for data in senderTimeouts:
+			self.assertEqual(self.getTransactionStatus(data.paymentHash), 'sender_timeout')
+		for data in receiverTimeouts:
+			self.assertEqual(self.getTransactionStatus(data.paymentHash), 'receiver_timeout')
+		self.assertEqual(self.getBalance(self.senderID), 500)
+
+		#Time-outs that are not yet queued are expired on access as well:
+		data = self.bl4p_startTransaction(senderTimeout=0.01)
+		self.bl4p_processSelfReport(data)
+		time.sleep(0.02)
+		with self.assertRaises(self.bl4p.TransactionNotFound):
+			self.bl4p_cancelTransaction(data)
+		self.assertEqual(self.getTransactionStatus(data.paymentHash), 'sender_timeout')
+		self.assertEqual(self.bl4p.processTimeouts(), None)
+
+
+	def test_archive(self):
+		self.setBalance(self.senderID, 500)
+		self.setBalance(self.receiverID, 200)
+
+		with tempfile.TemporaryDirectory() as directory:
+			archive = bl4p_archive.TransactionArchive(os.path.join(directory, 'archive'))
+			self.bl4p.setArchive(archive, 0.3)
+
+			data1 = self.bl4p_startTransaction()
+			self.bl4p_processSelfReport(data1)
+			self.bl4p_processSenderAck(data1)
+			self.bl4p_processReceiverClaim(data1)
+
+			data2 = self.bl4p_startTransaction()
+			self.bl4p_cancelTransaction(data2)
+
+			data3 = self.bl4p_startTransaction(senderTimeout=0.2)
+			self.bl4p_processSelfReport(data3)
+
+			data4 = self.bl4p_startTransaction()
+
+			#t = 0.2: sender time-out of data3
+			self.assertAlmostEqual(self.bl4p.processTimeouts(), 0.2, places=1)
+			time.sleep(0.21)
+			self.assertAlmostEqual(self.bl4p.processTimeouts(), 0.1, places=1)
+			self.assertEqual(len(self.bl4p.transactions), 4)
+
+			#t = 0.3: archiving of data1 and data2
+			time.sleep(0.14)
+			self.assertAlmostEqual(self.bl4p.processTimeouts(), 0.15, places=1)
+			self.assertEqual(set(self.bl4p.transactions.keys()), {data3.paymentHash, data4.paymentHash})
+
+			#t = 0.5: archiving of data3
+			time.sleep(0.2)
+			self.assertEqual(self.bl4p.processTimeouts(), None)
+			self.assertEqual(set(self.bl4p.transactions.keys()), {data4.paymentHash})
+
+			#Status is still available, both from cache and from disk:
+			for i in range(2):
+				self.assertEqual(self.bl4p.getTransactionStatus(self.receiverID, data1.paymentHash), 'completed')
+				self.assertEqual(self.bl4p.getTransactionStatus(self.senderID, data1.paymentHash), 'completed')
+				self.assertEqual(self.bl4p.getTransactionStatus(self.receiverID, data2.paymentHash), 'canceled')
+				self.assertEqual(self.bl4p.getTransactionStatus(self.receiverID, data3.paymentHash), 'sender_timeout')
+				with self.assertRaises(self.bl4p.TransactionNotFound):
+					self.bl4p.getTransactionStatus(self.senderID, data2.paymentHash)
+				archive.cache.clear()
+
+			#Archived transactions can't be used anymore:
+			with self.assertRaises(self.bl4p.TransactionNotFound):
+				self.bl4p_processReceiverClaim(data1)
+			self.assertEqual(self.getBalance(self.receiverID), 200 + data1.receiverAmount)
+
+			archive.close()
+
+
+	def test_archiveFlush(self):
+		scheduler = Mock()
+		self.bl4p.setScheduler(scheduler)
+		loop = asyncio.new_event_loop()
+
+		with tempfile.TemporaryDirectory() as directory:
+			archive = bl4p_archive.TransactionArchive(os.path.join(directory, 'archive'), loop=loop)
+			self.bl4p.setArchive(archive, 0.0)
+
+			#Nothing to archive, nothing to flush:
+			with patch.object(archive, 'startFlush') as startFlush:
+				self.bl4p.processTimeouts()
+				startFlush.assert_not_called()
+
+			data1 = self.bl4p_startTransaction()
+			self.bl4p_cancelTransaction(data1)
+
+			#Transactions stay in memory until the flush is finished:
+			self.assertEqual(self.bl4p.processTimeouts(), None)
+			self.assertTrue(archive.flushing)
+			self.assertEqual(len(self.bl4p.transactions), 1)
+
+			#No new archiving during the flush:
+			data2 = self.bl4p_startTransaction()
+			self.bl4p_cancelTransaction(data2)
+			self.assertEqual(self.bl4p.processTimeouts(), None)
+			self.assertEqual(archive.numRecords, 1)
+
+			scheduler.reset_mock()
+			loop.run_until_complete(asyncio.sleep(0.1))
+			self.assertFalse(archive.flushing)
+			self.assertEqual(set(self.bl4p.transactions.keys()), {data2.paymentHash})
+			self.assertEqual(self.bl4p.getTransactionStatus(self.receiverID, data1.paymentHash), 'canceled')
+			scheduler.scheduleDeadline.assert_called_once_with(
+				self.bl4p, unittest.mock.ANY, self.bl4p.processScheduledTimeouts)
+
+			#A failed flush is retried later:
+			with patch.object(archive, 'flush', side_effect=OSError('(intended) test exception')):
+				self.bl4p.processTimeouts()
+				with self.assertLogs(level='ERROR'):
+					loop.run_until_complete(asyncio.sleep(0.1))
+			self.assertEqual(set(self.bl4p.transactions.keys()), {data2.paymentHash})
+			self.assertAlmostEqual(self.bl4p.archiveQueue[0][0], time.time(), places=1)
+			self.assertEqual(self.bl4p.archiveRetryDelay, 2 * self.bl4p.minTimeoutRetryDelay)
+
+			time.sleep(0.1)
+			self.bl4p.processTimeouts()
+			loop.run_until_complete(asyncio.sleep(0.1))
+			self.assertEqual(len(self.bl4p.transactions), 0)
+			self.assertEqual(self.bl4p.archiveRetryDelay, self.bl4p.minTimeoutRetryDelay)
+
+			archive.close()
+
+		loop.close()
+
+
+	def test_timeoutRetry(self):
+		scheduler = Mock()
+		self.bl4p.setScheduler(scheduler)
+		archive = Mock(flushing=False)
+		archive.add.side_effect = OSError('(intended) test exception')
+		archive.startFlush.side_effect = lambda callback: callback(None)
+		self.bl4p.setArchive(archive, 0.0)
+
+		data = self.bl4p_startTransaction()
+		self.bl4p_cancelTransaction(data)
+		scheduler.reset_mock()
+
+		#A failure is logged, and processing is retried later:
+		with self.assertLogs(level='ERROR'):
+			self.bl4p.processScheduledTimeouts()
+		key, deadline, function = scheduler.scheduleDeadline.call_args[0]
+		self.assertEqual(key, self.bl4p)
+		self.assertAlmostEqual(deadline, time.time() + 0.1, places=1)
+		self.assertEqual(function, self.bl4p.processScheduledTimeouts)
+		scheduler.reset_mock()
+
+		#Consecutive failures increase the delay:
+		with self.assertLogs(level='ERROR'):
+			self.bl4p.processScheduledTimeouts()
+		key, deadline, function = scheduler.scheduleDeadline.call_args[0]
+		self.assertAlmostEqual(deadline, time.time() + 0.2, places=1)
+		scheduler.reset_mock()
+
+		#Earlier wake-ups are still scheduled:
+		t = time.time() + 0.01
+		self.bl4p.requestWakeup(t)
+		scheduler.scheduleDeadline.assert_called_once_with(
+			self.bl4p, t, self.bl4p.processScheduledTimeouts)
+
+		#After recovery, the delay is reset:
+		archive.add.side_effect = None
+		self.bl4p.processScheduledTimeouts()
+		archive.add.assert_called_with(data.paymentHash, unittest.mock.ANY)
+		self.assertEqual(len(self.bl4p.transactions), 0)
+		self.assertEqual(self.bl4p.timeoutRetryDelay, self.bl4p.minTimeoutRetryDelay)
+
+
+	def test_journalFailure(self):
+		self.setBalance(self.senderID, 500)
+		self.setBalance(self.receiverID, 200)
+		self.bl4p.minTimeBetweenTimeouts = 0.01
+
+		with tempfile.TemporaryDirectory() as directory:
+			j = bl4p_journal.Journal(os.path.join(directory, 'journal'))
+			self.bl4p.setJournal(j)
+
+			data1 = self.bl4p_startTransaction()
+			data2 = self.bl4p_startTransaction(senderTimeout=0.01)
+			self.bl4p_processSelfReport(data2)
+			time.sleep(0.02)
+
+			j.failed = OSError('(intended) test exception')
+			numAppended = j.numAppended
+
+			#State changes are refused, without touching the in-memory state:
+			with self.assertRaises(self.bl4p.BackendUnavailable):
+				self.bl4p_cancelTransaction(data1)
+			self.assertEqual(self.getTransactionStatus(data1.paymentHash), 'waiting_for_selfreport')
+			with self.assertRaises(self.bl4p.BackendUnavailable):
+				self.bl4p_startTransaction()
+			self.assertEqual(len(self.bl4p.transactions), 2)
+
+			#Time-outs as well; they stay in the index:
+			with self.assertRaises(self.bl4p.BackendUnavailable):
+				self.bl4p.processTimeouts()
+			self.assertEqual(self.bl4p.transactions[data2.paymentHash].status, 'waiting_for_sender')
+			self.assertEqual(self.bl4p.getTimeoutBacklogSize(), 0)
+			self.assertEqual(self.bl4p.timeouts.getNextTimeout(),
+				self.bl4p.transactions[data2.paymentHash].senderTimeout)
+
+			self.assertEqual(j.numAppended, numAppended)
+			os.close(j.fd)
+
+
+	def test_verifySignatureAsync(self):
+		report = b'foo'
+		signature = self.receiverKey.ecdsa_serialize(self.receiverKey.ecdsa_sign(report))
+
+		loop = asyncio.new_event_loop()
+		pools = \
+		[
+		None,
+		concurrent.futures.ThreadPoolExecutor(2),
+		concurrent.futures.ProcessPoolExecutor(2),
+		]
+		try:
+			for pool in pools:
+				self.bl4p.setVerificationPool(pool)
+				loop.run_until_complete(
+					self.bl4p.verifySignatureAsync(self.receiverID, report, signature))
+
+				with self.assertRaises(self.bl4p.SignatureFailure):
+					loop.run_until_complete(
+						self.bl4p.verifySignatureAsync(self.receiverID, b'bar', signature))
+				with self.assertRaises(self.bl4p.SignatureFailure):
+					loop.run_until_complete(
+						self.bl4p.verifySignatureAsync(self.senderID, report, signature))
+				with self.assertRaises(self.bl4p.UserNotFound):
+					loop.run_until_complete(
+						self.bl4p.verifySignatureAsync(1312, report, signature))
+		finally:
+			for pool in pools:
+				if pool is not None:
+					pool.shutdown()
+			loop.close()
+
+		#A verified signature is not checked again:
+		data = self.bl4p_startTransaction()
+		report = selfreport.serialize({
+			'paymentHash': data.paymentHash.hex(),
+			'offerID': '42',
+			'receiverCryptoAmount': '6',
+			'cryptoCurrency': 'btc'
+			})
+		with self.assertRaises(self.bl4p.SignatureFailure):
+			self.bl4p.processSelfReport(self.receiverID, report, b'')
+		self.bl4p.processSelfReport(self.receiverID, report, b'', signatureVerified=True)
+		self.assertEqual(self.getTransactionStatus(data.paymentHash), 'waiting_for_sender')
+
+
+	def test_getLockedFunds(self):
+		self.setBalance(self.senderID, 5000)
+		locked = 0
+		for i in range(3):
+			data = self.bl4p_startTransaction(amount=100 + i)
+			self.bl4p_processSelfReport(data)
+			if i > 0:
+				self.bl4p_processSenderAck(data)
+				locked += data.senderAmount
+
+		self.assertEqual(locked, 203)
+		self.assertEqual(self.bl4p.getLockedFunds(), locked)
+		self.assertEqual(self.bl4p.getLockedFunds(self.senderID), locked)
+		self.assertEqual(self.bl4p.getLockedFunds(self.receiverID), 0)
+
+		#Completed transactions are not locked:
+		self.bl4p_processReceiverClaim(data)
+		self.assertEqual(self.bl4p.getLockedFunds(), locked - data.senderAmount)
+
+
+	def test_schnorrSignatures(self):
+		user = bl4p_backend.User(id=9, pubKey=self.senderKey.pubkey.serialize(),
+			signatureType=signatures.SignatureType.schnorr)
+		schnorrSignature = self.senderKey.schnorr_sign(b'foo', signatures.schnorrTag)
+		ecdsaSignature = self.senderKey.ecdsa_serialize(self.senderKey.ecdsa_sign(b'foo'))
+
+		self.bl4p.checkSignature(user, b'foo', schnorrSignature)
+		with self.assertRaises(self.bl4p.SignatureFailure):
+			self.bl4p.checkSignature(user, b'bar', schnorrSignature)
+		with self.assertRaises(self.bl4p.SignatureFailure):
+			self.bl4p.checkSignature(user, b'foo', ecdsaSignature)
+
+		#Users can only be added if their signatures can be verified:
+		with patch('secp256k1.HAS_EXTRAKEYS', False):
+			with self.assertRaises(signatures.UnsupportedSignatureType):
+				self.bl4p.addUser(user)
+		with self.assertRaises(self.bl4p.UserNotFound):
+			self.bl4p.getUser(9)
+		self.bl4p.addUser(user)
+		self.assertEqual(self.bl4p.getUser(9).signatureType, signatures.SignatureType.schnorr)
+
+
+	def test_batchVerifier(self):
+		report = b'foo'
+		signature = self.receiverKey.ecdsa_serialize(self.receiverKey.ecdsa_sign(report))
+
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		try:
+			verifier = signatures.BatchVerifier(window=0.01)
+			self.bl4p.setBatchVerifier(verifier)
+
+			@asyncio.coroutine
+			def verify(message):
+				try:
+					yield from self.bl4p.verifySignatureAsync(self.receiverID, message, signature)
+				except self.bl4p.SignatureFailure:
+					return False
+				return True
+
+			results = loop.run_until_complete(asyncio.gather(
+				verify(report), verify(b'bar'), verify(report)))
+			self.assertEqual(results, [True, False, True])
+			self.assertEqual((verifier.numBatches, verifier.numSignatures), (1, 3))
+		finally:
+			asyncio.set_event_loop(None)
+			loop.close()
+
+
+	def test_publicKeyCache(self):
+		self.bl4p.publicKeyCache = bl4p_backend.LRUCache(1)
+		sender = self.bl4p.getUser(self.senderID)
+		receiver = self.bl4p.getUser(self.receiverID)
+		self.assertEqual(self.bl4p.getPublicKeyCacheStatistics(), {'hits': 0, 'misses': 0, 'size': 0})
+
+		pubKey = self.bl4p.getPublicKey(sender)
+		self.assertEqual(pubKey.serialize(), self.senderKey.pubkey.serialize())
+		self.assertTrue(self.bl4p.getPublicKey(sender) is pubKey)
+		self.assertEqual(self.bl4p.getPublicKeyCacheStatistics(), {'hits': 1, 'misses': 1, 'size': 1})
+
+		#Size-bounded:
+		self.assertEqual(self.bl4p.getPublicKey(receiver).serialize(), self.receiverKey.pubkey.serialize())
+		self.assertFalse(self.bl4p.getPublicKey(sender) is pubKey)
+		self.assertEqual(self.bl4p.getPublicKeyCacheStatistics(), {'hits': 1, 'misses': 3, 'size': 1})
+
+		#Users without a valid key:
+		self.assertEqual(self.bl4p.getPublicKey(bl4p_backend.User(id=1, pubKey=None)), None)
+		self.assertEqual(self.bl4p.getPublicKey(bl4p_backend.User(id=1, pubKey=bytes(33))), None)
+
+
+	def test_verificationCache(self):
+		self.setBalance(self.senderID, 500)
+		data = self.bl4p_startTransaction()
+		self.bl4p_processSelfReport(data)
+		self.bl4p.verificationCache.clear()
+
+		report = selfreport.serialize({
+			'paymentHash': data.paymentHash.hex(),
+			'offerID': '42',
+			'receiverCryptoAmount': '6',
+			'cryptoCurrency': 'btc'
+			})
+		signature = self.senderKey.ecdsa_serialize(self.senderKey.ecdsa_sign(report))
+		otherSignature = self.senderKey.ecdsa_serialize(self.senderKey.ecdsa_sign(report + b'x'))
+		senderAck = lambda signature: self.bl4p.processSenderAck(
+			self.senderID, data.senderAmount, data.paymentHash, 5000, report, signature)
+
+		loop = asyncio.new_event_loop()
+		try:
+			with patch('bl4p_server.signatures.verify', side_effect=signatures.verify) as verify:
+				preimage = senderAck(signature)
+				self.assertEqual(verify.call_count, 1)
+
+				#Retries skip verification:
+				for i in range(3):
+					self.assertEqual(senderAck(signature), preimage)
+				loop.run_until_complete(self.bl4p.verifySignatureAsync(self.senderID, report, signature))
+				self.assertEqual(verify.call_count, 1)
+
+				#Failures are not cached:
+				for i in range(2):
+					with self.assertRaises(self.bl4p.SignatureFailure):
+						senderAck(otherSignature)
+				with self.assertRaises(self.bl4p.SignatureFailure):
+					loop.run_until_complete(self.bl4p.verifySignatureAsync(self.receiverID, report, signature))
+				self.assertEqual(verify.call_count, 4)
+				self.assertEqual(len(self.bl4p.verificationCache), 1)
+
+				#Without a cache entry, verification happens again:
+				self.bl4p.verificationCache.clear()
+				self.assertEqual(senderAck(signature), preimage)
+				self.assertEqual(verify.call_count, 5)
+		finally:
+			loop.close()
+
+
+	def test_journal(self):
+		self.setBalance(self.senderID, 500)
+		self.setBalance(self.receiverID, 200)
+		self.bl4p.minTimeBetweenTimeouts = 0.01
+
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, 'journal')
+			self.bl4p.setJournal(bl4p_journal.Journal(filename))
+
+			data1 = self.bl4p_startTransaction()
+			self.bl4p_processSelfReport(data1)
+			self.bl4p_processSenderAck(data1)
+			self.bl4p_processReceiverClaim(data1)
+
+			data2 = self.bl4p_startTransaction()
+			self.bl4p_processSelfReport(data2)
+			self.bl4p_processSenderAck(data2)
+			self.bl4p_cancelTransaction(data2)
+
+			data3 = self.bl4p_startTransaction(senderTimeout=0.05, lockedTimeout=0.1)
+			self.bl4p_processSelfReport(data3)
+			data4 = self.bl4p_startTransaction(senderTimeout=0.05, lockedTimeout=0.1)
+			self.bl4p_processSelfReport(data4)
+			self.bl4p_processSenderAck(data4)
+
+			data5 = self.bl4p_startTransaction()
+			self.bl4p_processSelfReport(data5)
+			self.bl4p_processSenderAck(data5)
+
+			data6 = self.bl4p_startTransaction()
+
+			time.sleep(0.2)
+			self.bl4p.processTimeouts()
+			self.assertEqual(self.getTransactionStatus(data3.paymentHash), 'sender_timeout')
+			self.assertEqual(self.getTransactionStatus(data4.paymentHash), 'receiver_timeout')
+			self.bl4p.journal.close()
+
+			#Replay on top of the original users:
+			bl4p = bl4p_backend.BL4P()
+			bl4p.users[self.senderID]   = bl4p_backend.User(id=self.senderID  , balance=500, pubKey=self.senderKey.pubkey.serialize()  )
+			bl4p.users[self.receiverID] = bl4p_backend.User(id=self.receiverID, balance=200, pubKey=self.receiverKey.pubkey.serialize())
+			bl4p.setJournal(bl4p_journal.Journal(filename))
+
+			self.assertEqual(bl4p.users, self.bl4p.users)
+			self.assertEqual(bl4p.transactions, self.bl4p.transactions)
+			self.assertEqual(self.getBalance(self.senderID), 500 - 2 * data5.senderAmount)
+
+			#The time-out index is restored as well:
+			self.assertEqual(bl4p.timeouts.getNextTimeout(), self.bl4p.transactions[data5.paymentHash].receiverTimeout)
+			self.assertEqual(bl4p.timeouts.popExpired(time.time()), [])
+
+			#New state changes are appended:
+			self.bl4p = bl4p
+			self.bl4p_processReceiverClaim(data5)
+			bl4p.journal.close()
+
+			bl4p = bl4p_backend.BL4P()
+			bl4p.users[self.receiverID] = bl4p_backend.User(id=self.receiverID, balance=200, pubKey=self.receiverKey.pubkey.serialize())
+			bl4p.users[self.senderID]   = bl4p_backend.User(id=self.senderID  , balance=500, pubKey=self.senderKey.pubkey.serialize()  )
+			bl4p.setJournal(bl4p_journal.Journal(filename))
+			self.assertEqual(bl4p.transactions[data5.paymentHash].status, 'completed')
+			self.assertEqual(bl4p.users[self.receiverID].balance, 200 + data1.receiverAmount + data5.receiverAmount)
+			bl4p.journal.close()
+
+
 	def test_feeAmounts(self):
 		self.bl4p.fee_base = 1
 		self.bl4p.fee_rate = decimal.Decimal('0.0025')
@@ -15,6 +15,8 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import hashlib
 import sys
 import unittest
 from unittest.mock import patch, Mock
@@ -22,6 +24,7 @@ from unittest.mock import patch, Mock
 sys.path.append('..')
 
 from bl4p_server.api import bl4p_pb2
+from bl4p_server.api import selfreport
 from bl4p_server import bl4p_rpc
 
 
@@ -29,11 +32,15 @@ from bl4p_server import bl4p_rpc
 class MockServer:
 	def __init__(self):
 		self.RPCFunctions = {}
+		self.orderingKeyFunctions = {}
+		self.priorities = {}
 		self.timeoutFunctions = []
 
 
-	def registerRPCFunction(self, requestType, function):
+	def registerRPCFunction(self, requestType, function, orderingKey=None, priority=None):
 		self.RPCFunctions[requestType] = function
+		self.orderingKeyFunctions[requestType] = orderingKey
+		self.priorities[requestType] = priority
 
 
 	def registerTimeoutFunction(self, function):
@@ -69,15 +76,42 @@ class MockBL4P(Mock):
 		pass
 
 
+	class BackendUnavailable(Exception):
+		pass
+
+
+	def __init__(self, *args, **kwargs):
+		Mock.__init__(self, *args, **kwargs)
+		self.verifySignatureAsync = Mock(side_effect=self.verifySignature)
+		self.verifyResult = None
+
+
+	@asyncio.coroutine
+	def verifySignature(self, userid, message, signature):
+		if self.verifyResult is not None:
+			raise self.verifyResult
+		return
+		yield
+
+
+
+def run(coroutine):
+	loop = asyncio.new_event_loop()
+	try:
+		return loop.run_until_complete(coroutine)
+	finally:
+		loop.close()
+
+
 
 class TestBL4PRPC(unittest.TestCase):
 
 	@patch('bl4p_server.bl4p_rpc.start'      , return_value=100)
 	@patch('bl4p_server.bl4p_rpc.cancelStart', return_value=101)
-	@patch('bl4p_server.bl4p_rpc.send'       , return_value=102)
+	@patch('bl4p_server.bl4p_rpc.send'       , return_value=102, new_callable=Mock)
 	@patch('bl4p_server.bl4p_rpc.receive'    , return_value=103)
 	@patch('bl4p_server.bl4p_rpc.getStatus'  , return_value=104)
-	@patch('bl4p_server.bl4p_rpc.selfReport' , return_value=105)
+	@patch('bl4p_server.bl4p_rpc.selfReport' , return_value=105, new_callable=Mock)
 	def test_registerRPC(self, mock_selfReport, mock_getStatus, mock_receive, mock_send, mock_cancelStart, mock_start):
 		mocks = \
 		{
@@ -108,7 +142,34 @@ class TestBL4PRPC(unittest.TestCase):
 					mock.assert_not_called()
 				mock.reset_mock()
 
-		self.assertEqual(server.timeoutFunctions, [bl4p.processTimeouts])
+		self.assertEqual(server.timeoutFunctions, [])
+		bl4p.setScheduler.assert_called_once_with(server)
+
+		self.assertEqual(server.priorities,
+			{
+			bl4p_pb2.BL4P_Start      : 'normal',
+			bl4p_pb2.BL4P_CancelStart: 'high',
+			bl4p_pb2.BL4P_Send       : 'high',
+			bl4p_pb2.BL4P_Receive    : 'high',
+			bl4p_pb2.BL4P_GetStatus  : 'normal',
+			bl4p_pb2.BL4P_SelfReport : 'normal',
+			})
+
+		#Ordering keys:
+		keys = server.orderingKeyFunctions
+		self.assertEqual(keys[bl4p_pb2.BL4P_Start], None)
+		for requestType in [bl4p_pb2.BL4P_CancelStart, bl4p_pb2.BL4P_Send, bl4p_pb2.BL4P_GetStatus]:
+			request = requestType()
+			request.payment_hash.data = b'foo'
+			self.assertEqual(keys[requestType](request), b'foo')
+
+		request = bl4p_pb2.BL4P_Receive()
+		request.payment_preimage.data = b'foo'
+		self.assertEqual(keys[bl4p_pb2.BL4P_Receive](request), hashlib.sha256(b'foo').digest())
+
+		request = bl4p_pb2.BL4P_SelfReport()
+		request.report = selfreport.serialize({'paymentHash': '00ff'})
+		self.assertEqual(keys[bl4p_pb2.BL4P_SelfReport](request), b'\x00\xff')
 
 
 	def test_start(self):
@@ -161,7 +222,7 @@ class TestBL4PRPC(unittest.TestCase):
 			)
 
 		#Exceptions
-		for xc in [bl4p.TransactionNotFound()]:
+		for xc in [bl4p.TransactionNotFound(), bl4p.BackendUnavailable()]:
 			bl4p.cancelTransaction.reset_mock()
 			bl4p.cancelTransaction.side_effect=xc
 			result = bl4p_rpc.cancelStart(bl4p, userID=4, request=request)
@@ -186,23 +247,32 @@ class TestBL4PRPC(unittest.TestCase):
 		bl4p.processSenderAck = Mock(
 			return_value=b'\x00\xff'
 			)
-		result = bl4p_rpc.send(bl4p, userID=4, request=request)
+		result = run(bl4p_rpc.send(bl4p, userID=4, request=request))
 		self.assertTrue(isinstance(result, bl4p_pb2.BL4P_SendResult))
 		self.assertEqual(result.payment_preimage.data, b'\x00\xff')
+		bl4p.verifySignatureAsync.assert_called_once_with(4, 8, 9)
 		bl4p.processSenderAck.assert_called_once_with(
 			sender_userid=4, amount=5, paymentHash=6, maxLockedTimeout=7,
-			report=8, signature=9,
+			report=8, signature=9, signatureVerified=True,
 			)
 
 		#Exceptions
 		for xc in [bl4p.UserNotFound(), bl4p.SignatureFailure(), bl4p.TransactionNotFound(), bl4p.InsufficientFunds(), bl4p.MissingData()]:
 			bl4p.processSenderAck.reset_mock()
 			bl4p.processSenderAck.side_effect=xc
-			result = bl4p_rpc.send(bl4p, userID=4, request=request)
+			result = run(bl4p_rpc.send(bl4p, userID=4, request=request))
+			self.assertTrue(isinstance(result, bl4p_pb2.Error))
+
+		#Verification failures; state is not touched:
+		for xc in [bl4p.UserNotFound(), bl4p.SignatureFailure()]:
+			bl4p.processSenderAck.reset_mock()
+			bl4p.verifyResult = xc
+			result = run(bl4p_rpc.send(bl4p, userID=4, request=request))
 			self.assertTrue(isinstance(result, bl4p_pb2.Error))
+			bl4p.processSenderAck.assert_not_called()
 
 		bl4p.processSenderAck.reset_mock()
-		result = bl4p_rpc.send(bl4p, userID=None, request=request)
+		result = run(bl4p_rpc.send(bl4p, userID=None, request=request))
 		self.assertTrue(isinstance(result, bl4p_pb2.Error))
 
 
@@ -266,21 +336,30 @@ class TestBL4PRPC(unittest.TestCase):
 
 		#Successfull call
 		bl4p.processSelfReport = Mock()
-		result = bl4p_rpc.selfReport(bl4p, userID=4, request=request)
+		result = run(bl4p_rpc.selfReport(bl4p, userID=4, request=request))
 		self.assertTrue(isinstance(result, bl4p_pb2.BL4P_SelfReportResult))
+		bl4p.verifySignatureAsync.assert_called_once_with(4, b'foo', b'bar')
 		bl4p.processSelfReport.assert_called_once_with(
-			receiver_userid=4, report=b'foo', signature=b'bar'
+			receiver_userid=4, report=b'foo', signature=b'bar', signatureVerified=True
 			)
 
 		#Exceptions
 		for xc in [bl4p.UserNotFound(), bl4p.TransactionNotFound(), bl4p.SignatureFailure(), bl4p.MissingData()]:
 			bl4p.processSelfReport.reset_mock()
 			bl4p.processSelfReport.side_effect=xc
-			result = bl4p_rpc.selfReport(bl4p, userID=4, request=request)
+			result = run(bl4p_rpc.selfReport(bl4p, userID=4, request=request))
+			self.assertTrue(isinstance(result, bl4p_pb2.Error))
+
+		#Verification failures; state is not touched:
+		for xc in [bl4p.UserNotFound(), bl4p.SignatureFailure()]:
+			bl4p.processSelfReport.reset_mock()
+			bl4p.verifyResult = xc
+			result = run(bl4p_rpc.selfReport(bl4p, userID=4, request=request))
 			self.assertTrue(isinstance(result, bl4p_pb2.Error))
+			bl4p.processSelfReport.assert_not_called()
 
 		bl4p.getTransactionStatus.reset_mock()
-		result = bl4p_rpc.selfReport(bl4p, userID=None, request=request)
+		result = run(bl4p_rpc.selfReport(bl4p, userID=None, request=request))
 		self.assertTrue(isinstance(result, bl4p_pb2.Error))
 
 
@@ -0,0 +1,307 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import random
+import sys
+import unittest
+
+sys.path.append('..')
+
+from bl4p_server import bl4p_backend
+from bl4p_server import columnar
+from bl4p_server import offerbook_backend
+from bl4p_server.api.offer import Offer, Asset, Condition
+from bl4p_server.bl4p_backend import Transaction
+
+import test_bl4p_backend
+from randomoffers import randomAsset
+
+
+
+sha256 = lambda preimage: hashlib.sha256(preimage).digest()
+
+
+def makeTransaction(i, status='waiting_for_sender'):
+	return Transaction(
+		sender_userid = None if status == 'waiting_for_sender' else 6,
+		receiver_userid = 3,
+		amountIncoming = 1000 + i,
+		amountOutgoing = 997 + i,
+		preimage = bytes([i]) * 32,
+		senderTimeout = 100.0 + i,
+		receiverTimeout = 200.0 + i,
+		status = status,
+		)
+
+
+
+class TestTransactionTable(unittest.TestCase):
+	def test_mapping(self):
+		table = columnar.TransactionTable(capacity=2)
+		hashes = [sha256(bytes([i])) for i in range(5)]
+		for i, h in enumerate(hashes):
+			table[h] = makeTransaction(i)
+
+		self.assertEqual(len(table), 5)
+		self.assertEqual(table.capacity, 8)
+		self.assertEqual(set(table), set(hashes))
+		self.assertEqual(set(table.keys()), set(hashes))
+		self.assertTrue(hashes[0] in table)
+		self.assertFalse(b'foo' in table)
+		self.assertEqual(table.get(b'foo'), None)
+		with self.assertRaises(KeyError):
+			table[b'foo']
+
+		for i, h in enumerate(hashes):
+			tx = table[h]
+			self.assertEqual(tx.sender_userid, None)
+			self.assertEqual(tx.receiver_userid, 3)
+			self.assertEqual(tx.amountIncoming, 1000 + i)
+			self.assertEqual(tx.amountOutgoing, 997 + i)
+			self.assertEqual(tx.preimage, bytes([i]) * 32)
+			self.assertEqual(tx.senderTimeout, 100.0 + i)
+			self.assertEqual(tx.receiverTimeout, 200.0 + i)
+			self.assertEqual(tx.status, 'waiting_for_sender')
+			self.assertEqual(type(tx.amountIncoming), int)
+			self.assertEqual(type(tx.senderTimeout), float)
+
+		#Changes through views:
+		tx = table.get(hashes[1])
+		tx.sender_userid = 6
+		tx.status = bl4p_backend.TransactionStatus.waiting_for_receiver
+		self.assertEqual(table[hashes[1]].sender_userid, 6)
+		self.assertEqual(table[hashes[1]].status, 'waiting_for_receiver')
+		self.assertEqual(
+			[(h, tx.amountIncoming) for h, tx in table.items()],
+			[(h, 1000 + i) for i, h in enumerate(hashes)]
+			)
+		self.assertEqual([tx.amountOutgoing for tx in table.values()], [997 + i for i in range(5)])
+
+		#Overwriting keeps the row:
+		row = table.index[hashes[2]]
+		table[hashes[2]] = makeTransaction(42)
+		self.assertEqual(table.index[hashes[2]], row)
+		self.assertEqual(table[hashes[2]].amountIncoming, 1042)
+
+		#Removal:
+		tx = table.pop(hashes[1])
+		self.assertEqual(type(tx), Transaction)
+		self.assertEqual(tx.amountIncoming, 1001)
+		self.assertEqual(tx.sender_userid, 6)
+		self.assertEqual(tx.status, 'waiting_for_receiver')
+		self.assertEqual(len(table), 4)
+		self.assertFalse(hashes[1] in table)
+		self.assertEqual(table.pop(hashes[1], None), None)
+		with self.assertRaises(KeyError):
+			table.pop(hashes[1])
+
+		#Re-use of the free row:
+		staleView = table[hashes[3]]
+		table.pop(hashes[3])
+		newHash = sha256(b'new')
+		table[newHash] = makeTransaction(7)
+		self.assertEqual(table.index[newHash], 3)
+		self.assertEqual(table.numRows, 5)
+		self.assertEqual(table[newHash].amountIncoming, 1007)
+
+		#Views of removed transactions don't alias the new one:
+		with self.assertRaises(AssertionError):
+			staleView.amountIncoming
+		with self.assertRaises(AssertionError):
+			staleView.status = bl4p_backend.TransactionStatus.canceled
+		self.assertEqual(table[newHash].status, 'waiting_for_sender')
+
+
+	def test_timeouts(self):
+		table = columnar.TransactionTable()
+		self.assertEqual(table.getNextTimeout(), None)
+		self.assertEqual(table.getExpired(1000.0), [])
+
+		table[b'a' * 32] = makeTransaction(5, 'waiting_for_sender')   #105
+		table[b'b' * 32] = makeTransaction(0, 'waiting_for_receiver') #200
+		table[b'c' * 32] = makeTransaction(1, 'waiting_for_sender')   #101
+		table[b'd' * 32] = makeTransaction(0, 'completed')
+		table[b'e' * 32] = makeTransaction(0, 'waiting_for_selfreport')
+
+		self.assertEqual(table.getNextTimeout(), 101.0)
+		self.assertEqual(table.getExpired(100.0), [])
+		self.assertEqual(table.getExpired(105.0),
+			[(b'c' * 32, 'waiting_for_sender'), (b'a' * 32, 'waiting_for_sender')])
+
+		table[b'c' * 32].status = 'sender_timeout'
+		table.pop(b'a' * 32)
+		self.assertEqual(table.getNextTimeout(), 200.0)
+		self.assertEqual(table.getExpired(1000.0), [(b'b' * 32, 'waiting_for_receiver')])
+
+
+	def test_getLockedFunds(self):
+		table = columnar.TransactionTable()
+		self.assertEqual(table.getLockedFunds(), 0)
+
+		table[b'a' * 32] = makeTransaction(1, 'waiting_for_receiver')
+		table[b'b' * 32] = makeTransaction(2, 'waiting_for_receiver')
+		table[b'c' * 32] = makeTransaction(4, 'waiting_for_sender')
+		table[b'd' * 32] = makeTransaction(8, 'completed')
+		table[b'b' * 32].sender_userid = 7
+		self.assertEqual(table.getLockedFunds(), 2003)
+		self.assertEqual(table.getLockedFunds(6), 1001)
+		self.assertEqual(table.getLockedFunds(7), 1002)
+		self.assertEqual(table.getLockedFunds(8), 0)
+
+
+
+class TestColumnarBL4P(test_bl4p_backend.TestBL4P):
+	'''
+	Runs the BL4P tests on columnar transaction storage.
+	'''
+
+	def setUp(self):
+		test_bl4p_backend.TestBL4P.setUp(self)
+		users = self.bl4p.users
+		self.bl4p = bl4p_backend.BL4P(columnar=True)
+		self.bl4p.fee_base = 1
+		self.bl4p.fee_rate = 0
+		self.bl4p.users = users
+
+
+	#Too timing-sensitive on slow machines; see TestTransactionTable.test_timeouts:
+	test_processTimeouts = None
+
+
+	def test_getLockedFunds(self):
+		self.setBalance(self.senderID, 5000)
+		locked = 0
+		for i in range(3):
+			data = self.bl4p_startTransaction(amount=100 + i)
+			self.bl4p_processSelfReport(data)
+			if i > 0:
+				self.bl4p_processSenderAck(data)
+				locked += data.senderAmount
+
+		self.assertEqual(locked, 203)
+		self.assertEqual(self.bl4p.getLockedFunds(), locked)
+		self.assertEqual(self.bl4p.getLockedFunds(self.senderID), locked)
+		self.assertEqual(self.bl4p.getLockedFunds(self.receiverID), 0)
+
+		dictBL4P = bl4p_backend.BL4P()
+		dictBL4P.transactions = bl4p_backend.TransactionDict(
+			(paymentHash, tx.copy())
+			for paymentHash, tx in self.bl4p.transactions.items()
+			)
+		self.assertEqual(dictBL4P.getLockedFunds(), locked)
+		self.assertEqual(dictBL4P.getLockedFunds(self.senderID), locked)
+		self.assertEqual(dictBL4P.getLockedFunds(self.receiverID), 0)
+
+
+
+
+class TestOfferColumns(unittest.TestCase):
+	def test_findMatches(self):
+		def makeOffer(bid, ask, locked_timeout=None):
+			return Offer(
+				bid=Asset(bid, 1, 'btc', 'ln'), ask=Asset(ask, 1, 'eur', 'bl3p.eu'),
+				address='', ID=0, locked_timeout=locked_timeout)
+
+		columns = columnar.OfferColumns(offerbook_backend.indexedConditions, capacity=1)
+		offers = [makeOffer(3, 1), makeOffer(2, 1, (0, 10)), makeOffer(2**64 - 1, 2**64 - 2), makeOffer(1, 1, (20, 30))]
+		for position, offer in [(0, offers[0]), (1, offers[1]), (1, offers[3]), (1, offers[2])]:
+			columns.insert(position, offer, *offerbook_backend.getLimitRate(offer))
+		#Now in order 0, 2, 3, 1
+		self.assertEqual(len(columns), 4)
+		self.assertEqual(columns.numerator[:4].tolist(), [3.0, float(2**64 - 1), 1.0, 2.0])
+
+		query = Offer(
+			bid=Asset(1, 1, 'eur', 'bl3p.eu'), ask=Asset(1, 1, 'btc', 'ln'),
+			address='', ID=0, locked_timeout=(5, 25))
+		rows, sure = columns.findMatches(query, *offerbook_backend.getLimitRate(query))
+		self.assertEqual(rows.tolist(), [0, 1, 2, 3])
+		#Rate 1 and a rate that is 1 in float64 are not certain:
+		self.assertEqual(sure.tolist(), [True, False, False, True])
+
+		query.conditions[Condition.LOCKED_TIMEOUT] = (11, 15)
+		rows, sure = columns.findMatches(query, *offerbook_backend.getLimitRate(query))
+		self.assertEqual(rows.tolist(), [0, 1])
+
+		columns.delete(1)
+		self.assertEqual(len(columns), 3)
+		rows, sure = columns.findMatches(query, *offerbook_backend.getLimitRate(query))
+		self.assertEqual(rows.tolist(), [0])
+
+		#Conditions without columns are left to query.matches:
+		offer = makeOffer(3, 1)
+		offer.conditions[1234] = (0, 0)
+		columns.insert(0, offer, *offerbook_backend.getLimitRate(offer))
+		self.assertEqual(list(columns.conditionMin.keys()), [Condition.LOCKED_TIMEOUT])
+		rows, sure = columns.findMatches(query, *offerbook_backend.getLimitRate(query))
+		self.assertEqual(rows.tolist(), [0, 1])
+		self.assertEqual(sure.tolist(), [False, True])
+
+
+	def test_offerBook(self):
+		'''
+		Compares columnar and non-columnar offer books.
+		'''
+		rng = random.Random(0)
+		limit = lambda: rng.choice([0, 2**63 - 1, -2**63, 2**63, -2**63 - 1])
+		def makeRange():
+			low = rng.choice([rng.randint(0, 100), limit()])
+			return rng.choice([None, (low, max(low, rng.randint(0, 100))), (low, limit())])
+		def makeOffer(reverse=False):
+			bid = randomAsset(rng, 'btc', 'ln', extremes=True)
+			ask = randomAsset(rng, 'eur', 'bl3p.eu', extremes=True)
+			if reverse:
+				bid, ask = ask, bid
+			ret = Offer(bid=bid, ask=ask, address='', ID=0,
+				cltv_expiry_delta=makeRange(), locked_timeout=makeRange())
+			#Condition keys without columns:
+			unknownRange = makeRange()
+			if unknownRange is not None:
+				ret.conditions[1000 + rng.randrange(3)] = unknownRange
+			return ret
+
+		books = offerbook_backend.OfferBook(), offerbook_backend.OfferBook(columnar=True)
+		IDs = []
+		for i in range(300):
+			offer = makeOffer()
+			if rng.random() < 0.3 and IDs:
+				#Same limit rate as an earlier offer:
+				other = rng.choice(IDs)[2]
+				offer.bid.CopyFrom(other.bid)
+				offer.ask.CopyFrom(other.ask)
+			try:
+				IDs.append((i % 5, [b.addOffer(i % 5, offer) for b in books][0], offer))
+			except offerbook_backend.OfferBook.InvalidOffer:
+				continue
+
+			if rng.random() < 0.2:
+				userID, ID, o = IDs.pop(rng.randrange(len(IDs)))
+				for b in books:
+					b.removeOffer(userID, ID)
+
+			query = makeOffer(reverse=True)
+			if rng.random() < 0.5 and IDs:
+				#Borderline: exactly the inverse rate of an existing offer
+				o = rng.choice(IDs)[2]
+				query.bid.CopyFrom(Asset(o.ask.max_amount, o.ask.max_amount_divisor, 'eur', 'bl3p.eu'))
+				query.ask.CopyFrom(Asset(o.bid.max_amount, o.bid.max_amount_divisor, 'btc', 'ln'))
+			self.assertEqual(books[1].findOffers(query), books[0].findOffers(query))
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
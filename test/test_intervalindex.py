@@ -0,0 +1,101 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import sys
+import unittest
+
+sys.path.append('..')
+
+from bl4p_server import intervalindex
+
+
+
+class TestIntervalIndex(unittest.TestCase):
+	def checkTree(self, node):
+		'Checks the ordering, heap and maximum invariants; returns the size'
+		if node is None:
+			return 0
+		maxHigh = node.high
+		for child in (node.left, node.right):
+			if child is not None:
+				self.assertTrue(child.priority <= node.priority)
+				maxHigh = max(maxHigh, child.maxHigh)
+		if node.left is not None:
+			self.assertTrue(node.left.key < node.key)
+		if node.right is not None:
+			self.assertTrue(node.right.key > node.key)
+		self.assertEqual(node.maxHigh, maxHigh)
+		return 1 + self.checkTree(node.left) + self.checkTree(node.right)
+
+
+	def test_simple(self):
+		index = intervalindex.IntervalIndex()
+		self.assertEqual(index.findOverlapping(0, 10), [])
+		self.assertEqual(index.countOverlapping(0, 10), 0)
+
+		index.add('a', 0, 10)
+		index.add('b', 5, 5)
+		index.add('c', 20, 30)
+		index.add('d', -5, 0)
+		self.assertEqual(len(index), 4)
+
+		self.assertEqual(index.findOverlapping(0, 10), ['d', 'a', 'b'])
+		self.assertEqual(index.findOverlapping(6, 19), ['a'])
+		self.assertEqual(index.findOverlapping(11, 19), [])
+		self.assertEqual(index.findOverlapping(30, 40), ['c'])
+		self.assertEqual(index.countOverlapping(0, 10), 3)
+		self.assertEqual(index.countOverlapping(11, 19), 0)
+
+		index.remove('a')
+		self.assertEqual(index.findOverlapping(0, 10), ['d', 'b'])
+		with self.assertRaises(KeyError):
+			index.remove('a')
+		self.assertEqual(self.checkTree(index.root), 3)
+
+
+	def test_random(self):
+		rng = random.Random(0)
+		index = intervalindex.IntervalIndex()
+		intervals = {}
+		for i in range(2000):
+			if intervals and rng.random() < 0.4:
+				ID = rng.choice(list(intervals.keys()))
+				del intervals[ID]
+				index.remove(ID)
+			else:
+				low = rng.randint(-1000, 1000)
+				intervals[i] = low, low + rng.randint(0, rng.choice([10, 100, 1000]))
+				index.add(i, *intervals[i])
+
+			if i % 100 == 0:
+				self.assertEqual(self.checkTree(index.root), len(intervals))
+
+			low = rng.randint(-1100, 1100)
+			high = low + rng.randint(0, 200)
+			expected = [ID for ID, (l, h) in intervals.items() if l <= high and h >= low]
+			expected.sort(key=lambda ID: (intervals[ID][0], ID))
+			self.assertEqual(index.findOverlapping(low, high), expected)
+			self.assertEqual(index.countOverlapping(low, high), len(expected))
+
+		self.assertEqual(len(index), len(intervals))
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
+
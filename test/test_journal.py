@@ -0,0 +1,212 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('..')
+
+from bl4p_server import journal
+
+
+
+class TestJournal(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.filename = os.path.join(self.directory.name, 'journal')
+		self.generation0 = self.filename + '.0'
+
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+
+	def test_encoding(self):
+		h = bytes(range(32))
+		p = bytes(range(32, 64))
+		self.assertEqual(
+			journal.decode(journal.encodeStart(h, p, 3, 100, 99, 1600000000.25, 1600000100.5)),
+			(journal.START, h, p, 3, 100, 99, 1600000000.25, 1600000100.5)
+			)
+		self.assertEqual(
+			journal.decode(journal.encodeSenderAck(h, 6)),
+			(journal.SENDERACK, h, 6)
+			)
+		for recordType in (journal.SELFREPORT, journal.CLAIM, journal.CANCEL,
+			journal.SENDER_TIMEOUT, journal.RECEIVER_TIMEOUT, journal.ARCHIVE):
+			self.assertEqual(journal.decode(journal.encode(recordType, h)), (recordType, h))
+
+
+	def test_appendRead(self):
+		j = journal.Journal(self.filename)
+		self.assertEqual(list(j.readRecords()), [])
+
+		j.append(b'foo')
+		j.append(b'bar')
+		self.assertEqual(os.path.getsize(self.generation0), 0) #not yet written
+		j.sync()
+		self.assertEqual(j.numDurable, 2)
+		j.append(b'')
+		j.close()
+
+		j = journal.Journal(self.filename)
+		self.assertEqual(list(j.readRecords()), [b'foo', b'bar', b''])
+		j.append(b'baz')
+		j.close()
+
+		j = journal.Journal(self.filename)
+		self.assertEqual(list(j.readRecords()), [b'foo', b'bar', b'', b'baz'])
+		j.close()
+
+
+	def test_damagedTail(self):
+		j = journal.Journal(self.filename)
+		j.append(b'foo')
+		j.append(b'bar')
+		j.close()
+		size = os.path.getsize(self.generation0)
+
+		#Incomplete record:
+		with open(self.generation0, 'ab') as f:
+			f.write(journal.header.pack(10, 0) + b'x')
+		j = journal.Journal(self.filename)
+		self.assertEqual(list(j.readRecords()), [b'foo', b'bar'])
+		self.assertEqual(os.path.getsize(self.generation0), size)
+		j.close()
+
+		#Corrupted record:
+		with open(self.generation0, 'r+b') as f:
+			f.seek(size - 1)
+			f.write(b'X')
+		j = journal.Journal(self.filename)
+		self.assertEqual(list(j.readRecords()), [b'foo'])
+		self.assertEqual(os.path.getsize(self.generation0), size // 2)
+		j.close()
+
+
+	def test_groupCommit(self):
+		loop = asyncio.new_event_loop()
+		j = journal.Journal(self.filename, loop=loop)
+
+		writes = []
+		writeAndSync = j.writeAndSync
+		def countingWriteAndSync(fd, data):
+			writes.append(data)
+			writeAndSync(fd, data)
+		j.writeAndSync = countingWriteAndSync
+
+		@asyncio.coroutine
+		def request(payload):
+			j.append(payload)
+			yield from j.waitDurable()
+			self.assertTrue(os.path.getsize(self.generation0) >= sum(map(len, writes)))
+			return payload
+
+		#Requests handled in the same loop iteration share one write+sync:
+		results = loop.run_until_complete(asyncio.gather(
+			request(b'a'), request(b'b'), request(b'c'),
+			loop=loop))
+		self.assertEqual(results, [b'a', b'b', b'c'])
+		self.assertEqual(len(writes), 1)
+		self.assertEqual(j.numDurable, 3)
+
+		#Nothing to wait for:
+		loop.run_until_complete(j.waitDurable())
+		self.assertEqual(len(writes), 1)
+
+		loop.run_until_complete(request(b'd'))
+		self.assertEqual(len(writes), 2)
+
+		j.close()
+		loop.close()
+
+		j = journal.Journal(self.filename)
+		self.assertEqual(list(j.readRecords()), [b'a', b'b', b'c', b'd'])
+		j.close()
+
+
+	def test_rotate(self):
+		j = journal.Journal(self.filename)
+		j.append(b'a')
+		self.assertEqual(j.rotate(), 1)
+		j.append(b'b')
+		self.assertEqual(j.rotate(), 2)
+		j.sync()
+		j.append(b'c')
+		j.close()
+
+		j = journal.Journal(self.filename)
+		self.assertEqual(j.getGenerations(), [0, 1, 2])
+		self.assertEqual(j.generation, 2)
+		self.assertEqual(list(j.readRecords()), [b'a', b'b', b'c'])
+		self.assertEqual(list(j.readRecords(1)), [b'b', b'c'])
+		self.assertEqual(list(j.readRecords(3)), [])
+
+		j.removeGenerationsBefore(2)
+		self.assertEqual(j.getGenerations(), [2])
+		j.append(b'd')
+		j.close()
+
+		j = journal.Journal(self.filename)
+		self.assertEqual(list(j.readRecords()), [b'c', b'd'])
+		j.close()
+
+		#Rotation with group commit:
+		loop = asyncio.new_event_loop()
+		j = journal.Journal(self.filename, loop=loop)
+		j.append(b'e')
+		self.assertEqual(j.rotate(), 3)
+		j.append(b'f')
+		loop.run_until_complete(j.waitDurable())
+		self.assertEqual(j.retired, [])
+		j.close()
+		loop.close()
+
+		j = journal.Journal(self.filename)
+		self.assertEqual(list(j.readRecords(3)), [b'f'])
+		self.assertEqual(list(j.readRecords()), [b'c', b'd', b'e', b'f'])
+		j.close()
+
+
+	def test_writeFailure(self):
+		loop = asyncio.new_event_loop()
+		j = journal.Journal(self.filename, loop=loop)
+
+		def failingWriteAndSync(fd, data):
+			raise OSError('(intended) test exception')
+		j.writeAndSync = failingWriteAndSync
+
+		j.append(b'a')
+		with self.assertRaises(journal.Journal.WriteFailure):
+			loop.run_until_complete(j.waitDurable())
+
+		#The journal stays unusable:
+		with self.assertRaises(journal.Journal.WriteFailure):
+			loop.run_until_complete(j.waitDurable())
+		with self.assertRaises(journal.Journal.WriteFailure):
+			j.append(b'b')
+
+		os.close(j.fd)
+		loop.close()
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
@@ -15,6 +15,7 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
+import random
 import sys
 import unittest
 
@@ -23,6 +24,8 @@ sys.path.append('..')
 from bl4p_server.api import offer_pb2
 from bl4p_server.api import offer
 
+from randomoffers import randomAsset
+
 
 
 class TestOffer(unittest.TestCase):
@@ -554,6 +557,38 @@ class TestOffer(unittest.TestCase):
 
 
 
+	def test_matchesRandom(self):
+		rng = random.Random(0)
+		makeAsset = lambda: randomAsset(rng, rng.choice(['btc', 'eur']), rng.choice(['ln', 'bl3p.eu']))
+		makeRange = lambda: rng.choice([None, sorted([rng.randint(0, 100), rng.randint(0, 100)])])
+		makeOffer = lambda: offer.Offer(
+			bid=makeAsset(), ask=makeAsset(), address='', ID=0,
+			cltv_expiry_delta=makeRange(),
+			sender_timeout=makeRange(),
+			locked_timeout=makeRange(),
+			)
+
+		numMatches = 0
+		for i in range(5000):
+			o1, o2 = makeOffer(), makeOffer()
+			if rng.random() < 0.5:
+				#Make the currencies and exchanges correspond, to exercise the other checks:
+				o2.bid.CopyFrom(offer.Asset(o2.bid.max_amount, o2.bid.max_amount_divisor, o1.ask.currency, o1.ask.exchange))
+				o2.ask.CopyFrom(offer.Asset(o2.ask.max_amount, o2.ask.max_amount_divisor, o1.bid.currency, o1.bid.exchange))
+
+			try:
+				o1.verifyMatches(o2)
+				verdict = True
+			except offer.MismatchError:
+				verdict = False
+			self.assertEqual(o1.matches(o2), verdict)
+			numMatches += verdict
+
+		#Both outcomes must have been tested sufficiently:
+		self.assertTrue(500 < numMatches < 4500)
+
+
+
 if __name__ == '__main__':
 	unittest.main(verbosity=2)
 
@@ -15,18 +15,24 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
 
+import random
 import sys
 import unittest
 
 sys.path.append('..')
 
 from bl4p_server import offerbook_backend
+from bl4p_server.api.offer import Offer, Asset, Condition
+
+from randomoffers import randomAsset
 
 
 
 class DummyOffer:
-	def __init__(self, name):
+	def __init__(self, name, bid='btc', ask='eur'):
 		self.name = name
+		self.bid = Asset(1, 1, bid, 'ln')
+		self.ask = Asset(1, 1, ask, 'bl3p.eu')
 		self.conditions = {}
 
 
@@ -35,8 +41,28 @@ class DummyOffer:
 
 
 
-class DummyQuery:
+class CountingQuery(Offer):
+	'''
+	Query that counts the offers it is matched against.
+	Set the __class__ of an Offer to this to start counting.
+	'''
+	numChecked = 0
+
+	def matches(self, other):
+		self.numChecked += 1
+		return Offer.matches(self, other)
+
+
+
+class DummyQuery(DummyOffer):
+	def __init__(self, bid='eur', ask='btc'):
+		DummyOffer.__init__(self, 'query', bid, ask)
+		self.ask.exchange, self.bid.exchange = self.bid.exchange, self.ask.exchange
+		self.checked = []
+
+
 	def matches(self, offer):
+		self.checked.append(offer.name)
 		return offer.name.startswith('foo')
 
 
@@ -103,6 +129,187 @@ class TestOfferBook(unittest.TestCase):
 		self.assertTrue(offers[2] in found)
 
 
+	def test_pairIndex(self):
+		self.offerBook.addOffer(3, DummyOffer('foo1'))
+		self.offerBook.addOffer(3, DummyOffer('foo2', bid='eur', ask='btc'))
+		self.offerBook.addOffer(4, DummyOffer('foo3', bid='btc', ask='usd'))
+		ID4 = self.offerBook.addOffer(4, DummyOffer('foo4'))
+		self.assertEqual(len(self.offerBook.pairIndex), 3)
+
+		#Only offers in the counter-pair are examined:
+		query = DummyQuery()
+		self.assertEqual(self.offerBook.findOffers(query), [DummyOffer('foo1'), DummyOffer('foo4')])
+		self.assertEqual(query.checked, ['foo1', 'foo4'])
+
+		query = DummyQuery(bid='btc', ask='eur')
+		self.assertEqual(self.offerBook.findOffers(query), [DummyOffer('foo2')])
+		self.assertEqual(query.checked, ['foo2'])
+
+		#Exchanges must match as well:
+		query = DummyQuery()
+		query.bid.exchange = 'foo'
+		self.assertEqual(self.offerBook.findOffers(query), [])
+		self.assertEqual(query.checked, [])
+
+		query = DummyQuery(bid='usd', ask='eur')
+		self.assertEqual(self.offerBook.findOffers(query), [])
+
+		#Removal:
+		self.offerBook.removeOffer(4, ID4)
+		query = DummyQuery()
+		self.assertEqual(self.offerBook.findOffers(query), [DummyOffer('foo1')])
+
+		self.offerBook.removeOffer(3, 1)
+		self.assertEqual(len(self.offerBook.pairIndex), 2)
+
+
+
+	def test_priceOrder(self):
+		def makeOffer(bid, bidDiv, ask, askDiv):
+			return Offer(
+				bid=Asset(bid, bidDiv, 'btc', 'ln'),
+				ask=Asset(ask, askDiv, 'eur', 'bl3p.eu'),
+				address='', ID=0)
+
+		def makeQuery(bid, bidDiv, ask, askDiv):
+			return Offer(
+				bid=Asset(bid, bidDiv, 'eur', 'bl3p.eu'),
+				ask=Asset(ask, askDiv, 'btc', 'ln'),
+				address='', ID=0)
+
+		offers = \
+		[
+		makeOffer(2, 1, 1, 1),   #rate 2
+		makeOffer(1, 1, 1, 1),   #rate 1
+		makeOffer(5, 10, 1, 1),  #rate 1/2
+		makeOffer(3, 1, 1, 1),   #rate 3
+		makeOffer(10, 10, 1, 1), #rate 1, added later
+		makeOffer(1, 1, 0, 1),   #infinite rate
+		makeOffer(0, 1, 1, 1),   #rate 0
+		]
+		IDs = [self.offerBook.addOffer(3, o) for o in offers]
+
+		self.assertEqual(self.offerBook.findOffers(makeQuery(1, 1, 1, 1)),
+			[offers[5], offers[3], offers[0], offers[1], offers[4]])
+		self.assertEqual(self.offerBook.findOffers(makeQuery(1, 1, 2, 1)),
+			[offers[5], offers[3], offers[0]])
+		self.assertEqual(self.offerBook.findOffers(makeQuery(0, 1, 1, 1)),
+			[offers[5]])
+		self.assertEqual(self.offerBook.findOffers(makeQuery(0, 1, 0, 1)),
+			[offers[5], offers[3], offers[0], offers[1], offers[4], offers[2], offers[6]])
+
+		#The search stops at the first offer with an incompatible rate:
+		query = makeQuery(1, 1, 2, 1)
+		query.__class__ = CountingQuery
+		self.offerBook.findOffers(query)
+		self.assertEqual(query.numChecked, 3)
+
+		self.offerBook.removeOffer(3, IDs[3])
+		self.offerBook.removeOffer(3, IDs[5])
+		self.assertEqual(self.offerBook.findOffers(makeQuery(1, 1, 1, 1)),
+			[offers[0], offers[1], offers[4]])
+
+
+	def test_priceOrderRandom(self):
+		rng = random.Random(0)
+
+		offers = []
+		for i in range(200):
+			offer = Offer(
+				bid=randomAsset(rng, 'btc', 'ln'), ask=randomAsset(rng, 'eur', 'bl3p.eu'),
+				address='', ID=i)
+			offers.append(offer)
+			self.offerBook.addOffer(i % 7, offer)
+
+		for i in range(200):
+			query = Offer(
+				bid=randomAsset(rng, 'eur', 'bl3p.eu'), ask=randomAsset(rng, 'btc', 'ln'),
+				address='', ID=0)
+			found = self.offerBook.findOffers(query)
+			expected = [o for o in offers if query.matches(o)]
+			self.assertEqual(sorted(o.ID for o in found), sorted(o.ID for o in expected))
+
+			#Best rate first:
+			rates = [offerbook_backend.getLimitRate(o) for o in found]
+			for (n1, d1), (n2, d2) in zip(rates[:-1], rates[1:]):
+				self.assertTrue(n1 * d2 >= n2 * d1 or d1 == 0)
+
+
+
+	def test_conditionIndex(self):
+		rng = random.Random(1)
+		makeRange = lambda width: (lambda low: (low, low + rng.randint(0, width)))(rng.randint(0, 10000))
+
+		offers = []
+		IDs = []
+		for i in range(400):
+			offer = Offer(
+				bid=Asset(rng.randint(1, 100), 1, 'btc', 'ln'),
+				ask=Asset(rng.randint(1, 100), 1, 'eur', 'bl3p.eu'),
+				address='', ID=i,
+				#Some offers don't have the condition; they match any range:
+				locked_timeout=None if i % 10 == 0 else makeRange(100),
+				sender_timeout=makeRange(10000),
+				)
+			offers.append(offer)
+			IDs.append(self.offerBook.addOffer(i % 7, offer))
+
+		#Remove some, to check that they disappear from the index:
+		for i in range(0, 400, 3):
+			self.offerBook.removeOffer(i % 7, IDs[i])
+		offers = [o for o in offers if o.ID % 3 != 0]
+
+		for i in range(100):
+			query = Offer(
+				bid=Asset(rng.randint(1, 100), 1, 'eur', 'bl3p.eu'),
+				ask=Asset(1, 1, 'btc', 'ln'),
+				address='', ID=0,
+				locked_timeout=rng.choice([None, makeRange(10), makeRange(10000), (5, 3)]),
+				)
+			query.__class__ = CountingQuery
+			found = self.offerBook.findOffers(query)
+			numChecked = query.numChecked
+			expected = [o for o in offers if query.matches(o)]
+			self.assertEqual(sorted(o.ID for o in found), sorted(o.ID for o in expected))
+
+			#Best rate first:
+			rates = [offerbook_backend.getLimitRate(o) for o in found]
+			for (n1, d1), (n2, d2) in zip(rates[:-1], rates[1:]):
+				self.assertTrue(n1 * d2 >= n2 * d1)
+
+			#Narrow ranges only check overlapping offers:
+			low, high = query.conditions.get(Condition.LOCKED_TIMEOUT, (0, -1))
+			if 0 <= high - low <= 10:
+				self.assertTrue(numChecked < len(offers) // 4)
+
+
+
+	def test_unindexedConditions(self):
+		def makeOffer(key, minmax, bid='btc', ask='eur', bidExchange='ln', askExchange='bl3p.eu'):
+			ret = Offer(
+				bid=Asset(1, 1, bid, bidExchange), ask=Asset(1, 1, ask, askExchange),
+				address='', ID=key, locked_timeout=(10, 20))
+			ret.conditions[key] = minmax
+			return ret
+
+		#Offers with many unknown condition keys:
+		offers = [makeOffer(1000 + i, (i, i)) for i in range(100)]
+		for offer in offers:
+			self.offerBook.addOffer(3, offer)
+		bucket = list(self.offerBook.pairIndex.values())[0]
+		self.assertEqual(list(bucket.conditionIndices.keys()), [Condition.LOCKED_TIMEOUT])
+
+		#Unknown keys are still checked by Offer.matches:
+		query = makeOffer(1042, (43, 50), 'eur', 'btc', 'bl3p.eu', 'ln')
+		found = self.offerBook.findOffers(query)
+		self.assertEqual([o.ID for o in found], [o.ID for o in offers if query.matches(o)])
+		self.assertEqual(len(found), 99)
+		query.conditions[1042] = (42, 42)
+		self.assertEqual(len(self.offerBook.findOffers(query)), 100)
+		query.conditions[Condition.LOCKED_TIMEOUT] = (21, 30)
+		self.assertEqual(self.offerBook.findOffers(query), [])
+
+
 
 if __name__ == '__main__':
 	unittest.main(verbosity=2)
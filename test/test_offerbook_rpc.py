@@ -29,10 +29,12 @@ from bl4p_server import offerbook_rpc
 class MockServer:
 	def __init__(self):
 		self.RPCFunctions = {}
+		self.priorities = {}
 
 
-	def registerRPCFunction(self, requestType, function):
+	def registerRPCFunction(self, requestType, function, priority):
 		self.RPCFunctions[requestType] = function
+		self.priorities[requestType] = priority
 
 
 
@@ -89,6 +91,14 @@ class TestOfferBookRPC(unittest.TestCase):
 					mock.assert_not_called()
 				mock.reset_mock()
 
+		self.assertEqual(server.priorities,
+			{
+			bl4p_pb2.BL4P_AddOffer    : 'normal',
+			bl4p_pb2.BL4P_ListOffers  : 'low',
+			bl4p_pb2.BL4P_RemoveOffer : 'normal',
+			bl4p_pb2.BL4P_FindOffers  : 'low',
+			})
+
 
 	@patch('bl4p_server.offerbook_rpc.Offer')
 	def test_addOffer(self, mock_Offer):
@@ -0,0 +1,117 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import unittest
+
+sys.path.append('..')
+
+from bl4p_server import ratelimit
+from bl4p_server.api import bl4p_pb2
+from bl4p_server.api.serialization import serialize, type2id, getTypeID, getRequestID
+
+
+
+startID = type2id[bl4p_pb2.BL4P_Start]
+findID = type2id[bl4p_pb2.BL4P_FindOffers]
+
+
+
+class TestRateLimiter(unittest.TestCase):
+	def setUp(self):
+		self.limiter = ratelimit.RateLimiter()
+		self.limiter.setLimit(bl4p_pb2.BL4P_FindOffers, 2.0, 3)
+
+
+	def test_setLimit(self):
+		with self.assertRaises(ValueError):
+			self.limiter.setLimit(bl4p_pb2.BL4P_Start, 0.0, 3)
+		with self.assertRaises(ValueError):
+			self.limiter.setLimit(bl4p_pb2.BL4P_Start, 1.0, 0)
+		with self.assertRaises(KeyError):
+			self.limiter.setLimit(bl4p_pb2.Err_Unknown, 1.0, 1)
+		self.assertEqual(list(self.limiter.limits.keys()), [findID])
+
+
+	def test_allow(self):
+		limiter = self.limiter
+
+		#Unlimited message type:
+		for i in range(10):
+			self.assertTrue(limiter.allow('a', startID, t=100.0))
+		self.assertEqual(len(limiter.buckets), 0)
+
+		#Burst:
+		for i in range(3):
+			self.assertTrue(limiter.allow('a', findID, t=100.0))
+		self.assertFalse(limiter.allow('a', findID, t=100.0))
+		self.assertEqual(limiter.numRejected, 1)
+
+		#Other clients have their own buckets:
+		self.assertTrue(limiter.allow('b', findID, t=100.0))
+
+		#Refill at the given rate:
+		self.assertFalse(limiter.allow('a', findID, t=100.4))
+		self.assertTrue(limiter.allow('a', findID, t=100.5))
+		self.assertFalse(limiter.allow('a', findID, t=100.5))
+		self.assertTrue(limiter.allow('a', findID, t=101.0))
+		self.assertEqual(limiter.numRejected, 3)
+
+		#Refill is capped at the burst size:
+		for i in range(3):
+			self.assertTrue(limiter.allow('a', findID, t=200.0))
+		self.assertFalse(limiter.allow('a', findID, t=200.0))
+
+
+	def test_removeIdle(self):
+		limiter = self.limiter
+		limiter.allow('a', findID, t=100.0)
+		limiter.allow('b', findID, t=100.2)
+		self.assertEqual(list(limiter.buckets.keys()), [('a', findID), ('b', findID)])
+
+		#a has refilled completely at t = 100.5:
+		limiter.allow('c', findID, t=100.6)
+		self.assertEqual(list(limiter.buckets.keys()), [('b', findID), ('c', findID)])
+
+		limiter.allow('b', findID, t=100.6)
+		self.assertEqual(list(limiter.buckets.keys()), [('c', findID), ('b', findID)])
+
+		limiter.removeIdle(t=110.0)
+		self.assertEqual(len(limiter.buckets), 0)
+
+
+	def test_serialization(self):
+		for requestID in [0, 1, 127, 128, 300, 2**64 - 1]:
+			request = bl4p_pb2.BL4P_FindOffers()
+			request.request = requestID
+			request.query.bid.max_amount = 1000
+			message = serialize(request)
+			self.assertEqual(getTypeID(message), findID)
+			self.assertEqual(getRequestID(message), requestID)
+
+		#Out of range, too long or incomplete:
+		prefix = b'\x00\x10\x00\x00\x08'
+		self.assertEqual(getRequestID(prefix + b'\xff' * 9 + b'\x02'), 0)
+		self.assertEqual(getRequestID(prefix + b'\xff' * 10 + b'\x01'), 0)
+		self.assertEqual(getRequestID(prefix + b'\xff'), 0)
+		self.assertEqual(getRequestID(prefix), 0)
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
+
@@ -20,7 +20,9 @@ import sys
 import threading
 import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
+
+import websocket
 
 sys.path.append('..')
 
@@ -28,9 +30,11 @@ testHost = '127.0.0.1'
 testPort = 8000
 testURL = 'ws://%s:%d/' % (testHost, testPort)
 
+from bl4p_server import ratelimit
 from bl4p_server import rpcserver
 from bl4p_server.api.client import Bl4pApi
 from bl4p_server.api import bl4p_pb2
+from bl4p_server.api.serialization import serialize, deserialize
 
 
 
@@ -114,6 +118,11 @@ class TestRPCServer(unittest.TestCase):
 		self.assertEqual(userID, 3)
 		self.assertEqual(request.amount.amount, 100)
 
+		stats = self.server.getLatencyStatistics()
+		self.assertEqual(stats['normal']['queue']['count'], 1)
+		self.assertEqual(stats['normal']['response']['count'], 1)
+		self.assertEqual(stats['high']['response']['count'], 0)
+
 
 	def test_exceptionInCall(self):
 		self.generateException = True
@@ -148,6 +157,82 @@ class TestRPCServer(unittest.TestCase):
 			self.client.getStatus(payment_hash=b'foobar')
 
 
+	def test_malformedRequests(self):
+		def sendAndReceive(message, opcode=websocket.ABNF.OPCODE_BINARY):
+			self.client.websocket.send(message, opcode=opcode)
+			return deserialize(self.client.websocket.recv())
+
+		def assertMalformed(result, requestID):
+			self.assertTrue(isinstance(result, bl4p_pb2.Error))
+			self.assertEqual(result.request, requestID)
+			self.assertEqual(result.reason, bl4p_pb2.Err_MalformedRequest)
+
+		#Unsupported, unknown and missing type IDs, text messages:
+		request = bl4p_pb2.BL4P_GetStatus()
+		request.request = 42
+		request.payment_hash.data = b'foo'
+		assertMalformed(sendAndReceive(serialize(request)), 42)
+		assertMalformed(sendAndReceive(b'\xff\xff\x00\x00\x08\x2b'), 43)
+		assertMalformed(sendAndReceive(b'\x00\x10'), 0)
+		assertMalformed(sendAndReceive('foobar', opcode=websocket.ABNF.OPCODE_TEXT), 0)
+
+		#Unparseable:
+		assertMalformed(sendAndReceive(b'\x00\x10\x00\x00\x08\x2c\xff'), 44)
+
+		#Request IDs that don't fit in uint64, or are incomplete:
+		assertMalformed(sendAndReceive(b'\xff\xff\x00\x00\x08' + b'\xff' * 10), 0)
+		assertMalformed(sendAndReceive(b'\xff\xff\x00\x00\x08' + b'\xff' * 9 + b'\x02'), 0)
+		assertMalformed(sendAndReceive(b'\xff\xff\x00\x00\x08' + b'\xff' * 9 + b'\x01'), 2**64 - 1)
+		assertMalformed(sendAndReceive(b'\xff\xff\x00\x00\x08\xff'), 0)
+
+		#Size limits:
+		request = bl4p_pb2.BL4P_Start()
+		request.request = 45
+		request.amount.amount = 100
+		message = serialize(request)
+		self.server.setMaxMessageSize(bl4p_pb2.BL4P_Start, len(message) - 5)
+		assertMalformed(sendAndReceive(message), 45)
+		self.server.setMaxMessageSize(bl4p_pb2.BL4P_Start, None)
+		self.server.setMaxMessageSize(None, len(message) - 5)
+		assertMalformed(sendAndReceive(message), 45)
+		self.server.setMaxMessageSize(bl4p_pb2.BL4P_Start, len(message) - 4)
+		self.assertTrue(isinstance(sendAndReceive(message), bl4p_pb2.BL4P_StartResult))
+		self.server.setMaxMessageSize(None, None)
+		self.assertEqual(self.server.maxMessageSizes,
+			{None: None, bl4p_pb2.BL4P_Start: len(message) - 4})
+		self.server.setMaxMessageSize(bl4p_pb2.BL4P_Start, None)
+
+		#None of these were passed to the RPC function,
+		#and the connection is still usable:
+		self.assertEqual(len(self.callLog), 1)
+		self.client.start(
+			amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+		self.assertEqual(len(self.callLog), 2)
+
+
+	def test_maxFrameSize(self):
+		self.assertEqual(self.server.getMaxFrameSize(), 65536 + 4)
+		self.server.setMaxMessageSize(bl4p_pb2.BL4P_Start, 100000)
+		self.assertEqual(self.server.getMaxFrameSize(), 100000 + 4)
+		self.server.setMaxMessageSize(bl4p_pb2.BL4P_Start, 100)
+		self.assertEqual(self.server.getMaxFrameSize(), 65536 + 4)
+		self.server.setMaxMessageSize(None, 1000)
+		self.assertEqual(self.server.getMaxFrameSize(), 1000 + 4)
+		self.server.setMaxMessageSize(None, None)
+		self.assertEqual(self.server.getMaxFrameSize(), None)
+
+		#The transport gets the limit:
+		class Stop(Exception):
+			pass
+		server = rpcserver.RPCServer(testHost, testPort)
+		server.setMaxMessageSize(bl4p_pb2.BL4P_Start, 100000)
+		with patch('websockets.serve', side_effect=Stop()) as serve:
+			with self.assertRaises(Stop):
+				server.run()
+		self.assertEqual(serve.call_args[1]['max_size'], 100000 + 4)
+		server.loop.close()
+
+
 	def test_timeouts(self):
 		dt1 = None
 		dt2 = None
@@ -194,6 +279,359 @@ class TestRPCServer(unittest.TestCase):
 
 
 
+	def test_coroutineCall(self):
+		@asyncio.coroutine
+		def APIFunction(userID, request):
+			yield from asyncio.sleep(0.01)
+			if self.generateException:
+				raise Exception('(intended) test exception')
+			self.callLog.append((userID, request))
+			ret = bl4p_pb2.BL4P_StartResult()
+			ret.payment_hash.data = b'\x00\xfe'
+			return ret
+
+		self.server.registerRPCFunction(bl4p_pb2.BL4P_Start, APIFunction)
+		senderAmount, receiverAmount, paymentHash = self.client.start(
+			amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+		self.assertEqual(paymentHash, b'\x00\xfe')
+		self.assertEqual(len(self.callLog), 1)
+
+		self.generateException = True
+		with self.assertRaises(Bl4pApi.Error):
+			self.client.start(
+				amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+
+
+	def test_responseBarriers(self):
+		@asyncio.coroutine
+		def barrier():
+			self.callLog.append('barrier')
+			yield from asyncio.sleep(0.01)
+
+		self.server.registerResponseBarrier(barrier)
+		senderAmount, receiverAmount, paymentHash = self.client.start(
+			amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+		self.assertEqual(paymentHash, b'\x00\xff')
+		self.assertEqual(len(self.callLog), 2)
+		self.assertEqual(self.callLog[1], 'barrier')
+
+		#A failing barrier results in an error response:
+		@asyncio.coroutine
+		def failingBarrier():
+			raise Exception('(intended) test exception')
+
+		self.server.registerResponseBarrier(failingBarrier)
+		with self.assertRaises(Bl4pApi.Error):
+			self.client.start(
+				amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+
+
+	def test_pipelining(self):
+		@asyncio.coroutine
+		def APIFunction(userID, request):
+			yield from asyncio.sleep(request.amount.amount / 1000.0)
+			self.callLog.append(request.amount.amount)
+			return bl4p_pb2.BL4P_StartResult()
+
+		def orderingKey(request):
+			return request.sender_timeout_delta_ms or None
+
+		self.server.registerRPCFunction(bl4p_pb2.BL4P_Start, APIFunction, orderingKey)
+
+		def sendRequests(amountsAndKeys):
+			for i, (amount, key) in enumerate(amountsAndKeys):
+				request = bl4p_pb2.BL4P_Start()
+				request.request = i
+				request.amount.amount = amount
+				request.sender_timeout_delta_ms = key
+				self.client.websocket.send(serialize(request), opcode=websocket.ABNF.OPCODE_BINARY)
+			return [deserialize(self.client.websocket.recv()).request for x in amountsAndKeys]
+
+		#Without ordering key, responses are sent as they complete:
+		self.assertEqual(sendRequests([(200, 0), (100, 0), (1, 0)]), [2, 1, 0])
+		self.assertEqual(self.callLog, [1, 100, 200])
+		self.callLog = []
+
+		#Requests with the same ordering key are handled in order:
+		self.assertEqual(sendRequests([(200, 1), (100, 2), (1, 1)]), [1, 0, 2])
+		self.assertEqual(self.callLog, [100, 200, 1])
+		self.callLog = []
+
+		#A maximum of 1 in-flight request means strict ordering:
+		self.server.maxInFlight = 1
+		self.client.close()
+		self.client = Bl4pApi(testURL, '3', '3')
+		self.assertEqual(sendRequests([(200, 0), (100, 0), (1, 0)]), [0, 1, 2])
+		self.assertEqual(self.callLog, [200, 100, 1])
+
+
+	def test_orderingKeyException(self):
+		def orderingKey(request):
+			raise Exception('(intended) test exception')
+
+		self.server.registerRPCFunction(bl4p_pb2.BL4P_Start, self.APIFunction, orderingKey)
+		senderAmount, receiverAmount, paymentHash = self.client.start(
+			amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+		self.assertEqual(paymentHash, b'\x00\xff')
+		self.assertEqual(self.server.orderingKeyFunctions[bl4p_pb2.BL4P_Start], orderingKey)
+
+		self.server.registerRPCFunction(bl4p_pb2.BL4P_Start, self.APIFunction)
+		self.assertEqual(self.server.orderingKeyFunctions, {})
+
+
+	def test_rateLimit(self):
+		limiter = ratelimit.RateLimiter()
+		limiter.setLimit(bl4p_pb2.BL4P_Start, 0.001, 2)
+		self.server.setRateLimiter(limiter)
+
+		def start():
+			return self.client.start(
+				amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+
+		start()
+		start()
+		with self.assertRaises(Bl4pApi.Error):
+			start()
+		self.assertEqual(len(self.callLog), 2)
+		self.assertEqual(limiter.numRejected, 1)
+
+		#The limit is per user, not per connection:
+		self.client.close()
+		self.client = Bl4pApi(testURL, '3', '3')
+		with self.assertRaises(Bl4pApi.Error):
+			start()
+
+		#Anonymous clients are limited per connection:
+		self.client.close()
+		self.client = Bl4pApi(testURL, '3', 'wrong')
+		start()
+		self.assertEqual(len(self.callLog), 3)
+
+		#The error response has the request ID and reason:
+		request = bl4p_pb2.BL4P_Start()
+		request.request = 42
+		self.client.websocket.send(serialize(request), opcode=websocket.ABNF.OPCODE_BINARY)
+		self.client.websocket.send(serialize(request), opcode=websocket.ABNF.OPCODE_BINARY)
+		#The rejection can overtake the accepted request:
+		results = [deserialize(self.client.websocket.recv()) for i in range(2)]
+		errors = [r for r in results if isinstance(r, bl4p_pb2.Error)]
+		self.assertEqual(len(errors), 1)
+		self.assertEqual(errors[0].request, 42)
+		self.assertEqual(errors[0].reason, bl4p_pb2.Err_RateLimitExceeded)
+
+		self.server.setRateLimiter(None)
+		start()
+
+
+	def test_queueFull(self):
+		self.server.maxQueueSize = 0
+
+		with self.assertRaises(Bl4pApi.Error):
+			self.client.start(
+				amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+		self.assertEqual(self.callLog, [])
+		self.assertEqual(self.server.getQueueStatistics(),
+			{'depth': 0, 'maxDepth': 0, 'limit': 0, 'shed': 1, 'timedOut': 0})
+
+		request = bl4p_pb2.BL4P_Start()
+		request.request = 42
+		self.client.websocket.send(serialize(request), opcode=websocket.ABNF.OPCODE_BINARY)
+		result = deserialize(self.client.websocket.recv())
+		self.assertTrue(isinstance(result, bl4p_pb2.Error))
+		self.assertEqual(result.request, 42)
+		self.assertEqual(result.reason, bl4p_pb2.Err_RequestQueueFull)
+
+		self.server.maxQueueSize = 1
+		self.client.start(
+			amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+		self.assertEqual(len(self.callLog), 1)
+		self.assertEqual(self.server.getQueueStatistics(),
+			{'depth': 0, 'maxDepth': 1, 'limit': 1, 'shed': 2, 'timedOut': 0})
+
+
+	def test_dispatch(self):
+		#We want a clean server without a running thread:
+		self.client.close()
+		self.serverThread.stop()
+
+		server = rpcserver.RPCServer(testHost, testPort)
+		asyncio.set_event_loop(server.loop)
+
+		calls = []
+		def function(userID, request):
+			calls.append((request, server.numQueued))
+			if request == 'exception':
+				raise Exception('(intended) test exception')
+			return request
+
+		@asyncio.coroutine
+		def coroutineFunction(userID, request):
+			calls.append((request, server.numQueued))
+			yield from asyncio.sleep(0.01)
+			return request
+
+		@asyncio.coroutine
+		def dispatch(function, request):
+			server.numQueued += 1
+			try:
+				return (yield from server.dispatch(function, None, request))
+			except Exception as e:
+				return str(e)
+
+		results = server.loop.run_until_complete(asyncio.gather(
+			dispatch(function, 'a'),
+			dispatch(coroutineFunction, 'b'),
+			dispatch(function, 'exception'),
+			dispatch(function, 'c'),
+			))
+
+		#Dispatched in order, one at a time:
+		self.assertEqual(calls, [('a', 3), ('b', 2), ('exception', 1), ('c', 0)])
+		self.assertEqual(results, ['a', 'b', '(intended) test exception', 'c'])
+		self.assertEqual(server.numQueued, 0)
+		self.assertFalse(server.queueScheduled)
+
+		#Higher priority classes go first:
+		server.priorities = {bytes: rpcserver.Priority.low, int: rpcserver.Priority.high}
+		calls = []
+		results = server.loop.run_until_complete(asyncio.gather(
+			dispatch(function, b'low'),
+			dispatch(function, 'normal'),
+			dispatch(function, 1),
+			dispatch(function, b'low2'),
+			dispatch(function, 2),
+			))
+		self.assertEqual([c[0] for c in calls], [1, 2, 'normal', b'low', b'low2'])
+		self.assertEqual(results, [b'low', 'normal', 1, b'low2', 2])
+
+		stats = server.getLatencyStatistics()
+		self.assertEqual(set(stats.keys()), {'high', 'normal', 'low'})
+		self.assertEqual(stats['high']['queue']['count'], 2)
+		self.assertEqual(stats['normal']['queue']['count'], 5)
+		self.assertEqual(stats['low']['queue']['count'], 2)
+		self.assertEqual(stats['high']['response']['count'], 0) #only counted by handleRequest
+
+		server.loop.close()
+
+
+	def test_latencyStatistics(self):
+		stats = rpcserver.LatencyStatistics()
+		self.assertEqual(stats.get(), {'count': 0, 'mean': 0.0, 'max': 0.0})
+		stats.add(1.0)
+		stats.add(3.0)
+		self.assertEqual(stats.get(), {'count': 2, 'mean': 2.0, 'max': 3.0})
+
+
+	def test_requestTimeout(self):
+		@asyncio.coroutine
+		def APIFunction(userID, request):
+			self.callLog.append(request.request)
+			yield from asyncio.sleep(0.1)
+			return bl4p_pb2.BL4P_StartResult()
+
+		self.server.registerRPCFunction(bl4p_pb2.BL4P_Start, APIFunction, lambda r: 'key')
+		self.server.setRequestTimeout(bl4p_pb2.BL4P_Start, 0.05)
+		self.server.setRequestTimeout(bl4p_pb2.BL4P_Send, 0.5)
+
+		#The second request waits for the first, and times out:
+		for i in range(2):
+			request = bl4p_pb2.BL4P_Start()
+			request.request = i
+			self.client.websocket.send(serialize(request), opcode=websocket.ABNF.OPCODE_BINARY)
+		results = [deserialize(self.client.websocket.recv()) for i in range(2)]
+		self.assertTrue(isinstance(results[0], bl4p_pb2.BL4P_StartResult))
+		self.assertTrue(isinstance(results[1], bl4p_pb2.Error))
+		self.assertEqual(results[1].request, 1)
+		self.assertEqual(results[1].reason, bl4p_pb2.Err_RequestTimeout)
+		self.assertEqual(self.callLog, [0])
+		self.assertEqual(self.server.getQueueStatistics()['timedOut'], 1)
+
+		#Default time-out:
+		self.server.resetRequestTimeout(bl4p_pb2.BL4P_Start)
+		self.server.setRequestTimeout(None, -1.0)
+		self.assertEqual(self.server.requestTimeouts, {bl4p_pb2.BL4P_Send: 0.5, None: -1.0})
+		with self.assertRaises(Bl4pApi.Error):
+			self.client.start(
+				amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+		self.assertEqual(self.callLog, [0])
+		self.assertEqual(self.server.getQueueStatistics()['timedOut'], 2)
+
+		#A message type without time-out, despite the default:
+		self.server.setRequestTimeout(bl4p_pb2.BL4P_Start, None)
+		self.assertEqual(self.server.requestTimeouts,
+			{bl4p_pb2.BL4P_Send: 0.5, bl4p_pb2.BL4P_Start: None, None: -1.0})
+		self.client.start(
+			amount=100, sender_timeout_delta_ms=5000, locked_timeout_delta_s=5000, receiver_pays_fee=False)
+		self.assertEqual(len(self.callLog), 2)
+		self.assertEqual(self.server.getQueueStatistics()['timedOut'], 2)
+
+
+	def test_deadlines(self):
+		calls = []
+		f1 = lambda: calls.append(1)
+		f2 = lambda: calls.append(2)
+
+		#We want a clean server without a running thread:
+		self.client.close()
+		self.serverThread.stop()
+
+		server = rpcserver.RPCServer(testHost, testPort)
+		server.loop = Mock()
+
+		def assertTimerArmed(deadline):
+			server.loop.call_later.assert_called_once()
+			delay, function = server.loop.call_later.call_args[0]
+			self.assertAlmostEqual(delay, max(0.0, deadline - time.time()), places=2)
+			self.assertEqual(function, server.processDeadlines)
+			server.loop.call_later.reset_mock()
+
+		t = time.time()
+
+		server.scheduleDeadline('a', t + 10.0, f1)
+		assertTimerArmed(t + 10.0)
+
+		#A later deadline doesn't re-arm the timer:
+		server.scheduleDeadline('b', t + 20.0, f2)
+		server.loop.call_later.assert_not_called()
+
+		#An earlier deadline does:
+		server.rescheduleDeadline('b', t + 5.0)
+		assertTimerArmed(t + 5.0)
+
+		server.cancelDeadline('b')
+		assertTimerArmed(t + 10.0)
+		server.cancelDeadline('b')
+		server.loop.call_later.assert_not_called()
+
+		with self.assertRaises(KeyError):
+			server.rescheduleDeadline('b', t + 5.0)
+
+		#Processing before the deadline does nothing:
+		server.processDeadlines()
+		self.assertEqual(calls, [])
+		assertTimerArmed(t + 10.0)
+
+		server.scheduleDeadline('b', t - 1.0, f2)
+		assertTimerArmed(t - 1.0)
+		server.scheduleDeadline('a', t - 2.0, f1)
+		assertTimerArmed(t - 2.0)
+		server.scheduleDeadline('c', t + 30.0, f1)
+		server.loop.call_later.assert_not_called()
+
+		server.processDeadlines()
+		self.assertEqual(calls, [1, 2])
+		assertTimerArmed(t + 30.0)
+		self.assertEqual(list(server.deadlines.keys()), ['c'])
+
+		#Exceptions are caught:
+		def f3():
+			raise Exception('(intended) test exception')
+		server.scheduleDeadline('c', t - 1.0, f3)
+		server.processDeadlines()
+		self.assertEqual(server.deadlines, {})
+		self.assertEqual(server.deadlineTimer, None)
+
+
 if __name__ == '__main__':
 	unittest.main(verbosity=2)
 
@@ -0,0 +1,142 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import concurrent.futures
+import hashlib
+import sys
+import unittest
+from unittest.mock import patch
+
+import secp256k1
+
+sys.path.append('..')
+
+from bl4p_server import signatures
+
+
+
+sha256 = lambda preimage: hashlib.sha256(preimage).digest()
+
+
+
+class TestSignatures(unittest.TestCase):
+	def test_verify(self):
+		key = secp256k1.PrivateKey(privkey=sha256(b'3'))
+		otherKey = secp256k1.PrivateKey(privkey=sha256(b'6'))
+		signature = key.ecdsa_serialize(key.ecdsa_sign(b'foo'))
+
+		self.assertTrue(signatures.verify(key.pubkey, b'foo', signature))
+		self.assertTrue(signatures.verify(key.pubkey.serialize(), b'foo', signature))
+		self.assertTrue(signatures.verify(key.pubkey.serialize(compressed=False), b'foo', signature))
+
+		self.assertFalse(signatures.verify(key.pubkey, b'bar', signature))
+		self.assertFalse(signatures.verify(otherKey.pubkey, b'foo', signature))
+		self.assertFalse(signatures.verify(otherKey.pubkey.serialize(), b'foo', signature))
+
+		#Malformed data:
+		self.assertFalse(signatures.verify(key.pubkey, b'foo', b'bar'))
+		self.assertFalse(signatures.verify(b'bar', b'foo', signature))
+		self.assertFalse(signatures.verify(None, b'foo', signature))
+
+
+	def test_verifySchnorr(self):
+		key = secp256k1.PrivateKey(privkey=sha256(b'3'))
+		otherKey = secp256k1.PrivateKey(privkey=sha256(b'6'))
+		signature = key.schnorr_sign(b'foo', signatures.schnorrTag)
+		schnorr = signatures.SignatureType.schnorr
+
+		self.assertTrue(signatures.verify(key.pubkey, b'foo', signature, schnorr))
+		self.assertTrue(signatures.verify(key.pubkey.serialize(), b'foo', signature, schnorr))
+
+		self.assertFalse(signatures.verify(key.pubkey, b'bar', signature, schnorr))
+		self.assertFalse(signatures.verify(otherKey.pubkey, b'foo', signature, schnorr))
+		self.assertFalse(signatures.verify(key.pubkey, b'foo', key.schnorr_sign(b'foo', b'other tag'), schnorr))
+		self.assertFalse(signatures.verify(key.pubkey, b'foo', signature[:-1], schnorr))
+
+		#Signature types are not interchangeable:
+		ecdsaSignature = key.ecdsa_serialize(key.ecdsa_sign(b'foo'))
+		self.assertFalse(signatures.verify(key.pubkey, b'foo', ecdsaSignature, schnorr))
+		self.assertFalse(signatures.verify(key.pubkey, b'foo', signature))
+
+
+	def test_checkSupported(self):
+		signatures.checkSupported(signatures.SignatureType.ecdsa)
+		signatures.checkSupported(signatures.SignatureType.schnorr)
+		with self.assertRaises(signatures.UnsupportedSignatureType):
+			signatures.checkSupported('foo')
+
+		#Versions before 0.14.0 don't have BIP340 Schnorr signatures:
+		for name in ('HAS_SCHNORR', 'HAS_EXTRAKEYS'):
+			with patch('secp256k1.' + name, False):
+				with self.assertRaises(signatures.UnsupportedSignatureType):
+					signatures.checkSupported(signatures.SignatureType.schnorr)
+				signatures.checkSupported(signatures.SignatureType.ecdsa)
+
+
+	def test_BatchVerifier(self):
+		key = secp256k1.PrivateKey(privkey=sha256(b'3'))
+		pubKey = key.pubkey.serialize()
+		ecdsaSignature = key.ecdsa_serialize(key.ecdsa_sign(b'foo'))
+		schnorrSignature = key.schnorr_sign(b'foo', signatures.schnorrTag)
+		requests = \
+		[
+		(pubKey, b'foo', ecdsaSignature, signatures.SignatureType.ecdsa),
+		(pubKey, b'foo', schnorrSignature, signatures.SignatureType.schnorr),
+		(pubKey, b'bar', ecdsaSignature, signatures.SignatureType.ecdsa),
+		(pubKey, b'bar', schnorrSignature, signatures.SignatureType.schnorr),
+		(pubKey, b'foo', schnorrSignature, signatures.SignatureType.ecdsa),
+		]
+		expected = [True, True, False, False, False]
+
+		self.assertEqual(signatures.verifyBatch(requests), expected)
+
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		pools = \
+		[
+		None,
+		concurrent.futures.ThreadPoolExecutor(1),
+		concurrent.futures.ProcessPoolExecutor(1),
+		]
+		try:
+			for pool in pools:
+				#Gathered in a single batch:
+				verifier = signatures.BatchVerifier(pool, window=0.01)
+				results = loop.run_until_complete(asyncio.gather(
+					*[verifier.verify(*r) for r in requests]))
+				self.assertEqual(results, expected)
+				self.assertEqual((verifier.numBatches, verifier.numSignatures), (1, 5))
+
+				#Full batches are verified immediately:
+				verifier = signatures.BatchVerifier(pool, window=1000, maxBatchSize=2)
+				results = loop.run_until_complete(asyncio.gather(
+					*[verifier.verify(*r) for r in requests[:4]]))
+				self.assertEqual(results, expected[:4])
+				self.assertEqual((verifier.numBatches, verifier.numSignatures), (2, 4))
+				self.assertEqual(verifier.timer, None)
+		finally:
+			for pool in pools:
+				if pool is not None:
+					pool.shutdown()
+			asyncio.set_event_loop(None)
+			loop.close()
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
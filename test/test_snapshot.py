@@ -0,0 +1,188 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import unittest
+import zlib
+from unittest.mock import Mock
+
+import secp256k1
+
+sys.path.append('..')
+
+from bl4p_server import bl4p_backend
+from bl4p_server import journal
+from bl4p_server import snapshot
+from bl4p_server.bl4p_backend import User, Transaction
+
+
+
+sha256 = lambda preimage: hashlib.sha256(preimage).digest()
+
+
+
+class TestSnapshot(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.filename = os.path.join(self.directory.name, 'snapshot')
+		self.journalFilename = os.path.join(self.directory.name, 'journal')
+		self.key = secp256k1.PrivateKey(privkey=sha256(b'3'))
+
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+
+	def makeBL4P(self):
+		bl4p = bl4p_backend.BL4P()
+		bl4p.users[3] = User(id=3, balance=200, pubKey=self.key.pubkey.serialize())
+		bl4p.users[6] = User(id=6, balance=500, pubKey=None)
+		return bl4p
+
+
+	def test_writeRead(self):
+		users = [
+			User(id=3, balance=200, pubKey=self.key.pubkey.serialize()),
+			User(id=6, balance=-5, pubKey=None, signatureType='schnorr'),
+			]
+		transactions = \
+		{
+		sha256(bytes([i])):
+			Transaction(
+				sender_userid = None if i == 0 else 6,
+				receiver_userid = 3,
+				amountIncoming = 100 + i,
+				amountOutgoing = 99,
+				preimage = bytes([i]) * 32,
+				senderTimeout = 1600000000.25,
+				receiverTimeout = 1600000100.5,
+				status = status
+				)
+		for i, status in enumerate(snapshot.statuses)
+		}
+
+		snapshot.write(self.filename, 42, users, transactions)
+		generation, users2, transactions2 = snapshot.read(self.filename)
+		self.assertEqual(generation, 42)
+		self.assertEqual(transactions2, transactions)
+		self.assertEqual([(u.id, u.balance) for u in users2], [(3, 200), (6, -5)])
+		self.assertEqual(users2, users)
+
+		#Version 1 files, without signature types:
+		with open(self.filename, 'wb') as f:
+			data = snapshot.header.pack(snapshot.magicV1, 43, 1, 0) + \
+				snapshot.userRecordV1.pack(3, 200, self.key.pubkey.serialize())
+			f.write(data + snapshot.trailer.pack(zlib.crc32(data)))
+		generation, users2, transactions2 = snapshot.read(self.filename)
+		self.assertEqual(generation, 43)
+		self.assertEqual(users2, users[:1])
+		self.assertEqual(transactions2, {})
+
+		#Damaged files:
+		with open(self.filename, 'r+b') as f:
+			f.seek(snapshot.header.size + 3)
+			f.write(b'\xff')
+		with self.assertRaises(ValueError):
+			snapshot.read(self.filename)
+
+		with open(self.filename, 'wb') as f:
+			f.write(b'foo')
+		with self.assertRaises(ValueError):
+			snapshot.read(self.filename)
+
+
+	def test_snapshotter(self):
+		bl4p = self.makeBL4P()
+		bl4p.setJournal(journal.Journal(self.journalFilename))
+
+		amountIncoming, amountOutgoing, hash1 = bl4p.startTransaction(3, 100, 5, 5000, True)
+		amountIncoming, amountOutgoing, hash2 = bl4p.startTransaction(3, 100, 5, 5000, True)
+		bl4p.cancelTransaction(3, hash2)
+
+		scheduler = Mock()
+		snapshotter = snapshot.Snapshotter(bl4p, self.filename, 60.0)
+		snapshotter.start(scheduler)
+		key, deadline, function = scheduler.scheduleDeadline.call_args[0]
+		self.assertEqual(function, snapshotter.takeSnapshot)
+		self.assertAlmostEqual(deadline, time.time() + 60.0, places=1)
+
+		snapshotter.takeSnapshot()
+		self.assertEqual(bl4p.journal.generation, 1)
+
+		#State changes while the snapshot is being written:
+		amountIncoming, amountOutgoing, hash3 = bl4p.startTransaction(3, 100, 5, 5000, True)
+
+		#Wait for the child process:
+		while snapshotter.childPID is not None:
+			time.sleep(0.01)
+			snapshotter.checkSnapshot()
+		key, deadline, function = scheduler.scheduleDeadline.call_args[0]
+		self.assertEqual(function, snapshotter.checkSnapshot)
+		self.assertFalse(os.path.exists(self.filename)) #journal is not yet durable
+
+		bl4p.journal.sync()
+		snapshotter.checkSnapshot()
+		key, deadline, function = scheduler.scheduleDeadline.call_args[0]
+		self.assertEqual(function, snapshotter.takeSnapshot)
+		self.assertTrue(os.path.exists(self.filename))
+		self.assertEqual(bl4p.journal.getGenerations(), [1])
+
+		#Only the open transaction is in the snapshot:
+		generation, users, transactions = snapshot.read(self.filename)
+		self.assertEqual(generation, 1)
+		self.assertEqual(set(transactions.keys()), {hash1})
+
+		bl4p.cancelTransaction(3, hash1)
+		bl4p.journal.close()
+
+		#Restore:
+		bl4p2 = bl4p_backend.BL4P()
+		generation = snapshot.load(bl4p2, self.filename)
+		bl4p2.setJournal(journal.Journal(self.journalFilename), generation)
+		self.assertEqual(set(bl4p2.users.keys()), {3, 6})
+		self.assertEqual(bl4p2.transactions[hash1], bl4p.transactions[hash1])
+		self.assertEqual(bl4p2.transactions[hash3], bl4p.transactions[hash3])
+		self.assertFalse(hash2 in bl4p2.transactions) #finished before the snapshot
+		bl4p2.journal.close()
+
+
+	def test_failingChild(self):
+		bl4p = self.makeBL4P()
+		bl4p.setJournal(journal.Journal(self.journalFilename))
+		bl4p.users[3].pubKey = 'not a public key'
+
+		scheduler = Mock()
+		snapshotter = snapshot.Snapshotter(bl4p, self.filename, 60.0)
+		snapshotter.start(scheduler)
+		snapshotter.takeSnapshot()
+		while snapshotter.childPID is not None:
+			time.sleep(0.01)
+			snapshotter.checkSnapshot()
+
+		key, deadline, function = scheduler.scheduleDeadline.call_args[0]
+		self.assertEqual(function, snapshotter.takeSnapshot)
+		self.assertFalse(os.path.exists(self.filename))
+		bl4p.journal.close()
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
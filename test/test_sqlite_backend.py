@@ -0,0 +1,170 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+
+sys.path.append('..')
+
+from bl4p_server import bl4p_backend
+from bl4p_server import sqlite_backend
+
+import test_bl4p_backend
+
+
+
+class TestSQLiteBL4P(test_bl4p_backend.TestBL4P):
+	'''
+	Runs the BL4P tests on the SQLite back-end.
+	'''
+
+	def setUp(self):
+		test_bl4p_backend.TestBL4P.setUp(self)
+		self.directory = tempfile.TemporaryDirectory()
+		#Durability is not tested here; don't let fsync disturb the timing:
+		self.bl4p = sqlite_backend.SQLiteBL4P(':memory:')
+		self.bl4p.fee_base = 1
+		self.bl4p.fee_rate = 0
+		self.bl4p.addUser(bl4p_backend.User(id=self.senderID  , balance=0, pubKey=self.senderKey.pubkey.serialize()  ))
+		self.bl4p.addUser(bl4p_backend.User(id=self.receiverID, balance=0, pubKey=self.receiverKey.pubkey.serialize()))
+
+
+	def tearDown(self):
+		self.bl4p.close()
+		self.directory.cleanup()
+
+
+	def setBalance(self, userID, balance):
+		self.bl4p.db.execute('UPDATE users SET balance = ? WHERE id = ?', (balance, userID))
+
+	def getBalance(self, userID):
+		return self.bl4p.getUser(userID).balance
+
+
+	def getTransaction(self, paymentHash):
+		return self.bl4p.readTransaction(paymentHash)
+
+
+	#These test the internals of the in-memory back-end:
+	test_timeoutQueue = None
+	test_timingWheel = None
+	test_timeoutBacklog = None
+	test_archive = None
+	test_timeoutRetry = None
+	test_archiveFlush = None
+	test_journal = None
+	test_journalFailure = None
+
+	#Too timing-sensitive for the slower back-end; see test_timeoutBatches:
+	test_processTimeouts = None
+
+
+	def test_unsupported(self):
+		with self.assertRaises(ValueError):
+			self.bl4p.setArchive(None, 3600.0)
+		with self.assertRaises(ValueError):
+			self.bl4p.setJournal(None)
+
+
+	def test_persistence(self):
+		filename = os.path.join(self.directory.name, 'bl4p.sqlite')
+		self.bl4p.close()
+		self.bl4p = sqlite_backend.SQLiteBL4P(filename)
+		self.bl4p.fee_rate = 0
+		self.bl4p.addUser(bl4p_backend.User(id=self.senderID  , balance=500, pubKey=self.senderKey.pubkey.serialize()  ))
+		self.bl4p.addUser(bl4p_backend.User(id=self.receiverID, balance=200, pubKey=self.receiverKey.pubkey.serialize()))
+
+		data1 = self.bl4p_startTransaction()
+		self.bl4p_processSelfReport(data1)
+		self.bl4p_processSenderAck(data1)
+		data2 = self.bl4p_startTransaction()
+		self.bl4p.close()
+
+		self.bl4p = sqlite_backend.SQLiteBL4P(filename)
+		self.assertEqual(self.bl4p.db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+		#Existing users are not replaced:
+		self.bl4p.addUser(bl4p_backend.User(id=self.senderID, balance=0, pubKey=self.senderKey.pubkey.serialize()))
+		self.assertEqual(self.getBalance(self.senderID), 500 - data1.senderAmount)
+		self.assertEqual(self.getTransactionStatus(data1.paymentHash), 'waiting_for_receiver')
+		self.assertEqual(self.getTransactionStatus(data2.paymentHash), 'waiting_for_selfreport')
+
+		#Failed calls are rolled back entirely:
+		self.bl4p.setStatus = Mock(side_effect=Exception('(intended) test exception'))
+		with self.assertRaises(Exception):
+			self.bl4p_cancelTransaction(data1)
+		del self.bl4p.setStatus
+		self.assertEqual(self.getBalance(self.senderID), 500 - data1.senderAmount)
+		self.assertEqual(self.getTransactionStatus(data1.paymentHash), 'waiting_for_receiver')
+
+		self.bl4p_processReceiverClaim(data1)
+		self.assertEqual(self.getBalance(self.receiverID), 200 + data1.receiverAmount)
+
+
+	def test_upgrade(self):
+		filename = os.path.join(self.directory.name, 'bl4p.sqlite')
+		db = sqlite3.connect(filename)
+		db.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, balance INTEGER NOT NULL, pubkey BLOB)')
+		db.execute('INSERT INTO users (id, balance, pubkey) VALUES (?, ?, ?)',
+			(self.senderID, 500, self.senderKey.pubkey.serialize()))
+		db.commit()
+		db.close()
+
+		self.bl4p.close()
+		self.bl4p = sqlite_backend.SQLiteBL4P(filename)
+		self.assertEqual(self.bl4p.getUser(self.senderID), bl4p_backend.User(
+			id=self.senderID, balance=500, pubKey=self.senderKey.pubkey.serialize(), signatureType='ecdsa'))
+
+		self.bl4p.addUser(bl4p_backend.User(id=self.receiverID, balance=200,
+			pubKey=self.receiverKey.pubkey.serialize(), signatureType='schnorr'))
+		self.assertEqual(self.bl4p.getUser(self.receiverID).signatureType, 'schnorr')
+
+
+	def test_timeoutBatches(self):
+		self.setBalance(self.senderID, 500)
+		self.setBalance(self.receiverID, 200)
+		self.bl4p.minTimeBetweenTimeouts = 0.01
+		self.bl4p.timeoutBatchSize = 2
+
+		data = [self.bl4p_startTransaction(senderTimeout=0.05, lockedTimeout=0.1) for i in range(3)]
+		for d in data:
+			self.bl4p_processSelfReport(d)
+		self.bl4p_processSenderAck(data[2])
+		laterData = self.bl4p_startTransaction(senderTimeout=10)
+		self.bl4p_processSelfReport(laterData)
+
+		time.sleep(0.15)
+		self.assertEqual(self.bl4p.processTimeouts(), 0.0)
+		self.assertAlmostEqual(self.bl4p.processTimeouts(), 9.85, places=1)
+		self.assertEqual(
+			[self.getTransactionStatus(d.paymentHash) for d in data],
+			['sender_timeout', 'sender_timeout', 'receiver_timeout'])
+		self.assertEqual(self.getBalance(self.senderID), 500)
+
+		#Index on (status, timeout) is used for finding expired time-outs:
+		plan = self.bl4p.db.execute('EXPLAIN QUERY PLAN ' + sqlite_backend.selectExpired,
+			('waiting_for_sender', 0.0, 1)).fetchall()
+		self.assertTrue('transactions_status_timeout' in str(plan))
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
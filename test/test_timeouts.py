@@ -0,0 +1,188 @@
+#    Copyright (C) 2018-2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Server.
+#
+#    The BL4P Server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Server. If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import sys
+import unittest
+
+sys.path.append('..')
+
+from bl4p_server import timeouts
+
+
+
+class TestTimeoutHeap(unittest.TestCase):
+	def setUp(self):
+		self.live = {}
+		self.index = timeouts.TimeoutHeap(
+			lambda key, status: self.live.get(key) == status)
+
+
+	def add(self, timeout, key, status='s'):
+		self.live[key] = status
+		self.index.add(timeout, key, status)
+
+
+	def remove(self, key):
+		del self.live[key]
+		self.index.remove(key)
+
+
+	def test_heap(self):
+		self.assertEqual(self.index.getNextTimeout(), None)
+		self.assertEqual(self.index.popExpired(100.0), [])
+
+		self.add(10.5, 'a')
+		self.add(12.0, 'b', 'x')
+		self.add(11.0, 'c')
+		self.add(13.0, 'd')
+		self.assertEqual(self.index.getNextTimeout(), 10.5)
+
+		self.remove('a')
+		self.assertEqual(self.index.numStale, 1)
+		self.assertEqual(self.index.getNextTimeout(), 11.0)
+		self.assertEqual(self.index.numStale, 0)
+
+		self.assertEqual(self.index.popExpired(10.9), [])
+		self.assertEqual(self.index.popExpired(12.0), [('c', 's'), ('b', 'x')])
+		self.assertEqual(self.index.getNextTimeout(), 13.0)
+
+		#Compaction:
+		self.add(14.0, 'e')
+		self.add(15.0, 'f')
+		self.remove('e')
+		self.assertEqual(len(self.index.queue), 3)
+		self.remove('f')
+		self.assertEqual(self.index.queue, [(13.0, 'd', 's')])
+		self.assertEqual(self.index.numStale, 0)
+
+		#Stale entries are skipped:
+		self.add(20.0, 'g')
+		self.add(21.0, 'h')
+		self.add(22.0, 'i')
+		self.remove('g')
+		self.assertEqual(self.index.popExpired(25.0), [('d', 's'), ('h', 's'), ('i', 's')])
+		self.assertEqual(self.index.numStale, 0)
+		self.assertEqual(self.index.getNextTimeout(), None)
+
+		#Limited number of entries:
+		for key in 'jkl':
+			self.add(30.0, key)
+		self.assertEqual(self.index.popExpired(31.0, 2), [('j', 's'), ('k', 's')])
+		self.assertEqual(self.index.getNextTimeout(), 30.0)
+		self.assertEqual(self.index.popExpired(31.0, 2), [('l', 's')])
+		self.assertEqual(self.index.getNextTimeout(), None)
+
+
+
+class TestTimingWheel(unittest.TestCase):
+	def test_wheel(self):
+		wheel = timeouts.TimingWheel(1000.3)
+		self.assertEqual(wheel.getNextTimeout(), None)
+
+		wheel.add(1000.5, 'a', 's')
+		wheel.add(1000.9, 'b', 'x')
+		wheel.add(1002.0, 'c', 's')
+		wheel.add(2000.0, 'd', 's')
+		wheel.add(999.0, 'e', 's') #already expired
+		self.assertEqual(wheel.getNextTimeout(), 999.0)
+		self.assertEqual(wheel.popExpired(1000.6), [('e', 's')])
+
+		#The whole bucket expires at once, at the end of the bucket:
+		self.assertEqual(wheel.getNextTimeout(), 1001)
+		self.assertEqual(sorted(wheel.popExpired(1001.0)), [('a', 's'), ('b', 'x')])
+		self.assertEqual(wheel.getNextTimeout(), 1003)
+
+		wheel.remove('c')
+		wheel.remove('c')
+		self.assertEqual(wheel.popExpired(1500.0), [])
+
+		#Level 1 slot of bucket 2000:
+		self.assertEqual(wheel.getNextTimeout(), 1793)
+		self.assertEqual(wheel.popExpired(2000.9), [])
+		self.assertEqual(wheel.getNextTimeout(), 2001)
+		self.assertEqual(wheel.popExpired(2001.0), [('d', 's')])
+		self.assertEqual(wheel.getNextTimeout(), None)
+		self.assertEqual(wheel.location, {})
+		self.assertEqual(wheel.levelCounts, [0, 0, 0, 0])
+
+		#Limited number of entries, also from the expired queue:
+		wheel.add(2001.5, 'f', 's')
+		wheel.add(2001.6, 'g', 's')
+		wheel.add(2002.5, 'h', 's')
+		wheel.add(1999.0, 'i', 's')
+		self.assertEqual(wheel.popExpired(2003.0, 2), [('i', 's'), ('g', 's')])
+		self.assertEqual(wheel.getNextTimeout(), 2001.5)
+		wheel.remove('f')
+		self.assertEqual(wheel.getNextTimeout(), 2002.5)
+		self.assertEqual(wheel.popExpired(2003.0, 2), [('h', 's')])
+		self.assertEqual(wheel.getNextTimeout(), None)
+		self.assertEqual(wheel.location, {})
+		self.assertEqual(len(wheel.expired), 0)
+
+
+	def test_randomized(self):
+		'Compare a small wheel (with overflow) against a brute-force implementation'
+		rng = random.Random(42)
+		t = 1000.0
+		wheel = timeouts.TimingWheel(t, levelBits=(2, 2, 2))
+		reference = {}
+		nextKey = 0
+
+		for step in range(3000):
+			action = rng.random()
+			if action < 0.5:
+				timeout = t + rng.choice([rng.uniform(-2, 5), rng.uniform(0, 200)])
+				wheel.add(timeout, nextKey, 's')
+				reference[nextKey] = timeout
+				nextKey += 1
+			elif action < 0.7 and reference:
+				key = rng.choice(list(reference.keys()))
+				wheel.remove(key)
+				del reference[key]
+			else:
+				t += rng.choice([0.0, 0.3, rng.uniform(0, 30)])
+				expected = sorted(
+					key
+					for key, timeout in reference.items()
+					if int(timeout) < int(t)
+					)
+				expired = []
+				while True:
+					batch = wheel.popExpired(t, 3)
+					self.assertLessEqual(len(batch), 3)
+					expired += batch
+					if len(batch) < 3:
+						break
+				self.assertEqual(sorted(key for key, status in expired), expected)
+				for key in expected:
+					del reference[key]
+
+			nextTimeout = wheel.getNextTimeout()
+			if reference:
+				#Never too late:
+				self.assertLessEqual(nextTimeout, min(int(x) + 1 for x in reference.values()))
+			else:
+				self.assertEqual(nextTimeout, None)
+
+		self.assertEqual(len(wheel.location), len(reference))
+		self.assertEqual(sum(wheel.levelCounts), len(reference) - len(wheel.overflow) - len(wheel.due))
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
@@ -56,6 +56,69 @@ class TestUtils(unittest.TestCase):
 			TestStruct(attr1=2, attr2=1)
 			)
 
+		self.assertEqual(repr(TestStruct(attr1=1)), "TestStruct(attr1=1, attr2='default')")
+
+		#Fields are slots:
+		s = TestStruct()
+		self.assertFalse(hasattr(s, '__dict__'))
+		with self.assertRaises(AttributeError):
+			s.attr3 = 1
+		s.attr1 = 3
+		self.assertEqual(s.attr1, 3)
+
+		with self.assertRaises(TypeError):
+			TestStruct(1, 2)
+
+
+	def test_Struct_inheritance(self):
+		class BaseStruct(utils.Struct):
+			attr1 = None
+			attr2 = 'default'
+
+			def method(self):
+				return self.attr1
+
+		class DerivedStruct(BaseStruct):
+			attr2 = 'other default'
+			attr3 = 3
+
+		s = DerivedStruct(attr1=1)
+		self.assertEqual(s.attr1, 1)
+		self.assertEqual(s.attr2, 'other default')
+		self.assertEqual(s.attr3, 3)
+		self.assertEqual(s.method(), 1)
+		self.assertEqual(DerivedStruct.__slots__, ('attr3',))
+		self.assertEqual(repr(s), "DerivedStruct(attr1=1, attr2='other default', attr3=3)")
+
+		with self.assertRaises(KeyError):
+			BaseStruct(attr3=1)
+		with self.assertRaises(KeyError):
+			DerivedStruct(method=1)
+
+		self.assertNotEqual(BaseStruct(attr1=1), DerivedStruct(attr1=1))
+
+
+	def test_LRUCache(self):
+		cache = utils.LRUCache(2)
+		self.assertEqual(cache.get('a'), None)
+		self.assertEqual(cache.get('a', 'default'), 'default')
+		cache.put('a', 1)
+		cache.put('b', 2)
+		self.assertEqual(cache.get('a'), 1)
+		cache.put('c', 3) #removes b, which is least recently used
+		self.assertEqual(len(cache), 2)
+		self.assertEqual(cache.get('b'), None)
+		self.assertEqual(cache.get('a'), 1)
+		self.assertEqual(cache.get('c'), 3)
+		cache.put('a', 4) #replaces, and makes c least recently used
+		cache.put('d', 5)
+		self.assertEqual(cache.get('c'), None)
+		self.assertEqual(cache.get('a'), 4)
+		self.assertEqual((cache.hits, cache.misses), (4, 4))
+
+		cache.clear()
+		self.assertEqual(len(cache), 0)
+
 
 	def test_Enum(self):
 		testEnum = utils.Enum(['foo', 'bar'])